@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Benchmark the CompressionPolicy on a mixed corpus of emails.
+
+For every kind of email it compares always compressing with gpg's default
+(ZLIB level 6) against compressing as the policy chooses, reporting the CPU
+time spent (choosing plus compressing) and the size of the compressed data.
+The compression is done with zlib and bz2 in process, as gpg would do before
+encrypting, so no keys are needed:
+
+    python benchmarks/compression.py [rounds]
+"""
+import bz2
+import os
+import random
+import sys
+import time
+import zlib
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from memoryhole.compression import CompressionPolicy
+
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+def text(size):
+    rand = random.Random(size)
+    words = []
+    length = 0
+    while length < size:
+        word = rand.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)
+
+
+def email(*parts):
+    msg = MIMEMultipart()
+    msg['From'] = 'me@domain.com'
+    msg['To'] = 'you@other.com'
+    msg['Subject'] = 'benchmark'
+    for part in parts:
+        msg.attach(part)
+    return msg
+
+
+def corpus():
+    body = MIMEText(text(2 * 1024))
+    return [
+        ('short text', email(MIMEText(text(2 * 1024)))),
+        ('long text', email(MIMEText(text(512 * 1024)))),
+        ('html', email(body, MIMEText(text(256 * 1024), 'html'))),
+        ('jpeg', email(body, MIMEImage(os.urandom(1024 * 1024), 'jpeg'))),
+        ('zip', email(body, MIMEApplication(
+            zlib.compress(text(4 * 1024 * 1024).encode('ascii')),
+            'zip'))),
+        ('random binary', email(body, MIMEApplication(
+            os.urandom(1024 * 1024)))),
+        ('log attachment', email(body, MIMEApplication(
+            text(1024 * 1024).encode('ascii')))),
+        ('text and jpeg', email(MIMEText(text(512 * 1024)),
+                                MIMEImage(os.urandom(256 * 1024), 'jpeg'))),
+    ]
+
+
+def compress(data, compression):
+    if compression.algorithm == 'Uncompressed':
+        return data
+    if compression.algorithm == 'BZIP2':
+        return bz2.compress(data, compression.level or 9)
+    return zlib.compress(data, compression.level)
+
+
+def measure(msg, choose, rounds):
+    data = msg.as_string().encode('ascii')
+    start = time.process_time()
+    for _ in range(rounds):
+        size = len(compress(data, choose(msg)))
+    return (time.process_time() - start) / rounds, size
+
+
+def main(rounds=3):
+    policy = CompressionPolicy()
+    always = policy.compression
+
+    print('%-16s %10s %10s %10s %10s %8s' % (
+        'email', 'cpu ms', 'policy ms', 'bytes', 'policy', 'size'))
+    totals = [0.0, 0.0, 0, 0]
+    for name, msg in corpus():
+        cpu, size = measure(msg, lambda m: always, rounds)
+        pcpu, psize = measure(msg, policy.choose, rounds)
+        totals = [t + v for t, v in zip(totals, (cpu, pcpu, size, psize))]
+        print('%-16s %10.2f %10.2f %10d %10d %+7.1f%%' % (
+            name, cpu * 1000, pcpu * 1000, size, psize,
+            100.0 * (psize - size) / size))
+
+    cpu, pcpu, size, psize = totals
+    print('%-16s %10.2f %10.2f %10d %10d %+7.1f%%' % (
+        'total', cpu * 1000, pcpu * 1000, size, psize,
+        100.0 * (psize - size) / size))
+    print('CPU saved: %.1f%%' % (100.0 * (cpu - pcpu) / cpu,))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Benchmark the overhead of forwarding OpenPGP operations to a CryptoDaemon.
+
+It starts a daemon with an openpgp that only hashes the data, so only the
+framing and the socket round trip are measured, and signs texts of the given
+size from several client processes at the same time:
+
+    python benchmarks/daemon.py [processes] [requests] [size]
+"""
+import hashlib
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from memoryhole import ProtectConfig
+from memoryhole.daemon import CryptoDaemon, DaemonClient
+
+
+class HashSigner(object):
+
+    def sign(self, data, signaddr=None):
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def client(path, requests, text, latencies):
+    openpgp = DaemonClient(path)
+    start = time.time()
+    for _ in range(requests):
+        openpgp.sign(text, 'me@example.com')
+    latencies.put((time.time() - start) / requests)
+
+
+def main(processes=8, requests=2000, size=4096):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'memoryhole.sock')
+    daemon = CryptoDaemon(path, ProtectConfig(openpgp=HashSigner()))
+    daemon.start()
+    text = 'x' * size
+    try:
+        start = time.time()
+        for _ in range(requests):
+            HashSigner().sign(text)
+        direct = (time.time() - start) / requests
+
+        latencies = multiprocessing.Queue()
+        workers = [multiprocessing.Process(
+            target=client, args=(path, requests, text, latencies))
+            for _ in range(processes)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - start
+        mean = sum(latencies.get() for _ in workers) / processes
+    finally:
+        daemon.shutdown()
+        shutil.rmtree(directory)
+
+    print('%d processes, %d requests each, %d bytes' % (
+        processes, requests, size))
+    print('%-24s %8.3f ms' % ('direct call', direct * 1000))
+    print('%-24s %8.3f ms' % ('through the daemon', mean * 1000))
+    print('%-24s %8.0f requests/s' % ('daemon throughput',
+                                      processes * requests / elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
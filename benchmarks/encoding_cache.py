@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Benchmark signing a bulk mailing with the same attachment in every email.
+
+Each email has a short personalized body and the same quoted-printable text
+attachment, both are base64 encoded for signing. It measures the time to
+protect (sign) every email without and with an EncodingCache, with a signer
+that only hashes the text, so no keys are needed:
+
+    python benchmarks/encoding_cache.py [emails] [attachment KB]
+"""
+import hashlib
+import sys
+import time
+from email.charset import Charset, QP
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from memoryhole import protect, ProtectConfig
+from memoryhole.cache import EncodingCache
+
+
+class HashSigner(object):
+
+    def sign(self, data, signaddr=None):
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def newsletter(number, attachment):
+    charset = Charset('utf-8')
+    charset.body_encoding = QP
+    msg = MIMEMultipart('mixed', _subparts=[
+        MIMEText('Hello reader number %s' % (number,), 'plain', charset),
+        MIMEText(attachment, 'plain', charset)])
+    msg['From'] = 'news@example.com'
+    msg['To'] = 'reader%s@example.com' % (number,)
+    msg['Subject'] = 'Monthly news'
+    return msg
+
+
+def measure(emails, config):
+    start = time.time()
+    for msg in emails:
+        protect(msg, encrypt=False, config=config)
+    return (time.time() - start) / len(emails)
+
+
+def main(count=200, size=512):
+    line = u'Caf\u00e9 prices for this month, see the table below.\n'
+    attachment = line * (size * 1024 // len(line))
+
+    emails = [newsletter(i, attachment) for i in range(count)]
+    plain = measure(emails, ProtectConfig(openpgp=HashSigner()))
+
+    emails = [newsletter(i, attachment) for i in range(count)]
+    cache = EncodingCache()
+    cached = measure(emails, ProtectConfig(openpgp=HashSigner(),
+                                           encoding_cache=cache))
+
+    print('%d emails with a %d KB quoted-printable attachment' % (
+        count, size))
+    print('%-28s %8.2f ms/email' % ('without cache', plain * 1000))
+    print('%-28s %8.2f ms/email' % ('with EncodingCache', cached * 1000))
+    print('cache hits: %d, speedup: %.1fx' % (cache.hits, plain / cached))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
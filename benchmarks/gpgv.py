@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Benchmark the latency of verifying detached signatures with Gnupg and with
+GpgvVerifier, on a temporary keyring:
+
+    python benchmarks/gpgv.py [rounds] [size]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from binascii import hexlify
+
+from memoryhole.gpg import Gnupg
+from memoryhole.gpgv import GpgvVerifier
+
+
+def gpg(homedir, *args, **kwargs):
+    proc = subprocess.Popen(
+        ['gpg', '--batch', '--homedir', homedir, '--passphrase', ''] +
+        list(args),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(kwargs.get('data'))
+    if proc.returncode != 0:
+        raise RuntimeError(err)
+    return out
+
+
+def measure(verify, data, signature, rounds):
+    latencies = []
+    for _ in range(rounds):
+        start = time.time()
+        assert verify(data, signature)
+        latencies.append(time.time() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[-1]
+
+
+def main(rounds=50, size=64 * 1024):
+    homedir = tempfile.mkdtemp()
+    try:
+        gpg(homedir, '--quick-gen-key', 'Bench <bench@example.com>',
+            'rsa4096', 'cert,sign', 'never')
+        data = hexlify(os.urandom(size // 2)).decode('ascii')
+        signature = gpg(homedir, '-a', '-b', data=data.encode('ascii'))
+
+        backend = Gnupg(homedir)
+        verifier = GpgvVerifier(backend)
+        verifier.refresh_snapshot()
+        results = [
+            ('Gnupg', measure(backend.verify, data, signature, rounds)),
+            ('GpgvVerifier', measure(verifier.verify, data, signature,
+                                     rounds)),
+        ]
+        verifier.close()
+    finally:
+        subprocess.call(['gpgconf', '--homedir', homedir, '--kill',
+                         'gpg-agent'])
+        shutil.rmtree(homedir)
+
+    print('RSA-4096 signatures of %d KB, %d verifications' % (
+        size // 1024, rounds))
+    print('%-14s %10s %10s' % ('backend', 'median ms', 'max ms'))
+    for name, (median, worst) in results:
+        print('%-14s %10.2f %10.2f' % (name, median * 1000, worst * 1000))
+    print('speedup: %.1fx' % (results[0][1][0] / results[1][1][0],))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Benchmark decrypting the same message again with the session key cache.
+
+It creates a temporary keyring with an RSA-4096 key, encrypts a message to
+it and measures the latency of decrypting it with Gnupg without cache, and
+with a SessionKeyCache (the first decryption fills the cache):
+
+    python benchmarks/session_keys.py [rounds] [size]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from memoryhole.cache import SessionKeyCache
+from memoryhole.gpg import Gnupg
+
+
+def gpg(homedir, *args, **kwargs):
+    proc = subprocess.Popen(
+        ['gpg', '--batch', '--homedir', homedir, '--passphrase', ''] +
+        list(args),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(kwargs.get('data'))
+    if proc.returncode != 0:
+        raise RuntimeError(err)
+    return out
+
+
+def keyring(homedir):
+    gpg(homedir, '--quick-gen-key', 'Bench <bench@example.com>', 'rsa4096',
+        'cert,sign', 'never')
+    fingerprint = [line.split(':')[9] for line in gpg(
+        homedir, '--with-colons', '-k').decode().splitlines()
+        if line.startswith('fpr:')][0]
+    gpg(homedir, '--quick-add-key', fingerprint, 'rsa4096', 'encr', 'never')
+
+
+def measure(decrypt, ciphertext, rounds):
+    latencies = []
+    for _ in range(rounds):
+        start = time.time()
+        decrypt(ciphertext)
+        latencies.append(time.time() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2]
+
+
+def main(rounds=20, size=64 * 1024):
+    homedir = tempfile.mkdtemp()
+    try:
+        keyring(homedir)
+        ciphertext = gpg(homedir, '--trust-model', 'always', '-a', '-e',
+                         '-r', 'bench@example.com', data=os.urandom(size))
+
+        plain = measure(Gnupg(homedir).decrypt, ciphertext, rounds)
+
+        cache = SessionKeyCache()
+        cached = Gnupg(homedir, session_keys=cache)
+        first = measure(cached.decrypt, ciphertext, 1)
+        again = measure(cached.decrypt, ciphertext, rounds)
+    finally:
+        subprocess.call(['gpgconf', '--homedir', homedir, '--kill',
+                         'gpg-agent'])
+        shutil.rmtree(homedir)
+
+    print('RSA-4096, %d KB message, median of %d decryptions' % (
+        size // 1024, rounds))
+    print('%-28s %8.1f ms' % ('without cache', plain * 1000))
+    print('%-28s %8.1f ms' % ('first with cache', first * 1000))
+    print('%-28s %8.1f ms' % ('cached session key', again * 1000))
+    print('speedup: %.1fx' % (plain / again,))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Benchmark looking up the signing key of a sender among many identities.
+
+It creates a temporary keyring with a key for each identity and measures the
+latency of finding the signing key of a random sender with Gnupg without
+cache, listing every secret key, and with a SignerCache once the identities
+are cached:
+
+    python benchmarks/signers.py [identities] [rounds]
+"""
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from memoryhole.cache import SignerCache
+from memoryhole.gpg import Gnupg
+
+
+def gpg(homedir, *args):
+    proc = subprocess.Popen(
+        ['gpg', '--batch', '--homedir', homedir, '--passphrase', ''] +
+        list(args),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(err)
+    return out
+
+
+def measure(lookup, addresses):
+    latencies = []
+    for address in addresses:
+        start = time.time()
+        lookup(address)
+        latencies.append(time.time() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2]
+
+
+def main(identities=200, rounds=50):
+    homedir = tempfile.mkdtemp()
+    try:
+        addresses = ['user%d@example.com' % (i,) for i in range(identities)]
+        for address in addresses:
+            gpg(homedir, '--quick-gen-key', '<%s>' % (address,),
+                'future-default', 'sign', 'never')
+
+        senders = [random.choice(addresses) for _ in range(rounds)]
+        plain = measure(Gnupg(homedir)._signing_key, senders)
+
+        cached = Gnupg(homedir, signers=SignerCache())
+        first = measure(cached._signing_key, addresses)
+        again = measure(cached._signing_key, senders)
+    finally:
+        subprocess.call(['gpgconf', '--homedir', homedir, '--kill',
+                         'gpg-agent'])
+        shutil.rmtree(homedir)
+
+    print('%d identities, median latency of the lookups' % (identities,))
+    print('%-28s %8.3f ms' % ('without cache', plain * 1000))
+    print('%-28s %8.3f ms' % ('first lookup with cache', first * 1000))
+    print('%-28s %8.3f ms' % ('cached identity', again * 1000))
+    print('speedup: %.0fx' % (plain / max(again, 1e-6),))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Benchmark the throughput of a ProtectSpool.
+
+It queues emails into a temporary spool and measures the time the worker
+processes take to protect all of them, listing the incoming directory for
+every email (batch of 1) and once for each batch, with an openpgp that only
+base64 encodes the data, so the spool overhead dominates:
+
+    python benchmarks/spool.py [emails] [workers] [batch]
+"""
+import shutil
+import sys
+import tempfile
+import time
+from base64 import b64encode
+
+from memoryhole import ProtectConfig
+from memoryhole.spool import ProtectSpool
+
+
+EMAIL = """From: me@example.com
+To: you%s@example.com
+Subject: email %s
+
+body of the email
+"""
+
+
+class Base64OpenPGP(object):
+
+    def encrypt(self, data, encraddr):
+        return b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def measure(count, workers, batch):
+    path = tempfile.mkdtemp()
+    try:
+        spool = ProtectSpool(path, ProtectConfig(openpgp=Base64OpenPGP()),
+                             workers=workers, batch=batch, poll=0.01)
+        start = time.time()
+        for n in range(count):
+            spool.submit(EMAIL % (n, n))
+        submitted = time.time() - start
+
+        start = time.time()
+        spool.run(until_empty=True)
+        elapsed = time.time() - start
+        assert spool.counts()['outgoing'] == count
+        return submitted, elapsed
+    finally:
+        shutil.rmtree(path)
+
+
+def main(count=5000, workers=4, batch=100):
+    print('%d emails, %d workers' % (count, workers))
+    for size in (1, batch):
+        submitted, elapsed = measure(count, workers, size)
+        print('batch %-4d submit %8.0f emails/s  protect %8.0f emails/s' % (
+            size, count / submitted, count / elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,22 +1,42 @@
-from memoryhole.protection import protect, ProtectConfig
+from memoryhole.protection import (
+    protect, protect_to_bytes, protect_to_file, ProtectConfig
+)
 from memoryhole.openpgp import IOpenPGP
 from memoryhole.gpg import Gnupg
+from memoryhole.classify import classify
+from memoryhole import unwrapping
+from memoryhole.unwrapping import UnwrapFeeder
+from memoryhole.walk import DEFAULT_LIMITS, MIMELimitError, MIMELimits
 
 
-def unwrap(msg, opengp=Gnupg()):
+def unwrap(msg, openpgp=None, workers=4, limits=DEFAULT_LIMITS,
+           recorder=None):
     """
     Unwrap an email replacing and verifying memory hole headers.
 
+    Independent signed and encrypted parts of the email are verified and
+    decrypted concurrently by up to workers threads.
+
     :param msg: the email to be unwrapped
     :type msg: Message
     :param openpgp: the implementation of openpgp to use for decryption and/or
                     verification
     :type openpgp: OpenPGP
+    :param workers: maximum number of parts unwrapped at the same time
+    :type workers: int
+    :param limits: limits on the structure of the email, None for no limits
+    :type limits: MIMELimits
+    :param recorder: recorder of slow operations (see memoryhole.slowops)
+    :type recorder: SlowOpRecorder
 
     :return: a decrypted email
     :rtype: Message
     """
-    raise NotImplementedError()
+    if openpgp is None:
+        openpgp = Gnupg()
+    return unwrapping.unwrap(msg, openpgp, workers, limits, recorder)
 
 
-__all__ = ["protect", "ProtectConfig", "unwrap", "IOpenPGP"]
+__all__ = ["protect", "protect_to_bytes", "protect_to_file", "ProtectConfig",
+           "unwrap", "UnwrapFeeder", "classify", "IOpenPGP", "MIMELimits",
+           "MIMELimitError"]
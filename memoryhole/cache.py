@@ -0,0 +1,681 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from email.parser import Parser
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from memoryhole.message import ProtectionLevel
+
+
+class ProtectCache(object):
+
+    def __init__(self, max_entries=1024, ttl=None, secret=None,
+                 fingerprint_ttl=60):
+        """
+        Cache of protected emails, so retries of the same protection don't
+        need any crypto operation.
+
+        Entries are keyed by a digest of the original email, the recipients,
+        the signer and the ProtectConfig used, including its compression
+        policy and which openpgp backend and keyring (its homedir) it uses.
+        While the cache is configured protect uses boundaries derived from
+        the key with an HMAC under secret, so the same email protected twice
+        has the same structure but the boundaries don't reveal anything
+        about the email.
+
+        The key fingerprints of the addresses are part of the key, they are
+        looked up at most once every fingerprint_ttl seconds, so a key
+        rotation invalidates the entries after that time.
+
+        :param max_entries: maximum number of emails in the cache, the least
+                            recently used are discarded first
+        :type max_entries: int
+        :param ttl: seconds an entry is valid, None for no expiration
+        :type ttl: float
+        :param secret: key of the boundaries HMAC, random if not given.
+                       Caches sharing the secret use the same boundaries.
+        :type secret: bytes
+        :param fingerprint_ttl: seconds the fingerprints of an address are
+                                remembered
+        :type fingerprint_ttl: float
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.fingerprint_ttl = fingerprint_ttl
+        self._secret = secret if secret is not None else os.urandom(32)
+        self._fingerprints = OrderedDict()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, msg, encrypt, sign, config, encraddr, signaddr):
+        """
+        Calculate the cache key for the protection of msg.
+
+        :param msg: the email to be protected
+        :type msg: Message
+        :param encrypt: will the message be encrypted
+        :type encrypt: bool
+        :param sign: will the message be signed
+        :type sign: bool
+        :param config: the protection configuration
+        :type config: ProtectConfig
+        :param encraddr: the recipients of the encryption
+        :type encraddr: [str]
+        :param signaddr: the address used for signing
+        :type signaddr: str
+
+        :return: the hex digest identifying the protection
+        :rtype: str
+        """
+        h = hashlib.sha256()
+        h.update(_to_bytes(msg.as_string(unixfrom=False)))
+        h.update(_to_bytes(repr((
+            encrypt, sign, sorted(encraddr), signaddr,
+            sorted(config.replaced_headers.items()),
+            sorted(config.skipped_headers),
+            _compression_id(config.compression),
+            _backend_id(config.openpgp),
+            self._lookup_fingerprints(config.openpgp, encraddr, signaddr),
+        ))))
+        return h.hexdigest()
+
+    def boundary(self, key, suffix=''):
+        """
+        Deterministic multipart boundary for the cache key.
+
+        :param key: the cache key
+        :type key: str
+        :param suffix: added to the boundary, to have several per key
+        :type suffix: str
+
+        :rtype: str
+        """
+        mac = hmac.new(self._secret, _to_bytes(key), hashlib.sha256)
+        digest = mac.hexdigest()[:32]
+        return '=============memoryhole-%s%s==' % (digest, suffix)
+
+    def get(self, key):
+        """
+        Get the protected email stored for key.
+
+        :return: the protected email or None if it's not in the cache
+        :rtype: Message
+        """
+        cached = self.get_text(key)
+        if cached is None:
+            return None
+        return cached_message(*cached)
+
+    def get_text(self, key):
+        """
+        Get the flattened protected email stored for key.
+
+        :return: the flattened email and its protection level, or None if
+                 it's not in the cache
+        :rtype: (str, ProtectionLevel)
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and self.ttl is not None:
+                if time.time() - entry[2] > self.ttl:
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+        return entry[0], entry[1]
+
+    def put(self, key, msg):
+        """
+        Store the protected email msg under key.
+
+        :param msg: the protected email
+        :type msg: Message
+        """
+        self.put_text(key, msg.as_string(unixfrom=False),
+                      msg.protection_level)
+
+    def put_text(self, key, text, protection_level):
+        """
+        Store the flattened protected email text under key.
+
+        :param text: the flattened protected email
+        :type text: str
+        :param protection_level: the protection of the email
+        :type protection_level: ProtectionLevel
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (text, protection_level, time.time())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup_fingerprints(self, openpgp, encraddr, signaddr):
+        """
+        The key fingerprints of the addresses, if the openpgp implementation
+        knows how to find them. That way a key rotation invalidates the
+        entries protected with the old keys.
+        """
+        fingerprints = getattr(openpgp, 'fingerprints', None)
+        if fingerprints is None:
+            return None
+        addresses = list(encraddr)
+        if signaddr is not None:
+            addresses.append(signaddr)
+        lookup = (id(openpgp), tuple(sorted(addresses)))
+
+        now = time.time()
+        with self._lock:
+            found = self._fingerprints.get(lookup)
+            if found is not None and now - found[1] < self.fingerprint_ttl:
+                return found[0]
+
+        found = sorted(fingerprints(addresses))
+        with self._lock:
+            self._fingerprints.pop(lookup, None)
+            self._fingerprints[lookup] = (found, now)
+            while len(self._fingerprints) > self.max_entries:
+                self._fingerprints.popitem(last=False)
+        return found
+
+
+class SessionKeyCache(object):
+
+    def __init__(self, max_entries=1024, ttl=300):
+        """
+        Cache of the session keys of decrypted messages, so decrypting the
+        same message again only needs the symmetric decryption.
+
+        Session keys decrypt their messages, so they are only kept in memory
+        for ttl seconds, and are overwritten when discarded. Entries are
+        keyed by a digest of the gpg homedir and the encrypted message:
+        the key of a message is only used by the keyring that decrypted it.
+
+        :param max_entries: maximum number of keys in the cache, the least
+                            recently used are discarded first
+        :type max_entries: int
+        :param ttl: seconds a key is kept
+        :type ttl: float
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, homedir, ciphertext):
+        """
+        Get the session key of ciphertext.
+
+        :return: a copy of the session key, that the caller can overwrite
+                 once used, or None if it's not in the cache
+        :rtype: bytearray
+        """
+        digest = self._digest(homedir, ciphertext)
+        with self._lock:
+            entry = self._entries.pop(digest, None)
+            if entry is not None and time.time() - entry[1] > self.ttl:
+                _wipe(entry[0])
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[digest] = entry
+            self.hits += 1
+            return bytearray(entry[0])
+
+    def put(self, homedir, ciphertext, session_key):
+        """
+        Store the session key of ciphertext.
+
+        :param session_key: the session key as gpg prints it,
+                            algorithm:hexkey
+        :type session_key: bytes
+        """
+        digest = self._digest(homedir, ciphertext)
+        with self._lock:
+            old = self._entries.pop(digest, None)
+            if old is not None:
+                _wipe(old[0])
+            self._entries[digest] = (bytearray(session_key), time.time())
+            while len(self._entries) > self.max_entries:
+                _, (key, _) = self._entries.popitem(last=False)
+                _wipe(key)
+
+    def discard(self, homedir, ciphertext):
+        digest = self._digest(homedir, ciphertext)
+        with self._lock:
+            entry = self._entries.pop(digest, None)
+            if entry is not None:
+                _wipe(entry[0])
+
+    def clear(self):
+        with self._lock:
+            for key, _ in self._entries.values():
+                _wipe(key)
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _digest(self, homedir, ciphertext):
+        h = hashlib.sha256()
+        h.update(_to_bytes(homedir or ''))
+        h.update(b'\0')
+        h.update(_to_bytes(ciphertext))
+        return h.digest()
+
+
+class EncodingCache(object):
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, min_size=4096,
+                 directory=None):
+        """
+        Cache of base64 encoded payloads, so attachments repeated in many
+        emails, like the logo of a newsletter, are only transcoded once by
+        encode_base64.
+
+        Entries are keyed by a digest of the payload, as it is in the email,
+        and its content-transfer-encoding. Payloads smaller than min_size are
+        not cached, hashing them costs as much as encoding them. The least
+        recently used entries are evicted once the encoded payloads add up to
+        more than max_bytes, payloads bigger than max_bytes are not cached.
+
+        The entries are kept in memory, or in directory if given. A directory
+        can be shared by the worker processes of a pool: each entry is a file
+        written atomically, and the total size of the files is kept in the
+        directory too, updated under a lock file, so all the processes
+        together keep it under max_bytes removing the files used longest
+        ago. A pickled cache only keeps the directory, in memory entries are
+        not copied.
+
+        :param max_bytes: maximum size of the encoded payloads in the cache
+        :type max_bytes: int
+        :param min_size: minimum size of the payloads to cache
+        :type min_size: int
+        :param directory: directory to keep the entries in, None to keep them
+                          in memory
+        :type directory: str
+        """
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, payload, encoding):
+        """
+        Calculate the cache key for a payload.
+
+        :param payload: the payload as it is in the email
+        :type payload: str
+        :param encoding: the content-transfer-encoding of the payload
+        :type encoding: str
+
+        :return: the hex digest identifying the payload, None if it's too
+                 small to be cached
+        :rtype: str
+        """
+        if payload is None or len(payload) < self.min_size:
+            return None
+        h = hashlib.sha256()
+        h.update(_to_bytes(encoding or ''))
+        h.update(b'\0')
+        h.update(_payload_bytes(payload))
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Get the encoded payload stored for key.
+
+        :return: the base64 encoded payload, or None if it's not in the cache
+        :rtype: str
+        """
+        if self.directory is None:
+            with self._lock:
+                encoded = self._entries.pop(key, None)
+                if encoded is not None:
+                    self._entries[key] = encoded
+        else:
+            encoded = self._read(key)
+        with self._lock:
+            if encoded is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return encoded
+
+    def put(self, key, encoded):
+        """
+        Store the encoded payload under key.
+
+        :param encoded: the base64 encoded payload
+        :type encoded: str
+        """
+        if len(encoded) > self.max_bytes:
+            return
+        if self.directory is not None:
+            self._write(key, encoded)
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = encoded
+            self._size += len(encoded)
+            while self._size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def __len__(self):
+        if self.directory is None:
+            return len(self._entries)
+        return len(self._files())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_entries'] = OrderedDict()
+        state['_size'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _read(self, key):
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, 'rb') as f:
+                encoded = f.read().decode('ascii')
+            # the modification time orders the entries for eviction
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return encoded
+
+    def _write(self, key, encoded):
+        path = os.path.join(self.directory, key)
+        tmppath = os.path.join(self.directory,
+                               '.%s.%s.tmp' % (key, os.getpid()))
+        with open(tmppath, 'wb') as f:
+            f.write(encoded.encode('ascii'))
+
+        with self._directory_lock():
+            try:
+                replaced = os.stat(path).st_size
+            except OSError:
+                replaced = 0
+            os.rename(tmppath, path)
+            size = self._read_size()
+            if size is None:
+                size = self._evict_files()
+            else:
+                size += len(encoded) - replaced
+                if size > self.max_bytes:
+                    size = self._evict_files()
+            self._write_size(size)
+
+    @contextmanager
+    def _directory_lock(self):
+        """
+        Lock the directory against the other processes and threads using it.
+        """
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.directory, '.lock'), 'a') as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _read_size(self):
+        """
+        :return: the total size of the entries, None if unknown
+        :rtype: int
+        """
+        try:
+            with open(os.path.join(self.directory, '.size')) as f:
+                return int(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_size(self, size):
+        tmppath = os.path.join(self.directory, '.size.%s.tmp' % (os.getpid(),))
+        with open(tmppath, 'w') as f:
+            f.write(str(size))
+        os.rename(tmppath, os.path.join(self.directory, '.size'))
+
+    def _evict_files(self):
+        """
+        Remove the files used longest ago until the directory is under
+        max_bytes, leaving room for some entries more so the directory is
+        not scanned on every put.
+
+        :return: the total size of the entries left
+        :rtype: int
+        """
+        files = self._files()
+        total = sum(size for _, _, size in files)
+        if total > self.max_bytes:
+            files.sort()
+            limit = self.max_bytes * 9 // 10
+            for _, path, size in files:
+                if total <= limit:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    # removed by another process
+                    pass
+                total -= size
+        return total
+
+    def _files(self):
+        """
+        :return: the modification time, path and size of each entry
+        :rtype: [(float, str, int)]
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, path, stat.st_size))
+        return files
+
+
+class SignerCache(object):
+
+    def __init__(self, max_entries=10000, idle=600, passphrase=None):
+        """
+        Cache of the signing identities of a server signing for many
+        senders, so the secret key of a sender is only looked up once.
+
+        Each identity keeps the fingerprint of its signing key and the
+        keygrips of the key. If passphrase is given Gnupg presets the
+        passphrase of the key into gpg-agent when it resolves the identity,
+        so the key stays unlocked while the identity is in the cache (the
+        agent needs allow-preset-passphrase in its gpg-agent.conf). Identities
+        not used for idle seconds are evicted and their passphrases cleared
+        from the agent.
+
+        :param max_entries: maximum number of identities in the cache, the
+                            least recently used are evicted first
+        :type max_entries: int
+        :param idle: seconds an identity is kept without being used
+        :type idle: float
+        :param passphrase: callable that gets an address and returns the
+                           passphrase of its key, or None if it has no
+                           passphrase
+        :type passphrase: callable
+        """
+        self.max_entries = max_entries
+        self.idle = idle
+        self.passphrase = passphrase
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def get(self, homedir, address):
+        """
+        Get the fingerprint of the signing key of address.
+
+        :return: the fingerprint, or None if the identity is not in the cache
+        :rtype: str
+        """
+        key = (homedir, address.lower())
+        with self._lock:
+            evicted = self._evict_idle()
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries[key] = entry._replace(used=time.time())
+                self.hits += 1
+        _release(evicted)
+        return entry.fingerprint if entry is not None else None
+
+    def put(self, homedir, address, fingerprint, keygrips=(), release=None):
+        """
+        Store the signing key of address.
+
+        :param fingerprint: the fingerprint of the key
+        :type fingerprint: str
+        :param keygrips: the keygrips of the key and its subkeys
+        :type keygrips: [str]
+        :param release: callable run when the identity is evicted, like
+                        clearing its passphrase from the agent
+        :type release: callable
+        """
+        key = (homedir, address.lower())
+        entry = _Signer(fingerprint, tuple(keygrips), release, time.time())
+        with self._lock:
+            idle = self._evict_idle()
+            evicted = []
+            old = self._entries.pop(key, None)
+            if old is not None:
+                evicted.append(old)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[1])
+            self.evicted += len(evicted)
+        _release(idle + evicted)
+
+    def evict_idle(self):
+        """
+        Evict the identities not used for idle seconds.
+        """
+        with self._lock:
+            evicted = self._evict_idle()
+        _release(evicted)
+
+    def clear(self):
+        with self._lock:
+            evicted = list(self._entries.values())
+            self._entries.clear()
+            self.evicted += len(evicted)
+        _release(evicted)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict_idle(self):
+        # entries are in the order they were last used
+        evicted = []
+        limit = time.time() - self.idle
+        while self._entries:
+            key = next(iter(self._entries))
+            if self._entries[key].used > limit:
+                break
+            evicted.append(self._entries.pop(key))
+        self.evicted += len(evicted)
+        return evicted
+
+
+_Signer = namedtuple("_Signer", ("fingerprint", "keygrips", "release", "used"))
+
+
+def _release(signers):
+    """
+    Run the release callables of evicted signers, out of the cache lock as
+    they might run gpg.
+    """
+    for signer in signers:
+        if signer.release is not None:
+            signer.release()
+
+
+def _wipe(key):
+    key[:] = b'\0' * len(key)
+
+
+def cached_message(text, protection_level):
+    """
+    Parse a flattened email from the cache.
+
+    :rtype: Message
+    """
+    msg = Parser().parsestr(text)
+    msg.protection_level = ProtectionLevel(
+        set(protection_level.signed_by), set(protection_level.encrypted_by))
+    return msg
+
+
+def _compression_id(policy):
+    if policy is None:
+        return None
+    return (type(policy).__name__, sorted(vars(policy).items()))
+
+
+def _backend_id(openpgp):
+    """
+    The kind of backend and its keyring, the same in every process using
+    them so caches sharing the secret still agree on the keys.
+    """
+    backend = type(openpgp)
+    return (backend.__module__, backend.__name__,
+            getattr(openpgp, 'homedir', None))
+
+
+def _payload_bytes(payload):
+    if isinstance(payload, bytes):
+        return payload
+    try:
+        return payload.encode('utf-8', 'surrogateescape')
+    except LookupError:
+        # python 2 has no surrogateescape
+        return payload.encode('utf-8')
+
+
+def _to_bytes(s):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return s
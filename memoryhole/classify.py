@@ -0,0 +1,117 @@
+"""
+Classify raw emails by their memory hole protection without parsing them.
+"""
+import re
+from collections import namedtuple
+from email.message import Message
+from email.parser import HeaderParser
+
+
+ENCRYPTED = 'encrypted'
+SIGNED = 'signed'
+PROTECTED_HEADERS = 'protected-headers'
+
+# headers bigger than this are not looked at
+MAX_HEADER_SIZE = 64 * 1024
+_CHUNK_SIZE = 4 * 1024
+
+Classification = namedtuple(
+    "Classification", ("protection", "protocol", "micalg", "boundary"))
+
+_header_end = re.compile(b'\r?\n\r?\n')
+
+
+def classify(raw):
+    """
+    Classify a raw email by its protection.
+
+    Only the header block of the email and the headers of its first part are
+    read, so the cost doesn't depend on the size of the email.
+
+    The protection is ENCRYPTED for multipart/encrypted emails, SIGNED for
+    multipart/signed ones, PROTECTED_HEADERS for multiparts where the first
+    part is text/rfc822-headers, and None otherwise.
+
+    :param raw: the email
+    :type raw: bytes, bytearray, mmap or memoryview
+
+    :return: the protection, protocol, micalg and boundary of the email
+    :rtype: Classification
+    """
+    view = memoryview(raw)
+    headers, end = _headers(view, 0)
+    if headers is None:
+        return Classification(None, None, None, None)
+
+    content_type = headers.get_content_type()
+    boundary = headers.get_boundary()
+    protocol = headers.get_param('protocol')
+    micalg = headers.get_param('micalg')
+
+    protection = None
+    if content_type == 'multipart/encrypted':
+        protection = ENCRYPTED
+    elif content_type == 'multipart/signed':
+        protection = SIGNED
+    elif headers.get_content_maintype() == 'multipart' and boundary:
+        first = _first_part_headers(view, end, boundary)
+        if (first is not None and
+                first.get_content_type() == 'text/rfc822-headers'):
+            protection = PROTECTED_HEADERS
+    return Classification(protection, protocol, micalg, boundary)
+
+
+def _headers(view, start):
+    """
+    Parse the header block starting at start.
+
+    :return: a message with only the content headers and the position where
+             the body starts
+    :rtype: (Message, int)
+    """
+    block, match = _search(view, start, _header_end.search)
+    if match is None:
+        return None, None
+    parsed = HeaderParser().parsestr(
+        block[:match.start()].decode('latin-1'))
+
+    headers = Message()
+    for name in ('content-type', 'content-transfer-encoding'):
+        if name in parsed:
+            headers[name] = parsed[name]
+    return headers, start + match.end()
+
+
+def _first_part_headers(view, start, boundary):
+    # a whole line, so the boundary b1 doesn't match --b10
+    delimiter = re.compile(
+        b'^--' + re.escape(boundary.encode('latin-1')) +
+        b'(?:--)?[ \t]*\r?\n', re.M)
+    block, match = _search(view, start, delimiter.search)
+    if match is None:
+        return None
+    eol = match.end() - 1
+    if (block[eol + 1:eol + 2] == b'\n' or
+            block[eol + 1:eol + 3] == b'\r\n'):
+        # the part has no headers, it's text/plain
+        return Message()
+    headers, _ = _headers(view, start + eol + 1)
+    return headers
+
+
+def _search(view, start, search):
+    """
+    Look for the first match of search in view after start, copying only
+    growing chunks of view up to MAX_HEADER_SIZE.
+
+    :return: the block copied and the match
+    :rtype: (bytes, match)
+    """
+    size = _CHUNK_SIZE
+    while True:
+        block = view[start:start + size].tobytes()
+        match = search(block)
+        if (match is not None or size >= MAX_HEADER_SIZE or
+                start + size >= len(view)):
+            return block, match
+        size *= 2
@@ -0,0 +1,142 @@
+import binascii
+import math
+from collections import Counter, namedtuple
+
+from memoryhole.walk import walk
+
+
+Compression = namedtuple("Compression", ("algorithm", "level"))
+
+UNCOMPRESSED = Compression('Uncompressed', 0)
+
+
+class CompressionPolicy(object):
+
+    # content types that are already compressed
+    COMPRESSED_TYPES = frozenset([
+        'application/gzip',
+        'application/pdf',
+        'application/x-7z-compressed',
+        'application/x-bzip2',
+        'application/x-gzip',
+        'application/x-rar-compressed',
+        'application/x-xz',
+        'application/zip',
+        'image/gif',
+        'image/jpeg',
+        'image/png',
+        'image/webp',
+    ])
+    COMPRESSED_MAINTYPES = frozenset(['audio', 'video'])
+
+    def __init__(self, algorithm='ZLIB', level=6, max_compressed=0.5,
+                 max_entropy=7.5, sample_size=4096, min_size=64 * 1024):
+        """
+        Choose the compression of each email before encryption.
+
+        Compressing data that is already compressed (JPEG, ZIP, PDF, ...)
+        costs CPU and saves almost nothing. The parts of the email are
+        considered already compressed if their content type says so, or if a
+        sample of their content has more than max_entropy bits per byte.
+        If more than max_compressed of the email payload is already
+        compressed the email is encrypted uncompressed, otherwise it is
+        compressed with algorithm and level. Emails smaller than min_size
+        are always compressed, there is not much CPU to save on them.
+
+        Note that attachments are base64 encoded in the email, and compression
+        still shrinks already compressed ones by about a quarter; not
+        compressing them trades that size for the CPU (see
+        benchmarks/compression.py).
+
+        :param algorithm: the algorithm for compressible emails, one of
+                          'ZLIB', 'ZIP' or 'BZIP2'
+        :type algorithm: str
+        :param level: the compression level for compressible emails
+        :type level: int
+        :param max_compressed: maximum fraction of already compressed
+                               payload to compress an email
+        :type max_compressed: float
+        :param max_entropy: bits per byte above which a part is considered
+                            compressed
+        :type max_entropy: float
+        :param sample_size: bytes of each part used to calculate its entropy
+        :type sample_size: int
+        :param min_size: payload size below which emails are always
+                         compressed
+        :type min_size: int
+        """
+        self.compression = Compression(algorithm, level)
+        self.max_compressed = max_compressed
+        self.max_entropy = max_entropy
+        self.sample_size = sample_size
+        self.min_size = min_size
+
+    def choose(self, msg):
+        """
+        Choose the compression for msg.
+
+        :param msg: the email to be encrypted
+        :type msg: Message
+
+        :rtype: Compression
+        """
+        total = 0
+        compressed = 0
+        for _, _, part, _ in walk(msg):
+            if part.is_multipart():
+                continue
+            size = len(part.get_payload())
+            total += size
+            if self.is_compressed(part):
+                compressed += size
+
+        if total < self.min_size:
+            return self.compression
+        if compressed > total * self.max_compressed:
+            return UNCOMPRESSED
+        return self.compression
+
+    def is_compressed(self, part):
+        """
+        Is the content of part already compressed.
+
+        :param part: a non multipart part
+        :type part: Message
+
+        :rtype: bool
+        """
+        if (part.get_content_type() in self.COMPRESSED_TYPES or
+                part.get_content_maintype() in self.COMPRESSED_MAINTYPES):
+            return True
+        if part.get_content_maintype() == 'text':
+            return False
+        return entropy(self._sample(part)) > self.max_entropy
+
+    def _sample(self, part):
+        payload = part.get_payload()
+        encoding = part.get('content-transfer-encoding', '').lower()
+        if encoding == 'base64':
+            # decode only the begining of the payload
+            chars = -(-self.sample_size * 4 // 3) // 4 * 4
+            encoded = ''.join(payload[:chars * 2].split())[:chars]
+            try:
+                return binascii.a2b_base64(encoded)
+            except binascii.Error:
+                return b''
+        return part.get_payload(decode=True)[:self.sample_size]
+
+
+def entropy(data):
+    """
+    Shannon entropy of data in bits per byte.
+
+    :param data: the data
+    :type data: bytes
+
+    :rtype: float
+    """
+    if not data:
+        return 0.0
+    length = float(len(data))
+    return -sum(count / length * math.log(count / length, 2)
+                for count in Counter(bytearray(data)).values())
@@ -0,0 +1,527 @@
+"""
+Local crypto daemon shared by the processes of an application.
+
+Usage:
+
+    python -m memoryhole.daemon [--homedir HOMEDIR] [--pool-size N] SOCKET
+
+A CryptoDaemon keeps a warm pool of backends and the caches of a
+ProtectConfig, and serves OpenPGP operations and whole protect and unwrap
+requests over a Unix domain socket. DaemonClient implements IOpenPGP
+forwarding every call to the daemon, so the processes of a web application
+share one set of gpg processes and caches instead of warming their own.
+
+Requests and responses are frames of length prefixed fields:
+
+    4 bytes  length of the fields (big endian)
+    1 byte   operation code in requests, OK or ERROR in responses
+    2 bytes  number of fields
+    fields   4 bytes length and the bytes of each one, 0xffffffff for None
+
+Lists of strings are sent in one field separated by NUL bytes.
+"""
+import argparse
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+import threading
+from email.parser import BytesParser
+from functools import partial
+
+try:
+    import socketserver
+except ImportError:
+    # python 2
+    import SocketServer as socketserver
+
+from zope.interface import implementer
+
+from memoryhole.compression import Compression
+from memoryhole.gpg import GnupgTimeout
+from memoryhole.message import MemoryHoleMessage, ProtectionLevel
+from memoryhole.openpgp import (
+    IOpenPGP, Decryption, decrypt_verify, encrypt_args, key_addresses,
+    sign_as, verify_signer
+)
+from memoryhole.pool import OpenPGPPool, PoolFullError
+from memoryhole.protection import protect_to_bytes, ProtectConfig
+from memoryhole.unwrapping import unwrap
+from memoryhole.walk import MIMELimitError
+
+
+ENCRYPT = 1
+SIGN = 2
+DECRYPT = 3
+DECRYPT_VERIFY = 4
+VERIFY = 5
+PROTECT = 6
+UNWRAP = 7
+SLOW_OPS = 8
+VERIFY_SIGNER = 9
+KEY_ADDRESSES = 10
+
+OK = 0
+ERROR = 1
+
+# frames bigger than this are refused
+MAX_FRAME = 256 * 1024 * 1024
+
+_HEADER = struct.Struct('!IBH')
+_LENGTH = struct.Struct('!I')
+_NONE = 0xffffffff
+
+# errors raised again as they are on the client
+_ERRORS = dict((cls.__name__, cls) for cls in (
+    MIMELimitError, GnupgTimeout, PoolFullError))
+
+
+class DaemonError(RuntimeError):
+    """
+    Raised by DaemonClient when the daemon fails a request.
+    """
+
+
+class FrameError(ValueError):
+    """
+    Raised on malformed or too big frames.
+    """
+
+
+class CryptoDaemon(object):
+
+    def __init__(self, path, config=None, mode=0o600, workers=4):
+        """
+        Serve the OpenPGP operations of config.openpgp and protect and
+        unwrap with config on the Unix socket path.
+
+        Each client connection is served by its own thread and can send
+        any number of requests, the backend of config decides how many run
+        at the same time (see OpenPGPPool). A stale socket file left in
+        path is replaced.
+
+        :param path: path of the Unix socket
+        :type path: str
+        :param config: configuration for protect, its openpgp serves the
+                       operations and unwrap, by default a pool of Gnupg
+        :type config: ProtectConfig
+        :param mode: permissions of the socket file
+        :type mode: int
+        :param workers: maximum parts of an email unwrapped at the same time
+        :type workers: int
+        """
+        if config is None:
+            from memoryhole.gpg import Gnupg
+            config = ProtectConfig(openpgp=OpenPGPPool(Gnupg))
+        self.path = path
+        self.config = config
+        self.workers = workers
+
+        if (os.path.exists(path) and
+                stat.S_ISSOCK(os.stat(path).st_mode)):
+            os.remove(path)
+        # the socket is created with mode, there is no moment when others
+        # can connect to it
+        umask = os.umask(~mode & 0o777)
+        try:
+            self._server = _Server(path, _Handler)
+        finally:
+            os.umask(umask)
+        self._server.crypto_daemon = self
+
+    def serve_forever(self):
+        """
+        Serve requests until shutdown is called.
+        """
+        self._server.serve_forever()
+
+    def start(self):
+        """
+        Serve requests in a background thread.
+
+        :rtype: Thread
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        """
+        Stop serving and remove the socket file.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def handle(self, code, fields):
+        """
+        Run a request.
+
+        :param code: the operation
+        :type code: int
+        :param fields: the fields of the request
+        :type fields: [bytes]
+
+        :return: the fields of the response
+        :rtype: [bytes]
+        """
+        openpgp = self.config.openpgp
+        if code == ENCRYPT:
+            data, encraddr, signaddr, compression = fields
+            if compression is not None:
+                algorithm, level = _text(compression).split(' ')
+                compression = Compression(algorithm, int(level))
+            args, kwargs = encrypt_args(_text(data), _split(encraddr),
+                                        _text(signaddr), compression)
+            return [openpgp.encrypt(*args, **kwargs)]
+        if code == SIGN:
+            data, signaddr = fields
+            return [sign_as(openpgp, _text(data), _text(signaddr))]
+        if code == DECRYPT:
+            return [openpgp.decrypt(_text(fields[0]))]
+        if code == DECRYPT_VERIFY:
+            decryption = decrypt_verify(openpgp, _text(fields[0]))
+            return [decryption.data, _bool(decryption.signed),
+                    _bool(decryption.valid), decryption.key_id]
+        if code == VERIFY:
+            data, signature = fields
+            return [_bool(openpgp.verify(_text(data), _text(signature)))]
+        if code == VERIFY_SIGNER:
+            data, signature = fields
+            # the signed bytes as received, they might not be utf-8
+            return [verify_signer(openpgp, data, _text(signature))]
+        if code == KEY_ADDRESSES:
+            return [_join(key_addresses(openpgp, _text(fields[0])))]
+        if code == PROTECT:
+            data, encrypt, sign = fields
+            protected = protect_to_bytes(_parse(data), bool(encrypt),
+                                         self.config, bool(sign))
+            level = protected.protection_level
+            return [protected.data, _join(level.signed_by),
+                    _join(level.encrypted_by)]
+        if code == UNWRAP:
+            # the raw bytes, to verify the signed parts as received
+            msg = unwrap(fields[0], openpgp, self.workers,
+                         self.config.limits, self.config.recorder)
+            if isinstance(msg, MemoryHoleMessage):
+                level = msg.protection_level
+                outer = msg.outer_headers
+                replacements = msg.replacements
+            else:
+                # not protected, or only some nested parts are
+                level, outer, replacements = ProtectionLevel(), [], {}
+            return [_as_bytes(msg), _join(level.signed_by),
+                    _join(level.encrypted_by), _join(_flatten(outer)),
+                    _join(_flatten(replacements.items()))]
+        if code == SLOW_OPS:
+            if self.config.recorder is None:
+                return ['[]']
+            return [self.config.recorder.dump()]
+        raise FrameError('Unknown operation %s' % (code,))
+
+
+@implementer(IOpenPGP)
+class DaemonClient(object):
+
+    def __init__(self, path, timeout=None):
+        """
+        OpenPGP implementation forwarding every operation to a
+        CryptoDaemon.
+
+        Every thread uses its own connection, opened on its first request
+        and again after a fork, so a client can be shared by the threads of
+        a process and created before forking workers.
+
+        :param path: path of the Unix socket of the daemon
+        :type path: str
+        :param timeout: seconds to wait for each response, None for no limit
+        :type timeout: float
+        """
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def encrypt(self, data, encraddr, signaddr=None, compression=None):
+        if compression is not None:
+            compression = '%s %d' % compression
+        return _text(self._request(ENCRYPT, data, _join(encraddr),
+                                   signaddr, compression)[0])
+
+    def sign(self, data, signaddr=None):
+        return _text(self._request(SIGN, data, signaddr)[0])
+
+    def decrypt(self, data):
+        return self._request(DECRYPT, data)[0]
+
+    def decrypt_verify(self, data):
+        data, signed, valid, key_id = self._request(DECRYPT_VERIFY, data)
+        return Decryption(data, bool(signed), bool(valid), _text(key_id))
+
+    def verify(self, data, signature):
+        return bool(self._request(VERIFY, data, signature)[0])
+
+    def verify_signer(self, data, signature):
+        return _text(self._request(VERIFY_SIGNER, data, signature)[0])
+
+    def key_addresses(self, key_id):
+        return _split(self._request(KEY_ADDRESSES, key_id)[0])
+
+    def protect(self, msg, encrypt=True, sign=False):
+        """
+        Protect an email in the daemon, like memoryhole.protect with the
+        configuration of the daemon.
+
+        :param msg: the email to be protected
+        :type msg: Message
+        :param encrypt: should the message be encrypted
+        :type encrypt: bool
+        :param sign: should the encrypted message be signed too
+        :type sign: bool
+
+        :return: an encrypted and/or signed email
+        :rtype: Message
+        """
+        data, signed_by, encrypted_by = self._request(
+            PROTECT, _as_bytes(msg), _bool(encrypt), _bool(sign))
+        encmsg = _parse(data)
+        encmsg.protection_level = ProtectionLevel(set(_split(signed_by)),
+                                                  set(_split(encrypted_by)))
+        return encmsg
+
+    def unwrap(self, msg):
+        """
+        Unwrap an email in the daemon, like memoryhole.unwrap.
+
+        The protection of nested parts is not kept, only the one of the
+        unwrapped email, empty if it's not protected itself.
+
+        :param msg: the email to be unwrapped
+        :type msg: Message
+
+        :return: a decrypted email
+        :rtype: MemoryHoleMessage
+        """
+        data, signed_by, encrypted_by, outer, replacements = self._request(
+            UNWRAP, _as_bytes(msg))
+        level = ProtectionLevel(set(_split(signed_by)),
+                                set(_split(encrypted_by)))
+        outer = _split(outer)
+        replacements = _split(replacements)
+        return MemoryHoleMessage(
+            _parse(data), level, list(zip(outer[::2], outer[1::2])),
+            dict(zip(replacements[::2], replacements[1::2])))
+
+    def slow_ops(self):
+        """
+        Get the slow operations recorded by the recorder of the daemon.
+
+        :return: the records as dicts, see SlowOpRecorder.dump
+        :rtype: [dict]
+        """
+        return json.loads(_text(self._request(SLOW_OPS)[0]))
+
+    def close(self):
+        """
+        Close the connection of the current thread.
+        """
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            self._local.rfile.close()
+            sock.close()
+            self._local.sock = None
+
+    def _request(self, code, *fields):
+        fields = [field.read() if hasattr(field, 'read') else field
+                  for field in fields]
+        sock, rfile = self._connection()
+        try:
+            _send(sock, code, fields)
+            response = _recv(rfile)
+            if response is None:
+                raise DaemonError('The daemon closed the connection')
+            status, response = response
+        except Exception:
+            # the connection is in an unknown state
+            self.close()
+            raise
+        if status == ERROR:
+            name, message = [_text(field) for field in response]
+            raise _ERRORS.get(name, DaemonError)(message)
+        return response
+
+    def _connection(self):
+        local = self._local
+        if (getattr(local, 'sock', None) is None or
+                local.pid != os.getpid()):
+            local.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            local.sock.settimeout(self.timeout)
+            local.sock.connect(self.path)
+            local.rfile = local.sock.makefile('rb')
+            local.pid = os.getpid()
+        return local.sock, local.rfile
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        daemon = self.server.crypto_daemon
+        while True:
+            try:
+                request = _recv(self.rfile)
+            except FrameError as e:
+                _send(self.request, ERROR, [type(e).__name__, str(e)])
+                return
+            if request is None:
+                return
+
+            code, fields = request
+            try:
+                response = daemon.handle(code, fields)
+                status = OK
+            except Exception as e:
+                response = [type(e).__name__, str(e)]
+                status = ERROR
+            _send(self.request, status, response)
+
+
+def _send(sock, code, fields):
+    chunks = []
+    for field in fields:
+        if field is None:
+            chunks.append(_LENGTH.pack(_NONE))
+            continue
+        field = _bytes(field)
+        chunks.append(_LENGTH.pack(len(field)))
+        chunks.append(field)
+    body = b''.join(chunks)
+    sock.sendall(_HEADER.pack(len(body), code, len(fields)) + body)
+
+
+def _recv(rfile):
+    """
+    Read a frame.
+
+    :return: the code and fields of the frame, None if the connection was
+             closed before it
+    :rtype: (int, [bytes])
+    """
+    header = rfile.read(_HEADER.size)
+    if not header:
+        return None
+    if len(header) < _HEADER.size:
+        raise FrameError('Truncated frame')
+    length, code, count = _HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise FrameError('Frame of %s bytes is too big' % (length,))
+    body = rfile.read(length)
+    if len(body) < length:
+        raise FrameError('Truncated frame')
+
+    fields = []
+    offset = 0
+    for _ in range(count):
+        if offset + _LENGTH.size > length:
+            raise FrameError('Malformed frame')
+        size, = _LENGTH.unpack_from(body, offset)
+        offset += _LENGTH.size
+        if size == _NONE:
+            fields.append(None)
+            continue
+        if offset + size > length:
+            raise FrameError('Malformed frame')
+        fields.append(body[offset:offset + size])
+        offset += size
+    return code, fields
+
+
+def _bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def _text(value):
+    if value is None or not isinstance(value, bytes):
+        return value
+    return value.decode('utf-8')
+
+
+def _bool(value):
+    return b'\x01' if value else b''
+
+
+def _join(values):
+    return b'\0'.join(_bytes(value) for value in values)
+
+
+def _split(field):
+    if not field:
+        return []
+    return [value.decode('utf-8') for value in field.split(b'\0')]
+
+
+def _flatten(pairs):
+    return [str(item) for pair in pairs for item in pair]
+
+
+def _parse(data):
+    return BytesParser().parsebytes(_bytes(data))
+
+
+def _as_bytes(msg):
+    try:
+        return msg.as_bytes()
+    except UnicodeEncodeError:
+        # parsed from text with non ascii characters in it
+        return _bytes(msg.as_string())
+
+
+def _gnupg_pool(homedir, size):
+    from memoryhole.cache import SessionKeyCache, SignerCache
+    from memoryhole.gpg import Gnupg
+    session_keys = SessionKeyCache()
+    signers = SignerCache()
+    factory = partial(Gnupg, homedir, session_keys=session_keys,
+                      signers=signers)
+    return OpenPGPPool(factory, size=size)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve memoryhole crypto operations on a Unix socket.')
+    parser.add_argument('socket', help='path of the Unix socket')
+    parser.add_argument('--homedir', help='gpg homedir with the keys')
+    parser.add_argument('--pool-size', type=int, default=4,
+                        help='gpg operations running at the same time')
+    parser.add_argument('--slow', type=float, default=None,
+                        help='record operations slower than these seconds')
+    args = parser.parse_args(argv)
+
+    from memoryhole.cache import ProtectCache
+    from memoryhole.slowops import SlowOpRecorder
+
+    recorder = None
+    if args.slow is not None:
+        recorder = SlowOpRecorder(threshold=args.slow)
+    config = ProtectConfig(openpgp=_gnupg_pool(args.homedir, args.pool_size),
+                           cache=ProtectCache(), recorder=recorder)
+    daemon = CryptoDaemon(args.socket, config)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
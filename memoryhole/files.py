@@ -0,0 +1,45 @@
+"""
+Durable writes of the files of the spool and the re-encryption tool.
+"""
+import os
+
+
+def write_atomic(directory, name, data, tmpdir=None):
+    """
+    Write data into the file name of directory, so it's either complete or
+    not there at all, even if the system crashes.
+
+    The data is written into a temporary file in tmpdir, by default
+    directory itself, and renamed into place once it's on disk, then the
+    rename is made durable too. tmpdir must be in the same filesystem as
+    directory.
+
+    :param directory: the directory to write into
+    :type directory: str
+    :param name: the name of the file
+    :type name: str
+    :param data: the content of the file
+    :type data: bytes
+    :param tmpdir: the directory for the temporary file
+    :type tmpdir: str
+    """
+    if tmpdir is None:
+        tmpdir = directory
+    tmppath = os.path.join(tmpdir, '.%s.tmp' % (name,))
+    with open(tmppath, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmppath, os.path.join(directory, name))
+    fsync_dir(directory)
+
+
+def fsync_dir(directory):
+    """
+    Make the renames into directory durable.
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
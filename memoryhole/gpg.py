@@ -1,31 +1,530 @@
+import binascii
+import functools
+import math
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+from io import BytesIO
+from email.utils import parseaddr
+
 from zope.interface import implementer
 
-from memoryhole.openpgp import IOpenPGP
+from memoryhole.openpgp import IOpenPGP, BackendError, Decryption
+
+
+class GnupgTimeout(BackendError):
+    """
+    Raised when a gpg operation doesn't finish on time.
+    """
 
 
 @implementer(IOpenPGP)
 class Gnupg(object):
-    def __init__(self):
+    def __init__(self, homedir=None, timeout=None, session_keys=None,
+                 signers=None):
+        """
+        OpenPGP implementation using gnupg.
+
+        If timeout is given every operation taking more than timeout seconds
+        will be aborted: its gpg processes are killed and reaped, and
+        GnupgTimeout is raised.
+
+        If a session_keys cache is given the session key of every decrypted
+        message is kept in it, and decrypting the same message again skips
+        the public key decryption, using the cached key. gnupg doesn't let
+        through the session key options, so these decryptions run gpg
+        directly, passing the keys through a pipe and not the command line.
+
+        If a signers cache is given the signing key of each address is looked
+        up once, asking gpg only for the keys of that address, and kept in
+        the cache with its passphrase preset into gpg-agent if the cache
+        knows it.
+
+        :param homedir: the gpg homedir, None for the default one
+        :type homedir: str
+        :param timeout: maximum seconds for each operation
+        :type timeout: float
+        :param session_keys: cache of session keys
+        :type session_keys: SessionKeyCache
+        :param signers: cache of signing identities
+        :type signers: SignerCache
+        """
         from gnupg import GPG
-        self.gpg = GPG()
+        self.homedir = homedir
+        self.timeout = timeout
+        self.session_keys = session_keys
+        self.signers = signers
+        self.gpg = GPG(homedir=homedir)
+
+        self._local = threading.local()
+        self._preset_ttl = True
+        self._track_processes()
+
+    def encrypt(self, data, encraddr, signaddr=None, compression=None):
+        return self._call(self._encrypt, data, encraddr, signaddr,
+                          compression)
 
-    def encrypt(self, data, encraddr):
-        result = self.gpg.encrypt(data, *encraddr)
+    def sign(self, data, signaddr=None):
+        return self._call(self._sign, data, signaddr)
+
+    def decrypt(self, data):
+        return self._call(self._decrypt, data).data
+
+    def decrypt_verify(self, data):
+        return self._call(self._decrypt, data)
+
+    def verify(self, data, signature):
+        return bool(self._call(self._verify, data, signature).valid)
+
+    def verify_signer(self, data, signature):
+        result = self._call(self._verify, data, signature)
+        if not result.valid:
+            return None
+        return _primary_fingerprint(result)
+
+    def _encrypt(self, data, encraddr, signaddr, compression):
+        kwargs = {}
+        if signaddr is not None:
+            kwargs['default_key'] = self._signing_key(signaddr)
+        if compression is not None:
+            # gnupg doesn't let through --compress-level, gpg uses its
+            # default level for the algorithm
+            kwargs['compress_algo'] = compression.algorithm
+        result = self.gpg.encrypt(data, *encraddr, **kwargs)
         self._check_gpg_error(result)
         return result.data
 
-    def sign(self, data):
-        result = self.gpg.sign(data)
+    def _sign(self, data, signaddr):
+        kwargs = {}
+        if signaddr is not None:
+            kwargs['default_key'] = self._signing_key(signaddr)
+        result = self.gpg.sign(data, **kwargs)
         self._check_gpg_error(result)
         return result.data
 
-    def decrypt(self, data):
-        pass
+    def _decrypt(self, data):
+        """
+        Decrypt data, gpg verifies the signature inside it if there is one.
 
-    def verify(self, data, signature):
-        pass
+        :rtype: Decryption
+        """
+        if self.session_keys is not None:
+            if hasattr(data, 'read'):
+                data = data.read()
+            plaintext, status = self._decrypt_session_key(_to_bytes(data))
+            return Decryption(plaintext, *_signature_status(status))
+        if hasattr(data, 'read'):
+            result = self.gpg.decrypt_file(data)
+        else:
+            result = self.gpg.decrypt(data)
+        self._check_gpg_error(result)
+        signed, valid, key_id = _signature_status(
+            _to_bytes(getattr(result, 'stderr', '')))
+        if valid:
+            key_id = _primary_fingerprint(result) or key_id
+        return Decryption(result.data, signed, valid, key_id)
+
+    def _decrypt_session_key(self, ciphertext):
+        """
+        :return: the plaintext and the status lines of gpg
+        :rtype: (bytes, bytes)
+        """
+        key = self.session_keys.get(self.homedir, ciphertext)
+        if key is not None:
+            try:
+                return self._run_gpg(['--decrypt'], ciphertext, key,
+                                     okay=_decryption_okay)
+            except RuntimeError:
+                # decrypt it again from scratch
+                self.session_keys.discard(self.homedir, ciphertext)
+            finally:
+                key[:] = b'\0' * len(key)
+
+        plaintext, status = self._run_gpg(
+            ['--show-session-key', '--decrypt'], ciphertext,
+            okay=_decryption_okay)
+        match = _session_key_status.search(status)
+        if match is not None:
+            self.session_keys.put(self.homedir, ciphertext, match.group(1))
+        return plaintext, status
+
+    def _run_gpg(self, args, data, session_key=None, okay=None):
+        """
+        Run gpg with args, for the options gnupg doesn't allow.
+
+        The operation failed if gpg exits with an error, or if okay is given
+        and gpg doesn't print the status line it matches. The exit code
+        doesn't tell if a decryption failed: gpg exits with an error after
+        decrypting when it can't check the signature.
+
+        :return: the output and the status lines of gpg
+        :rtype: (bytes, bytes)
+        """
+        binary = (getattr(self.gpg, 'binary', None) or
+                  getattr(self.gpg, 'gpgbinary', 'gpg'))
+        cmd = [binary, '--batch', '--no-tty', '--status-fd', '2']
+        if self.homedir is not None:
+            cmd += ['--homedir', self.homedir]
+
+        popen_args = {}
+        keyfd = None
+        if session_key is not None:
+            keyfd, keywrite = os.pipe()
+            cmd += ['--override-session-key-fd', str(keyfd)]
+            if sys.version_info[0] >= 3:
+                popen_args['pass_fds'] = (keyfd,)
+            else:
+                popen_args['close_fds'] = False
+
+        try:
+            proc = subprocess.Popen(
+                cmd + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, **popen_args)
+            if keyfd is not None:
+                # the key is shorter than the pipe buffer, and written
+                # without copies so the caller can overwrite it
+                os.write(keywrite, session_key)
+                os.write(keywrite, b'\n')
+        finally:
+            if keyfd is not None:
+                os.close(keyfd)
+                os.close(keywrite)
+
+        operation = getattr(self._local, 'operation', None)
+        if operation is not None:
+            operation.add(proc)
+        out, err = proc.communicate(data)
+        if proc.returncode < 0:
+            raise BackendError('gpg was killed by signal %s' % (
+                -proc.returncode,))
+        if okay is not None:
+            failed = okay.search(err) is None
+        else:
+            failed = proc.returncode != 0
+        if failed:
+            raise RuntimeError('Failed gnupg operation: %s' % (
+                _session_key_line.sub(b'', err).decode('utf-8', 'replace'),))
+        return out, err
+
+    def _verify(self, data, signature):
+        # gnupg reads detached signatures only from files
+        fd, sigpath = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as sigfile:
+                sigfile.write(_to_bytes(signature))
+            if hasattr(data, 'read'):
+                result = self.gpg.verify_file(data, sig_file=sigpath)
+            else:
+                stream = BytesIO(_to_bytes(data))
+                result = self.gpg.verify_file(stream, sig_file=sigpath)
+                stream.close()
+        finally:
+            os.remove(sigpath)
+        return result
+
+    def fingerprints(self, addresses):
+        """
+        Find the fingerprints of the public keys for addresses.
+
+        :param addresses: list of email addresses
+        :type addresses: [str]
+
+        :return: the fingerprints of the keys with an uid for the addresses
+        :rtype: [str]
+        """
+        addresses = set(a.lower() for a in addresses)
+        return [key['fingerprint'] for key in self.gpg.list_keys()
+                if addresses & _key_addresses(key)]
+
+    def key_addresses(self, key_id):
+        """
+        Find the addresses of the uids of the public key with key_id.
+
+        :param key_id: fingerprint or key id of the key or one of its
+                       subkeys
+        :type key_id: str
+
+        :return: the addresses of the key, empty if there is no such key
+        :rtype: [str]
+        """
+        for key in self.gpg.list_keys():
+            ids = [key['fingerprint']] + [
+                subkey[0] for subkey in key.get('subkeys', [])]
+            if any(_same_key(key_id, i) for i in ids if i):
+                return sorted(_key_addresses(key))
+        return []
+
+    def _signing_key(self, signaddr):
+        """
+        Find the fingerprint of the secret key to sign as signaddr.
+
+        gnupg only accepts key ids for signing. Signing with another key of
+        the keyring would sign as another user, so RuntimeError is raised if
+        there is no secret key with an uid for signaddr.
+        """
+        if self.signers is not None:
+            fingerprint = self.signers.get(self.homedir, signaddr)
+            if fingerprint is None:
+                fingerprint = self._resolve_signer(signaddr)
+        else:
+            fingerprint = None
+            for key in self.gpg.list_keys(secret=True):
+                if signaddr.lower() in _key_addresses(key):
+                    fingerprint = key['fingerprint']
+                    break
+        if fingerprint is None:
+            raise RuntimeError('No secret key to sign as %s' % (signaddr,))
+        return fingerprint
+
+    def _resolve_signer(self, signaddr):
+        """
+        Look up the secret key of signaddr and store it in the signers cache,
+        presetting its passphrase.
+
+        :return: the fingerprint of the key, None if there is no secret key
+                 for signaddr
+        :rtype: str
+        """
+        try:
+            out, _ = self._run_gpg(
+                ['--with-colons', '--with-keygrip', '--list-secret-keys',
+                 '<%s>' % (signaddr,)], None)
+        except RuntimeError:
+            return None
+        fingerprint, keygrips = _secret_key(out.decode('utf-8', 'replace'))
+        if fingerprint is None:
+            return None
+
+        passphrase = None
+        if self.signers.passphrase is not None:
+            passphrase = self.signers.passphrase(signaddr)
+        release = None
+        if passphrase is not None:
+            self._preset_passphrase(keygrips, passphrase)
+            release = functools.partial(self._agent_command, ''.join(
+                'CLEAR_PASSPHRASE --mode=normal %s\n' % (keygrip,)
+                for keygrip in keygrips))
+        self.signers.put(self.homedir, signaddr, fingerprint, keygrips,
+                         release)
+        return fingerprint
+
+    def _preset_passphrase(self, keygrips, passphrase):
+        """
+        Preset the passphrase of the keygrips into gpg-agent, expiring after
+        the idle time of the signers cache, so the agent forgets it on its
+        own if the identity is never evicted, like when the process dies.
+
+        gpg-agent 2.2 only takes presets that never expire and answers Not
+        implemented to any other timeout, those agents get presets without
+        timeout, bounded by their max-cache-ttl.
+        """
+        ttl = int(math.ceil(self.signers.idle))
+        if self._preset_ttl:
+            try:
+                self._agent_command(_preset_commands(keygrips, ttl,
+                                                     passphrase))
+                return
+            except RuntimeError as e:
+                if 'Not implemented' not in str(e):
+                    raise
+                self._preset_ttl = False
+        self._agent_command(_preset_commands(keygrips, -1, passphrase))
+
+    def _agent_command(self, commands):
+        """
+        Send commands to gpg-agent, through stdin so passphrases are not in
+        the command line.
+        """
+        cmd = ['gpg-connect-agent']
+        if self.homedir is not None:
+            cmd += ['--homedir', self.homedir]
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, _ = proc.communicate((commands + '/bye\n').encode('utf-8'))
+        errors = _agent_error.findall(out)
+        if proc.returncode != 0 or errors:
+            raise RuntimeError('Failed gpg-agent command: %s' % (
+                b'; '.join(errors).decode('utf-8', 'replace'),))
+
+    def _call(self, method, *args):
+        """
+        Run method aborting it if it takes more than self.timeout.
+        """
+        if self.timeout is None:
+            return method(*args)
+
+        operation = _Operation()
+
+        def run():
+            self._local.operation = operation
+            try:
+                operation.result = method(*args)
+            except Exception as e:
+                operation.error = e
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(self.timeout)
+        if thread.is_alive():
+            operation.kill()
+            # let the operation clean up its temporary files
+            thread.join(self.timeout)
+            raise GnupgTimeout('gpg operation took more than %s seconds'
+                               % (self.timeout,))
+        if operation.error is not None:
+            raise operation.error
+        return operation.result
+
+    def _track_processes(self):
+        """
+        Register the gpg processes in the operation running them, so they can
+        be killed on timeouts.
+        """
+        open_subprocess = self.gpg._open_subprocess
+
+        def _open_subprocess(*args, **kwargs):
+            proc = open_subprocess(*args, **kwargs)
+            operation = getattr(self._local, 'operation', None)
+            if operation is not None:
+                operation.add(proc)
+            return proc
+        self.gpg._open_subprocess = _open_subprocess
 
     def _check_gpg_error(self, result):
         stderr = getattr(result, 'stderr', '')
+        returncode = getattr(result, 'returncode', None)
+        if returncode is not None and returncode < 0:
+            raise BackendError('gpg was killed by signal %s' % (-returncode,))
         if getattr(result, 'ok', False) is not True:
             raise RuntimeError('Failed gnupg operation: %s' % stderr)
+
+
+_decryption_okay = re.compile(br'^\[GNUPG:\] DECRYPTION_OKAY', re.M)
+_session_key_status = re.compile(br'^\[GNUPG:\] SESSION_KEY (\S+)$', re.M)
+# lines with the session key, never shown in errors
+_session_key_line = re.compile(br'^.*session.key.*$', re.M | re.I)
+
+
+_agent_error = re.compile(br'^ERR .*$', re.M)
+_signature_line = re.compile(
+    br'^\[GNUPG:\] (GOODSIG|BADSIG|ERRSIG|EXPSIG|EXPKEYSIG|REVKEYSIG) (\S+)',
+    re.M)
+_validsig = re.compile(br'^\[GNUPG:\] VALIDSIG (.*)$', re.M)
+
+
+def _signature_status(status):
+    """
+    Parse the signature status lines of a gpg decryption.
+
+    :return: if the data was signed, if the signature is valid and the key
+             id of the signer, the fingerprint of its primary key if the
+             signature is valid
+    :rtype: (bool, bool, str)
+    """
+    match = _signature_line.search(status)
+    if match is None:
+        return False, False, None
+    key_id = match.group(2).decode('ascii')
+    validsig = _validsig.search(status)
+    valid = match.group(1) == b'GOODSIG' and validsig is not None
+    if valid:
+        fields = validsig.group(1).split()
+        # the primary key fingerprint is the last of the ten fields
+        if len(fields) >= 10:
+            key_id = fields[9].decode('ascii')
+        else:
+            key_id = fields[0].decode('ascii')
+    return True, valid, key_id
+
+
+def _primary_fingerprint(result):
+    """
+    The fingerprint of the primary key of a valid signature, the one with
+    the uids, even if it was made with a subkey.
+    """
+    return (getattr(result, 'pubkey_fingerprint', None) or
+            getattr(result, 'fingerprint', None))
+
+
+def _same_key(key_id, other):
+    """
+    Are the two fingerprints or long key ids of the same key. Short key ids
+    are too easy to collide to be trusted.
+    """
+    key_id, other = key_id.upper(), other.upper()
+    if len(key_id) < len(other):
+        key_id, other = other, key_id
+    return len(other) >= 16 and key_id.endswith(other)
+
+
+def _secret_key(colons):
+    """
+    Parse the first secret key of gpg --with-colons --with-keygrip output.
+
+    :return: the fingerprint of the key and the keygrips of the key and its
+             subkeys
+    :rtype: (str, [str])
+    """
+    fingerprint = None
+    keygrips = []
+    for line in colons.splitlines():
+        fields = line.split(':')
+        if fields[0] == 'sec' and fingerprint is not None:
+            break
+        if fields[0] == 'fpr' and fingerprint is None:
+            fingerprint = fields[9]
+        elif fields[0] == 'grp':
+            keygrips.append(fields[9])
+    return fingerprint, keygrips
+
+
+def _preset_commands(keygrips, ttl, passphrase):
+    return ''.join('PRESET_PASSPHRASE %s %d %s\n' % (
+        keygrip, ttl, _hex(passphrase)) for keygrip in keygrips)
+
+
+def _hex(passphrase):
+    return binascii.hexlify(_to_bytes(passphrase)).decode('ascii').upper()
+
+
+def _key_addresses(key):
+    return set(parseaddr(uid)[1].lower() for uid in key.get('uids', []))
+
+
+def _to_bytes(s):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return s
+
+
+class _Operation(object):
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self._procs = []
+        self._killed = False
+        self._lock = threading.Lock()
+
+    def add(self, proc):
+        with self._lock:
+            self._procs.append(proc)
+            if self._killed:
+                _reap(proc)
+
+    def kill(self):
+        with self._lock:
+            self._killed = True
+            for proc in self._procs:
+                _reap(proc)
+
+
+def _reap(proc):
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
@@ -0,0 +1,182 @@
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from zope.interface import implementer
+
+from memoryhole.openpgp import (
+    IOpenPGP, decrypt_verify, encrypt_args, key_addresses, sign_as,
+    verify_signer
+)
+
+
+@implementer(IOpenPGP)
+class GpgvVerifier(object):
+
+    def __init__(self, fallback, homedir=None, snapshot=None, refresh=3600,
+                 gpg='gpg', gpgv='gpgv'):
+        """
+        OpenPGP implementation that verifies signatures with gpgv.
+
+        gpgv only checks signatures against a keyring file, with no agent,
+        trust database nor configuration, so it's much cheaper than a full
+        gpg verification. The keyring is a snapshot of the public keys of
+        homedir, exported again every refresh seconds. All the keys in the
+        snapshot are trusted, as they are by Gnupg.verify.
+
+        Signatures made by keys not in the snapshot, like keys imported
+        after the last refresh, are verified by fallback. So are the other
+        operations.
+
+        :param fallback: the full implementation
+        :type fallback: IOpenPGP
+        :param homedir: the gpg homedir to export the keys from, by default
+                        the homedir of fallback
+        :type homedir: str
+        :param snapshot: path of the keyring snapshot, by default a file in
+                         a temporary directory
+        :type snapshot: str
+        :param refresh: seconds between exports of the keys
+        :type refresh: float
+        :param gpg: the gpg binary used to export the keys
+        :type gpg: str
+        :param gpgv: the gpgv binary
+        :type gpgv: str
+        """
+        self.fallback = fallback
+        if homedir is None:
+            homedir = getattr(fallback, 'homedir', None)
+        self.homedir = homedir
+        self._tmpdir = None
+        if snapshot is None:
+            self._tmpdir = tempfile.mkdtemp()
+            snapshot = os.path.join(self._tmpdir, 'trusted.gpg')
+        self.snapshot = snapshot
+        self.refresh = refresh
+        self.gpg = gpg
+        self.gpgv = gpgv
+        self.fallbacks = 0
+        self._refreshed = None
+        self._lock = threading.Lock()
+
+    def encrypt(self, data, encraddr, signaddr=None, compression=None):
+        args, kwargs = encrypt_args(data, encraddr, signaddr, compression)
+        return self.fallback.encrypt(*args, **kwargs)
+
+    def sign(self, data, signaddr=None):
+        return sign_as(self.fallback, data, signaddr)
+
+    def decrypt(self, data):
+        return self.fallback.decrypt(data)
+
+    def decrypt_verify(self, data):
+        return decrypt_verify(self.fallback, data)
+
+    def verify(self, data, signature):
+        status = self._gpgv(data, signature)
+        if status is None:
+            return self.fallback.verify(data, signature)
+        return status is not False
+
+    def verify_signer(self, data, signature):
+        status = self._gpgv(data, signature)
+        if status is None:
+            return verify_signer(self.fallback, data, signature)
+        if status is False:
+            return None
+        return status.group(1).decode('ascii')
+
+    def key_addresses(self, key_id):
+        return key_addresses(self.fallback, key_id)
+
+    def _gpgv(self, data, signature):
+        """
+        Verify the signature with gpgv.
+
+        :return: the VALIDSIG status match if valid, False if not, None if
+                 the key is not in the snapshot
+        """
+        self._refresh_snapshot()
+
+        # gpgv reads detached signatures only from files
+        fd, sigpath = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as sigfile:
+                sigfile.write(_to_bytes(signature))
+            proc = subprocess.Popen(
+                [self.gpgv, '--status-fd', '1', '--keyring', self.snapshot,
+                 sigpath, '-'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            if hasattr(data, 'read'):
+                position = data.tell()
+                shutil.copyfileobj(data, proc.stdin)
+                status, _ = proc.communicate()
+                data.seek(position)
+            else:
+                status, _ = proc.communicate(_to_bytes(data))
+        finally:
+            os.remove(sigpath)
+
+        if _no_pubkey.search(status):
+            with self._lock:
+                self.fallbacks += 1
+            return None
+        validsig = _validsig.search(status)
+        if proc.returncode != 0 or validsig is None:
+            return False
+        return validsig
+
+    def refresh_snapshot(self):
+        """
+        Export the public keys of homedir into the snapshot now.
+        """
+        with self._lock:
+            self._export()
+
+    def _refresh_snapshot(self):
+        with self._lock:
+            if (self._refreshed is None or
+                    time.time() - self._refreshed > self.refresh):
+                self._export()
+
+    def _export(self):
+        cmd = [self.gpg, '--batch', '--no-tty', '--export']
+        if self.homedir is not None:
+            cmd[1:1] = ['--homedir', self.homedir]
+
+        tmppath = self.snapshot + '.tmp'
+        with open(tmppath, 'wb') as tmp:
+            proc = subprocess.Popen(cmd, stdout=tmp, stderr=subprocess.PIPE)
+            _, err = proc.communicate()
+            if proc.returncode != 0:
+                os.remove(tmppath)
+                raise RuntimeError('Failed to export the keys: %s' % (err,))
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        # running verifications keep reading the old snapshot
+        os.rename(tmppath, self.snapshot)
+        self._refreshed = time.time()
+
+    def close(self):
+        """
+        Remove the snapshot if it's in a temporary directory.
+        """
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+
+# the last field is the fingerprint of the primary key
+_validsig = re.compile(br'^\[GNUPG:\] VALIDSIG .* (\S+)$', re.M)
+_no_pubkey = re.compile(br'^\[GNUPG:\] NO_PUBKEY ', re.M)
+
+
+def _to_bytes(s):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return s
@@ -0,0 +1,271 @@
+"""
+Compact representation of emails to send them to worker processes.
+
+Pickling an email.message.Message means pickling a deep graph of small
+objects, for big emails it costs more than the crypto done with them. A
+CompactEmail keeps the headers of every part in a list and all the leaf
+payloads in one flat buffer, and the buffer can be moved to shared memory so
+only its name is pickled.
+"""
+from collections import namedtuple
+from email.message import Message
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
+from memoryhole.message import MemoryHoleMessage, ProtectionLevel
+
+
+# buffers smaller than this are pickled, sharing them costs more
+SHARE_THRESHOLD = 64 * 1024
+
+_STR = 's'
+_BYTES = 'b'
+
+_Part = namedtuple("_Part", (
+    "parent", "headers", "start", "end", "kind", "preamble", "epilogue",
+    "unixfrom", "level", "unwrapped"))
+
+
+class CompactEmail(object):
+
+    def __init__(self, parts, buffer):
+        """
+        An email as a list of parts and a flat buffer with their payloads.
+
+        Use CompactEmail.from_message and to_message to convert emails.
+
+        :param parts: the parts of the email in depth first order, each one
+                      with the index of its parent, its headers and the
+                      offsets of its payload in buffer
+        :type parts: [_Part]
+        :param buffer: the payloads of the leaf parts
+        :type buffer: bytes
+        """
+        self.parts = parts
+        self._buffer = buffer
+        self._shm = None
+        self._shm_name = None
+        self._owner = False
+
+    @classmethod
+    def from_message(cls, msg):
+        """
+        Build the compact representation of msg.
+
+        The protection_level of protected emails and the protection of
+        unwrapped ones (MemoryHoleMessage) are kept.
+
+        :param msg: the email
+        :type msg: Message
+
+        :rtype: CompactEmail
+        """
+        parts = []
+        chunks = []
+        offset = 0
+        pending = [(None, msg)]
+        while pending:
+            parent, part = pending.pop()
+            index = len(parts)
+            start = end = kind = None
+            payload = part.get_payload()
+            if part.is_multipart():
+                for subpart in reversed(payload):
+                    pending.append((index, subpart))
+            elif payload is not None:
+                kind = _STR
+                if isinstance(payload, bytes):
+                    kind = _BYTES
+                else:
+                    payload = _encode(payload)
+                chunks.append(payload)
+                start = offset
+                offset += len(payload)
+                end = offset
+
+            level = getattr(part, 'protection_level', None)
+            if level is not None:
+                level = (set(level.signed_by), set(level.encrypted_by))
+            unwrapped = None
+            if isinstance(part, MemoryHoleMessage):
+                unwrapped = (list(part.outer_headers),
+                             dict(part._replacements))
+            parts.append(_Part(
+                parent, list(part._headers), start, end, kind,
+                part.preamble, part.epilogue, part.get_unixfrom(), level,
+                unwrapped))
+        return cls(parts, b''.join(chunks))
+
+    def to_message(self):
+        """
+        Build the email back.
+
+        :rtype: Message
+        """
+        view = self._view()
+        try:
+            messages = []
+            for part in self.parts:
+                msg = Message()
+                msg._headers = list(part.headers)
+                msg.preamble = part.preamble
+                msg.epilogue = part.epilogue
+                msg.set_unixfrom(part.unixfrom)
+                if part.start is not None:
+                    payload = view[part.start:part.end].tobytes()
+                    if part.kind == _STR:
+                        payload = _decode(payload)
+                    msg.set_payload(payload)
+                messages.append(msg)
+                if part.parent is not None:
+                    messages[part.parent].attach(msg)
+        finally:
+            view.release()
+
+        # protected messages wrap their parts, so they are built after them
+        for index in reversed(range(len(self.parts))):
+            part = self.parts[index]
+            msg = messages[index]
+            level = None
+            if part.level is not None:
+                level = ProtectionLevel(*part.level)
+            if part.unwrapped is not None:
+                outer_headers, replacements = part.unwrapped
+                msg = MemoryHoleMessage(msg, level, outer_headers,
+                                        replacements)
+                if part.parent is not None:
+                    siblings = messages[part.parent].get_payload()
+                    siblings[siblings.index(messages[index])] = msg
+                messages[index] = msg
+            elif level is not None:
+                msg.protection_level = level
+        return messages[0]
+
+    def share(self, threshold=SHARE_THRESHOLD):
+        """
+        Move the buffer to shared memory if it's bigger than threshold, then
+        pickling the email only copies the name of the shared memory.
+
+        The process sharing it must call release once the email has been
+        built in the other processes, which must be started by it (like the
+        workers of a multiprocessing pool). Without
+        multiprocessing.shared_memory (python < 3.8) the buffer is not moved.
+
+        :return: the email itself
+        :rtype: CompactEmail
+        """
+        if (shared_memory is None or self._shm is not None or
+                len(self._buffer) <= threshold):
+            return self
+        shm = shared_memory.SharedMemory(create=True, size=len(self._buffer))
+        shm.buf[:len(self._buffer)] = self._buffer
+        self._shm = shm
+        self._shm_name = shm.name
+        self._owner = True
+        self._size = len(self._buffer)
+        self._buffer = None
+        return self
+
+    def release(self):
+        """
+        Free the shared memory of the buffer.
+        """
+        if self._shm is None:
+            return
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+    def __len__(self):
+        if self._buffer is None:
+            return self._size
+        return len(self._buffer)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shm'] = None
+        state['_owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def _view(self):
+        if self._buffer is not None:
+            return memoryview(self._buffer)
+        if self._shm is None:
+            self._shm = _attach(self._shm_name)
+        return self._shm.buf[:self._size]
+
+
+def _attach(name):
+    """
+    Attach to shared memory created by another process, without letting
+    the resource tracker unlink it.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 always registers it in the resource tracker, the
+        # worker processes of a pool share the tracker of the process that
+        # created it, and it's unregistered when that one unlinks it
+        return shared_memory.SharedMemory(name=name)
+
+
+def _encode(s):
+    try:
+        return s.encode('utf-8', 'surrogateescape')
+    except LookupError:
+        # python 2 has no surrogateescape, and its str are bytes already
+        return s.encode('utf-8')
+
+
+def _decode(b):
+    try:
+        return b.decode('utf-8', 'surrogateescape')
+    except LookupError:
+        return b
+
+
+def protect_compact(compact, encrypt=True, config=None, sign=False):
+    """
+    Protect an email in compact form, to run protect in worker processes:
+
+        compact = CompactEmail.from_message(msg).share()
+        protected = pool.apply(protect_compact, (compact,)).to_message()
+        compact.release()
+
+    The configuration must be picklable, or config left None and built by
+    the worker.
+
+    :param compact: the email to be protected
+    :type compact: CompactEmail
+
+    :return: the protected email
+    :rtype: CompactEmail
+    """
+    from memoryhole.protection import protect
+    msg = compact.to_message()
+    compact.release()
+    return CompactEmail.from_message(protect(msg, encrypt, config, sign))
+
+
+def unwrap_compact(compact, openpgp=None, workers=4):
+    """
+    Unwrap an email in compact form, to run unwrap in worker processes.
+
+    :param compact: the email to be unwrapped
+    :type compact: CompactEmail
+
+    :return: the unwrapped email
+    :rtype: CompactEmail
+    """
+    from memoryhole import unwrap
+    msg = compact.to_message()
+    compact.release()
+    return CompactEmail.from_message(unwrap(msg, openpgp, workers))
@@ -1,3 +1,4 @@
+from collections import namedtuple
 from email.message import Message
 from email.header import Header
 
@@ -71,19 +72,20 @@ class ProtectionLevel(object):
 class MemoryHoleHeader(Header):
 
     def __init__(self, name, value):
+        if isinstance(value, Header):
+            # 8bit values of emails parsed from bytes
+            self._h = value
+        else:
+            self._h = Header(value, header_name=name)
+        # the attributes of Header differ between python versions
+        self.__dict__.update(self._h.__dict__)
+
         self._name = name
         self._value = value
 
-        self._h = Header(value, header_name=name)
-
         self.signed_by = set([])
         self.encrypted_by = set([])
 
-        self._firstlinelen = self._h._firstlinelen
-        self._chunks = self._h._chunks
-        self._continuation_ws = self._h._continuation_ws
-        self._charset = self._h._charset
-
     @property
     def protection_level(self):
         return ProtectionLevel(self.signed_by, self.encrypted_by)
@@ -93,32 +95,159 @@ class MemoryHoleHeader(Header):
             self.protection_level.score, self._name, self._value)
 
 
+# headers describing the MIME structure, they differ between the wrapping
+# email and the unwrapped one
+MIME_HEADERS = frozenset([
+    'content-description',
+    'content-disposition',
+    'content-id',
+    'content-transfer-encoding',
+    'content-type',
+    'mime-version',
+])
+
+HeaderEntry = namedtuple("HeaderEntry", (
+    "name", "value", "protected", "outer", "tampered", "protection_level"))
+
+
 class MemoryHoleMessage(Message):
 
-    def __init__(self, msg, gpg):
+    def __init__(self, msg, protection_level=None, outer_headers=None,
+                 replacements=None):
+        """
+        An unwrapped email with its memory hole protected headers.
+
+        The protected and outer headers are compared once here and kept in
+        header_index, a dict from lower case header name to HeaderEntry
+        with the value of the header (the protected one if there is one,
+        else the one in the wrapping email), the protected and outer values,
+        whether the outer value was tampered and the ProtectionLevel of the
+        header. For repeated headers only the first one is indexed. Lookups
+        like msg['subject'] or msg.get('subject') go through the index, it's
+        built again if the headers of the email are modified.
+
+        A header is tampered if the outer value is not the same as the
+        protected one, unless it's a MIME header or the outer value is its
+        replacement in replacements. Encrypted emails replace some headers
+        in the wrapping email (see ProtectConfig.REPLACED_HEADERS).
+
+        :param msg: the unwrapped email, its headers are the protected ones
+        :type msg: Message
+        :param protection_level: the protection the email had
+        :type protection_level: ProtectionLevel
+        :param outer_headers: the unprotected headers of the wrapping email
+        :type outer_headers: [(str, str)]
+        :param replacements: outer values of headers replaced on protection
+        :type replacements: {str: str}
+        """
+        self.__dict__.update(msg.__dict__)
         self._msg = msg
-        self._gpg = gpg
 
-        verified = False
-        # verified = verify_signature(msg, gpg)
-        self.signed = verified.valid
+        if protection_level is None:
+            protection_level = ProtectionLevel()
+        self.protection_level = protection_level
+        if outer_headers is None:
+            outer_headers = []
+        self.outer_headers = outer_headers
+        if replacements is None:
+            replacements = {}
 
         self._mh_headers = {}
-        # inner_headers = extract_wrapped_headers(msg)
-        inner_headers = {}
+        if protection_level.score:
+            for name, value in msg.items():
+                if name.lower() in self._mh_headers:
+                    continue
+                mhh = MemoryHoleHeader(name, value)
+                mhh.signed_by.update(protection_level.signed_by)
+                mhh.encrypted_by.update(protection_level.encrypted_by)
+                self._mh_headers[name.lower()] = mhh
+
+        self._replacements = replacements
+        self.header_index = self._index_headers()
 
-        for name, value in inner_headers.items():
-            mhh = MemoryHoleHeader(name, value)
-            mhh.signed_by.add(verified.key_id)
-            self._mh_headers[name] = mhh
+    @property
+    def replacements(self):
+        """
+        The outer values of the headers replaced on protection.
 
-        self._charset = self._msg._charset
-        self._headers = self._msg._headers
-        self._payload = self._msg._payload
-        self.preamble = self._msg.preamble
+        :rtype: {str: str}
+        """
+        return dict(self._replacements)
 
     def get_protected_header(self, header_name):
-        return self._mh_headers.get(header_name)
-
-    # TODO add is_tampered_header?
-    # TODO add __getattr__, lookup the protected headers first
+        return self._mh_headers.get(header_name.lower())
+
+    def is_tampered_header(self, header_name):
+        """
+        Is the outer header different from the protected one.
+
+        :rtype: bool
+        """
+        entry = self.header_index.get(header_name.lower())
+        return entry is not None and entry.tampered
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def get(self, name, failobj=None):
+        """
+        Get the value of a header, looking up the protected headers first
+        and the outer ones after.
+        """
+        entry = self.header_index.get(name.lower())
+        if entry is None:
+            return Message.get(self, name, failobj)
+        return entry.value
+
+    def __setitem__(self, name, val):
+        Message.__setitem__(self, name, val)
+        self.header_index = self._index_headers()
+
+    def __delitem__(self, name):
+        Message.__delitem__(self, name)
+        self.header_index = self._index_headers()
+
+    def add_header(self, _name, _value, **_params):
+        Message.add_header(self, _name, _value, **_params)
+        self.header_index = self._index_headers()
+
+    def replace_header(self, _name, _value):
+        Message.replace_header(self, _name, _value)
+        self.header_index = self._index_headers()
+
+    def _index_headers(self):
+        outer = {}
+        for name, value in self.outer_headers:
+            outer.setdefault(name.lower(), (name, value))
+        inner = {}
+        for name, value in self.items():
+            inner.setdefault(name.lower(), (name, value))
+
+        index = {}
+        unprotected = ProtectionLevel()
+        for lname in set(inner) | set(outer):
+            if lname in MIME_HEADERS and lname not in inner:
+                # the MIME structure of the wrapping email doesn't apply
+                continue
+            name, value = inner.get(lname) or outer[lname]
+            outer_value = outer.get(lname, (None, None))[1]
+
+            mhh = self._mh_headers.get(lname)
+            protected = None
+            level = unprotected
+            tampered = False
+            if mhh is not None:
+                protected = mhh._value
+                level = mhh.protection_level
+                tampered = (
+                    outer_value is not None and
+                    lname not in MIME_HEADERS and
+                    _unfold(outer_value) != _unfold(protected) and
+                    outer_value != self._replacements.get(lname))
+            index[lname] = HeaderEntry(name, value, protected, outer_value,
+                                       tampered, level)
+        return index
+
+
+def _unfold(value):
+    return ' '.join(str(value).split())
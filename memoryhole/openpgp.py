@@ -1,29 +1,63 @@
+import inspect
+from collections import namedtuple
+
 from zope.interface import Interface
 
+try:
+    from inspect import signature as _signature
+except ImportError:
+    _signature = None
+
+
+Decryption = namedtuple("Decryption", ("data", "signed", "valid", "key_id"))
+
+
+class BackendError(RuntimeError):
+    """
+    Raised when a backend fails by itself and not because of the request,
+    like when its gpg process crashes or hangs.
+    """
+
 
 class IOpenPGP(Interface):
-    def encrypt(data, encraddr):
+    def encrypt(data, encraddr, signaddr=None, compression=None):
         """
         Encrypt and sign data.
 
+        If signaddr is given the data will be signed and encrypted in a single
+        pass, the signature goes inside the encrypted data as one-pass
+        signature packets. Otherwise the data will only be encrypted.
+
+        compression is only passed when the configuration has a compression
+        policy (see memoryhole.compression), implementations that don't
+        support it can leave the parameter out.
+
         :param data: data to be encrypted
-        :type data: str
+        :type data: str or file
         :param encraddr: list of email addresses to encrypt to
         :type encraddr: [str]
-        :param singaddr: email address to sign with
-        :type singaddr: str
+        :param signaddr: email address to sign with
+        :type signaddr: str
+        :param compression: algorithm and level to compress data with
+        :type compression: Compression
 
         :return: encrypted and signed data
         :rtype: str
         """
         pass
 
-    def sign(data):
+    def sign(data, signaddr=None):
         """
         Sign data.
 
+        If signaddr is given the data will be signed with the key of that
+        address, otherwise with the default key. protect passes it whenever
+        the email has a sender.
+
         :param data: data to be encrypted
-        :type data: str
+        :type data: str or file
+        :param signaddr: email address to sign with
+        :type signaddr: str
 
         :return: signature
         :rtype: str
@@ -32,15 +66,36 @@ class IOpenPGP(Interface):
 
     def decrypt(data):
         """
-        Decrypt and verify data.
+        Decrypt data.
+
+        Signatures inside the encrypted data are not checked, use
+        decrypt_verify for that.
 
         :param data: data to be decrypted
-        :type data: str
+        :type data: str or file
 
         :return: decrypted data
         :rtype: str
         """
-        # What about verification???
+        pass
+
+    def decrypt_verify(data):
+        """
+        Decrypt data and verify the signature inside it in the same pass, as
+        made by encrypt with a signaddr.
+
+        This method is optional, unwrap uses decrypt for implementations that
+        don't have it (see the decrypt_verify function).
+
+        :param data: data to be decrypted
+        :type data: str or file
+
+        :return: the decrypted data, if it was signed, if the signature is
+                 valid and the key id of the signer, None if not signed.
+                 For valid signatures it should be the fingerprint of the
+                 primary key, the one key_addresses knows the uids of
+        :rtype: Decryption
+        """
         pass
 
     def verify(data, signature):
@@ -56,3 +111,173 @@ class IOpenPGP(Interface):
         :rtype: bool
         """
         pass
+
+    def verify_signer(data, signature):
+        """
+        Verify a signature and find out who made it.
+
+        This method is optional, without it unwrap can't tell who signed a
+        part and doesn't count it as signed (see the verify_signer
+        function).
+
+        :param data: data to be verified
+        :type data: str
+        :param signature: detached signature
+        :type signature: str
+
+        :return: the fingerprint of the primary key of the signer, None if
+                 the signature is not valid
+        :rtype: str
+        """
+        pass
+
+    def key_addresses(key_id):
+        """
+        Find the email addresses of the uids of a key.
+
+        This method is optional, unwrap needs it to check that a part was
+        signed by its sender (see the key_addresses function).
+
+        :param key_id: fingerprint or key id of the key or of one of its
+                       subkeys
+        :type key_id: str
+
+        :return: the addresses, empty if the key is unknown
+        :rtype: [str]
+        """
+        pass
+
+
+def decrypt_verify(openpgp, data):
+    """
+    Decrypt data and verify the signature inside it with openpgp, in a single
+    pass if openpgp implements decrypt_verify. Otherwise data is only
+    decrypted, and it counts as not signed.
+
+    :param openpgp: the implementation to use
+    :type openpgp: IOpenPGP
+    :param data: data to be decrypted
+    :type data: str or file
+
+    :rtype: Decryption
+    """
+    method = getattr(openpgp, 'decrypt_verify', None)
+    if method is None:
+        return Decryption(openpgp.decrypt(data), False, False, None)
+    return method(data)
+
+
+def verify_signer(openpgp, data, signature):
+    """
+    Verify a signature with openpgp and find out who made it. If openpgp
+    doesn't implement verify_signer the signer can't be known, and None is
+    returned even for valid signatures.
+
+    :param openpgp: the implementation to use
+    :type openpgp: IOpenPGP
+    :param data: data to be verified
+    :type data: str
+    :param signature: detached signature
+    :type signature: str
+
+    :return: the fingerprint of the signer, None if unknown or not valid
+    :rtype: str
+    """
+    method = getattr(openpgp, 'verify_signer', None)
+    if method is None:
+        return None
+    return method(data, signature)
+
+
+def key_addresses(openpgp, key_id):
+    """
+    Find the email addresses of the uids of a key with openpgp, lower cased.
+    Without key_addresses in openpgp no address is known for any key.
+
+    :param openpgp: the implementation to use
+    :type openpgp: IOpenPGP
+    :param key_id: fingerprint or key id of the key
+    :type key_id: str
+
+    :rtype: [str]
+    """
+    method = getattr(openpgp, 'key_addresses', None)
+    if method is None or key_id is None:
+        return []
+    return sorted(set(address.lower() for address in method(key_id)))
+
+
+def sign_as(openpgp, data, signaddr=None):
+    """
+    Sign data with openpgp as signaddr. If openpgp.sign doesn't take signaddr
+    it's left out, and the data is signed with the default key of openpgp,
+    check signs_as before claiming who signed it.
+
+    :param openpgp: the implementation to use
+    :type openpgp: IOpenPGP
+    :param data: data to be signed
+    :type data: str or file
+    :param signaddr: email address to sign with
+    :type signaddr: str
+
+    :return: signature
+    :rtype: str
+    """
+    if signaddr is None or not signs_as(openpgp):
+        return openpgp.sign(data)
+    return openpgp.sign(data, signaddr)
+
+
+def signs_as(openpgp):
+    """
+    If openpgp.sign takes the address to sign as.
+
+    :param openpgp: the implementation to use
+    :type openpgp: IOpenPGP
+
+    :rtype: bool
+    """
+    return _takes_args(openpgp.sign, 2)
+
+
+def encrypt_args(data, encraddr, signaddr=None, compression=None):
+    """
+    Build the arguments of IOpenPGP.encrypt leaving out the optional ones not
+    given, so implementations that don't support them still work.
+
+    :return: the positional and keyword arguments
+    :rtype: (list, dict)
+    """
+    args = [data, encraddr]
+    if signaddr is not None:
+        args.append(signaddr)
+    kwargs = {}
+    if compression is not None:
+        kwargs['compression'] = compression
+    return args, kwargs
+
+
+def _takes_args(method, count):
+    """
+    If method can be called with count positional arguments, True when it
+    can't be inspected.
+    """
+    if _signature is not None:
+        try:
+            signature = _signature(method)
+        except (TypeError, ValueError):
+            return True
+        try:
+            signature.bind(*range(count))
+        except TypeError:
+            return False
+        return True
+
+    try:
+        spec = inspect.getargspec(method)
+    except TypeError:
+        return True
+    args = spec.args
+    if inspect.ismethod(method):
+        args = args[1:]
+    return spec.varargs is not None or len(args) >= count
@@ -0,0 +1,352 @@
+import threading
+import time
+from collections import deque
+from functools import partial
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from zope.interface import implementer
+
+from memoryhole.openpgp import (
+    IOpenPGP, BackendError, decrypt_verify, encrypt_args, key_addresses,
+    sign_as, verify_signer
+)
+
+
+# a slot in the pool for a backend not built yet
+_NEW = object()
+
+# errors of the backend itself, the rest are caused by the request
+BACKEND_ERRORS = (BackendError, EnvironmentError)
+
+
+class PoolFullError(RuntimeError):
+    """
+    Raised when the queue of callers waiting for a backend is full.
+    """
+
+
+@implementer(IOpenPGP)
+class OpenPGPPool(object):
+
+    def __init__(self, factory, size=4, max_queue=None, block=True,
+                 timeout=None, max_failures=3):
+        """
+        Thread safe pool of IOpenPGP backends.
+
+        Each operation borrows a backend from the pool for its whole
+        duration, so a backend is never used by two threads at the same time
+        and there are never more than size operations in flight. Callers
+        that don't get a backend are queued and served in arrival order.
+
+        When max_queue callers are already waiting, new callers wait for a
+        place in the queue if block is True, or fail with PoolFullError
+        otherwise. If timeout seconds pass while waiting PoolFullError is
+        raised as well.
+
+        A backend that fails max_failures operations in a row is considered
+        broken, it gets discarded and replaced by a new one from factory.
+        Only the errors of the backend itself count as failures, like
+        BackendError or an OSError running gpg, the ones caused by the
+        request (an unknown key, bad data...) are raised without counting.
+
+        :param factory: callable returning a new backend
+        :type factory: callable
+        :param size: maximum number of operations in flight
+        :type size: int
+        :param max_queue: maximum number of waiting callers, None for no
+                          limit
+        :type max_queue: int
+        :param block: should callers wait when the queue is full
+        :type block: bool
+        :param timeout: maximum seconds to wait for a backend
+        :type timeout: float
+        :param max_failures: consecutive failures to evict a backend
+        :type max_failures: int
+        """
+        self._factory = factory
+        self.size = size
+        self.max_queue = max_queue
+        self.block = block
+        self.timeout = timeout
+        self.max_failures = max_failures
+
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        self._idle = []
+        self._waiters = deque()
+        self._failures = {}
+        self._created = 0
+        self.in_flight = 0
+        self.evicted = 0
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    def encrypt(self, data, encraddr, signaddr=None, compression=None):
+        args, kwargs = encrypt_args(data, encraddr, signaddr, compression)
+        return self._run('encrypt', *args, **kwargs)
+
+    def sign(self, data, signaddr=None):
+        return self._run(sign_as, data, signaddr)
+
+    def decrypt(self, data):
+        return self._run('decrypt', data)
+
+    def decrypt_verify(self, data):
+        return self._run(decrypt_verify, data)
+
+    def verify(self, data, signature):
+        return self._run('verify', data, signature)
+
+    def verify_signer(self, data, signature):
+        return self._run(verify_signer, data, signature)
+
+    def key_addresses(self, key_id):
+        return self._run(key_addresses, key_id)
+
+    def _run(self, method, *args, **kwargs):
+        backend = self._acquire()
+        failed = True
+        try:
+            result = _method(backend, method)(*args, **kwargs)
+            failed = False
+            return result
+        except BACKEND_ERRORS:
+            raise
+        except Exception:
+            failed = False
+            raise
+        finally:
+            self._release(backend, failed)
+
+    def _acquire(self):
+        with self._lock:
+            backend = None
+            if not self._waiters:
+                backend = self._get_idle()
+            if backend is None:
+                waiter = self._queue()
+        if backend is not None:
+            return self._built(backend)
+
+        if waiter.event.wait(self.timeout):
+            return self._built(waiter.backend)
+
+        with self._lock:
+            backend = waiter.backend
+            if backend is None:
+                self._waiters.remove(waiter)
+                self._room.notify()
+        if backend is None:
+            raise PoolFullError('Timeout waiting for a backend')
+        # we got the backend just after the timeout
+        return self._built(backend)
+
+    def _queue(self):
+        while (self.max_queue is not None and
+               len(self._waiters) >= self.max_queue):
+            if not self.block:
+                raise PoolFullError('Too many operations waiting')
+            self._room.wait(self.timeout)
+            if len(self._waiters) >= self.max_queue:
+                if self.timeout is not None:
+                    raise PoolFullError('Timeout waiting in the queue')
+
+        waiter = _Waiter()
+        self._waiters.append(waiter)
+        return waiter
+
+    def _get_idle(self):
+        if self._idle:
+            self.in_flight += 1
+            return self._idle.pop()
+        if self._created < self.size:
+            self._created += 1
+            self.in_flight += 1
+            return _NEW
+        return None
+
+    def _built(self, backend):
+        """
+        The backend to use, built outside of the lock if it's _NEW.
+
+        If the factory fails the slot reserved for the backend is given to
+        the next waiter, or freed if nobody is waiting.
+        """
+        if backend is not _NEW:
+            return backend
+        try:
+            return self._factory()
+        except Exception:
+            with self._lock:
+                self._hand(_NEW)
+            raise
+
+    def _release(self, backend, failed):
+        with self._lock:
+            if failed:
+                failures = self._failures.get(id(backend), 0) + 1
+                if failures >= self.max_failures:
+                    self._failures.pop(id(backend), None)
+                    # whoever gets the slot builds its replacement
+                    backend = _NEW
+                    self.evicted += 1
+                else:
+                    self._failures[id(backend)] = failures
+            else:
+                self._failures.pop(id(backend), None)
+            self._hand(backend)
+
+    def _hand(self, backend):
+        if self._waiters:
+            # hand the backend directly to the oldest waiter
+            waiter = self._waiters.popleft()
+            waiter.backend = backend
+            waiter.event.set()
+            self._room.notify()
+        else:
+            self.in_flight -= 1
+            if backend is _NEW:
+                self._created -= 1
+            else:
+                self._idle.append(backend)
+
+
+@implementer(IOpenPGP)
+class HedgedOpenPGP(object):
+
+    def __init__(self, primary, secondary, percentile=0.95, min_samples=20,
+                 window=200):
+        """
+        Hedge slow operations of a backend on a second one.
+
+        Operations go to the primary backend. If one takes longer than the
+        given percentile of the recent latencies, the same operation is
+        started on the secondary backend and the first answer is used.
+        Hedging starts once min_samples latencies have been measured.
+
+        Use it with Gnupg timeouts, so the losing operation of a hung gpg
+        gets reaped.
+
+        :param primary: the backend for all operations
+        :type primary: IOpenPGP
+        :param secondary: the backend for hedged operations
+        :type secondary: IOpenPGP
+        :param percentile: latency percentile that triggers hedging
+        :type percentile: float
+        :param min_samples: latencies needed before hedging
+        :type min_samples: int
+        :param window: number of recent latencies kept
+        :type window: int
+        """
+        self.primary = primary
+        self.secondary = secondary
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.hedged = 0
+
+    def encrypt(self, data, encraddr, signaddr=None, compression=None):
+        args, kwargs = encrypt_args(data, encraddr, signaddr, compression)
+        return self._run('encrypt', *args, **kwargs)
+
+    def sign(self, data, signaddr=None):
+        return self._run(sign_as, data, signaddr)
+
+    def decrypt(self, data):
+        return self._run('decrypt', data)
+
+    def decrypt_verify(self, data):
+        return self._run(decrypt_verify, data)
+
+    def verify(self, data, signature):
+        return self._run('verify', data, signature)
+
+    def verify_signer(self, data, signature):
+        return self._run(verify_signer, data, signature)
+
+    def key_addresses(self, key_id):
+        return self._run(key_addresses, key_id)
+
+    def hedge_delay(self):
+        """
+        Seconds to wait for the primary before hedging, None if there are
+        not enough samples yet.
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = min(int(len(latencies) * self.percentile), len(latencies) - 1)
+        return latencies[index]
+
+    def _run(self, method, *args, **kwargs):
+        if hasattr(args[0], 'read'):
+            # a file can't be read by two backends at the same time
+            return self._timed(self.primary, method, args, kwargs)
+
+        delay = self.hedge_delay()
+        if delay is None:
+            return self._timed(self.primary, method, args, kwargs)
+
+        answers = Queue()
+        self._start(self.primary, method, args, kwargs, answers)
+        pending = 1
+        try:
+            ok, value = answers.get(timeout=delay)
+            pending -= 1
+        except Empty:
+            with self._lock:
+                self.hedged += 1
+            self._start(self.secondary, method, args, kwargs, answers)
+            pending += 1
+            ok, value = answers.get()
+            pending -= 1
+
+        while not ok and pending:
+            ok, value = answers.get()
+            pending -= 1
+        if not ok:
+            raise value
+        return value
+
+    def _start(self, backend, method, args, kwargs, answers):
+        def run():
+            try:
+                answers.put((True,
+                             self._timed(backend, method, args, kwargs)))
+            except Exception as e:
+                answers.put((False, e))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def _timed(self, backend, method, args, kwargs):
+        start = time.time()
+        result = _method(backend, method)(*args, **kwargs)
+        with self._lock:
+            self._latencies.append(time.time() - start)
+        return result
+
+
+def _method(backend, method):
+    """
+    Get the method of backend called method, or the function method applied
+    to backend, for operations that backends might not implement.
+    """
+    if callable(method):
+        return partial(method, backend)
+    return getattr(backend, method)
+
+
+class _Waiter(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.backend = None
@@ -1,21 +1,33 @@
+import os
 import re
-
-try:
-        from StringIO import StringIO
-except ImportError:
-        from io import StringIO
+import shutil
+import tempfile
+from binascii import hexlify
+from email.generator import Generator, _make_boundary
+from email.message import Message
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.utils import getaddresses
+from email.utils import getaddresses, parseaddr
 from collections import namedtuple
-from copy import deepcopy
+from copy import copy
+from io import BytesIO
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
 
+from memoryhole.cache import cached_message
 from memoryhole.gpg import Gnupg
+from memoryhole.message import ProtectionLevel
+from memoryhole.openpgp import encrypt_args, sign_as, signs_as
 from memoryhole.rfc3156 import (
     PGPEncrypted, MultipartEncrypted, RFC3156CompliantGenerator,
-    MultipartSigned, PGPSignature, encode_base64_rec
+    MultipartSigned, PGPSignature, canonical_text, encode_base64_rec,
+    fold_headers, signed_text
 )
+from memoryhole.walk import DEFAULT_LIMITS, copy_tree, walk
 
 
 class ProtectConfig(object):
@@ -32,7 +44,9 @@ class ProtectConfig(object):
     }
 
     def __init__(self, openpgp=None, replaced_headers=REPLACED_HEADERS,
-                 skipped_headers=[]):
+                 skipped_headers=[], spool_threshold=None, cache=None,
+                 compression=None, limits=DEFAULT_LIMITS,
+                 encoding_cache=None, recorder=None):
         """
         Configuration parameters for the protection.
 
@@ -45,7 +59,33 @@ class ProtectConfig(object):
         replaced by 'replacement' unless 'replacement' is None, in which case
         the header will be removed completely from the top level headers.
 
-        All header names need to be in lower case.
+        All header names need to be in lower case. The replaced_headers and
+        skipped_headers are copied, and protect never modifies the
+        configuration, so a ProtectConfig can be shared between threads as
+        long as its openpgp implementation can (see memoryhole.pool).
+
+        Messages with payloads bigger than spool_threshold bytes will be
+        flattened into anonymous temporary files, and the file handles will be
+        passed to openpgp instead of strings. Smaller messages, or all of them
+        if spool_threshold is None, are processed in memory.
+
+        If a cache is given protecting again an email already protected with
+        the same configuration will return the cached email, with no crypto
+        operations.
+
+        If a compression policy is given it chooses how each email is
+        compressed before encryption, otherwise openpgp uses its default
+        compression.
+
+        Emails exceeding the limits on their MIME structure are rejected with
+        MIMELimitError before doing anything with them.
+
+        If an encoding_cache is given the payloads base64 encoded for signing
+        are kept in it, so attachments repeated in many emails are only
+        encoded once.
+
+        If a recorder is given it keeps the profile of the slow protections
+        (see memoryhole.slowops).
 
         :param openpgp: the implementation of openpgp to use for encryption
                         and/or signature
@@ -54,48 +94,368 @@ class ProtectConfig(object):
         :type replaced_headers: {str: Header}
         :param skipped_headers: list of headers to skip
         :type skipped_headers: [str]
+        :param spool_threshold: payload size in bytes to start spooling to
+                                disk
+        :type spool_threshold: int
+        :param cache: cache of protected emails
+        :type cache: ProtectCache
+        :param compression: policy choosing the compression of each email
+        :type compression: CompressionPolicy
+        :param limits: limits on the structure of the emails, None for no
+                       limits
+        :type limits: MIMELimits
+        :param encoding_cache: cache of base64 encoded payloads
+        :type encoding_cache: EncodingCache
+        :param recorder: recorder of slow operations
+        :type recorder: SlowOpRecorder
         """
         if openpgp is None:
             openpgp = Gnupg()
         self.openpgp = openpgp
 
-        self.skipped_headers = skipped_headers
-        self.replaced_headers = replaced_headers
+        self.skipped_headers = list(skipped_headers)
+        self.replaced_headers = dict(replaced_headers)
+        self.spool_threshold = spool_threshold
+        self.compression = compression
+        self.cache = cache
+        self.limits = limits
+        self.encoding_cache = encoding_cache
+        self.recorder = recorder
+
+    def spool(self, msg):
+        """
+        Should msg intermediates be spooled to disk.
+
+        :param msg: the email to be protected
+        :type msg: Message
+
+        :rtype: bool
+        """
+        if self.spool_threshold is None:
+            return False
+        return _payload_size(msg) > self.spool_threshold
 
 
-def protect(msg, encrypt=True, config=None):
+def protect(msg, encrypt=True, config=None, sign=False):
     """
     Protect an email with memory hole. It will protect the
     config.protected_headers and will obscure the config.obscured_headers
 
+    If encrypt and sign are both True the message will be signed and
+    encrypted with a single call to config.openpgp.encrypt, the signature
+    travels inside the encrypted part. If encrypt is False the message will
+    be signed.
+
+    The returned email has a protection_level attribute with the
+    ProtectionLevel applied to it. It's only signed by the sender if
+    config.openpgp.sign takes the address to sign as, otherwise openpgp
+    signs with its default key and no signer is claimed.
+
     :param msg: the email to be protected
     :type msg: Message
     :param encrypt: should the message be encrypted
     :type encrypt: bool
+    :param sign: should the encrypted message be signed too
+    :type sign: bool
 
     :return: an encrypted and/or signed email
     :rtype: Message
     """
     if config is None:
         config = ProtectConfig()
+    if config.recorder is not None:
+        return config.recorder.record('protect', msg, _protect, msg,
+                                      encrypt, sign, config)
+    return _protect(msg, encrypt, sign, config)
+
+
+def _protect(msg, encrypt, sign, config):
+    if config.limits is not None:
+        config.limits.check(msg)
+
+    if config.cache is not None:
+        return _cached_protect(msg, encrypt, sign, config)
 
     if encrypt:
-        return _encrypt_mime(msg, config)
+        return _encrypt_mime(msg, config, sign)
 
     return _sign_mime(msg, config)
 
 
-def _encrypt_mime(msg, config):
+def protect_to_bytes(msg, encrypt=True, config=None, sign=False):
+    """
+    Protect an email like protect, returning it already flattened.
+
+    :param msg: the email to be protected
+    :type msg: Message
+    :param encrypt: should the message be encrypted
+    :type encrypt: bool
+    :param sign: should the encrypted message be signed too
+    :type sign: bool
+
+    :return: the protected email, with the flattened email in its data
+    :rtype: ProtectedEmail
+    """
+    out = BytesIO()
+    protected = protect_to_file(msg, out, encrypt, config, sign)
+    protected.data = out.getvalue()
+    return protected
+
+
+def protect_to_file(msg, fp, encrypt=True, config=None, sign=False):
+    """
+    Protect an email like protect, writing the flattened email into fp.
+
+    The email is written while it's assembled, the encrypted data from
+    config.openpgp, or the part already flattened to be signed, goes into fp
+    as it is, without flattening the protected email again. The Message is
+    only built if ProtectedEmail.message is called.
+
+    Encrypted emails are flattened as Message.as_string does, signed ones
+    with the same generator used to produce the signed text.
+
+    :param msg: the email to be protected
+    :type msg: Message
+    :param fp: where to write the protected email
+    :type fp: binary file
+    :param encrypt: should the message be encrypted
+    :type encrypt: bool
+    :param sign: should the encrypted message be signed too
+    :type sign: bool
+
+    :return: the protected email
+    :rtype: ProtectedEmail
+    """
+    if config is None:
+        config = ProtectConfig()
+    if config.recorder is not None:
+        return config.recorder.record('protect_to_file', msg, _protect_file,
+                                      msg, fp, encrypt, sign, config)
+    return _protect_file(msg, fp, encrypt, sign, config)
+
+
+def _protect_file(msg, fp, encrypt, sign, config):
+    if config.limits is not None:
+        config.limits.check(msg)
+
+    if config.cache is None:
+        return _protect_to_file(msg, fp, encrypt, sign, config)
+
+    key = _cache_key(msg, encrypt, sign, config)
+    cached = config.cache.get_text(key)
+    if cached is not None:
+        text, level = cached
+        _BytesWriter(fp).write(text)
+        return ProtectedEmail(lambda: cached_message(text, level), level)
+
+    out = BytesIO()
+    protected = _protect_to_file(msg, out, encrypt, sign, config,
+                                 boundary=config.cache.boundary(key))
+    data = out.getvalue()
+    config.cache.put_text(key, data.decode('utf-8'),
+                          protected.protection_level)
+    fp.write(data)
+    return protected
+
+
+class ProtectedEmail(object):
+    """
+    A protected email already flattened by protect_to_file.
+
+    It has the protection_level attribute of the email, and the flattened
+    email in data when it comes from protect_to_bytes.
+    """
+
+    def __init__(self, build, protection_level, data=None):
+        self._build = build
+        self._msg = None
+        self.protection_level = protection_level
+        self.data = data
+
+    def message(self):
+        """
+        Get the protected email.
+
+        :rtype: Message
+        """
+        if self._msg is None:
+            self._msg = self._build()
+            self._build = None
+        return self._msg
+
+
+def _protect_to_file(msg, fp, encrypt, sign, config, boundary=None):
+    if not encrypt:
+        newmsg, part, sigmsg, flat = _sign(msg, config, boundary,
+                                           flattened=True)
+        try:
+            _write_signed(fp, newmsg, sigmsg, flat)
+        finally:
+            _close(flat)
+        return ProtectedEmail(lambda: _build(newmsg, newmsg, [part, sigmsg]),
+                              newmsg.protection_level)
+
+    newmsg, encmsg, encstr = _encrypt(msg, config, sign, boundary)
+
+    # flatten the email with a placeholder in place of the encrypted data,
+    # and write the encrypted data in its place
+    placeholder = 'memoryhole-encrypted-' + hexlify(os.urandom(16)).decode()
+    encmsg.set_payload(placeholder)
+    out = StringIO()
+    g = Generator(out, mangle_from_=False, maxheaderlen=0)
+    g.flatten(newmsg)
+
+    text = out.getvalue()
+    delimiter = '--' + newmsg.get_boundary()
+    if text.count(placeholder) != 1 or _contains(encstr, delimiter):
+        # the backend returned something that doesn't fit in the template
+        encmsg.set_payload(encstr)
+        text = newmsg.as_string(unixfrom=False)
+        _BytesWriter(fp).write(text)
+    else:
+        head, tail = text.split(placeholder)
+        writer = _BytesWriter(fp)
+        writer.write(head)
+        writer.write(encstr)
+        writer.write(tail)
+    return ProtectedEmail(lambda: _build(newmsg, encmsg, encstr),
+                          newmsg.protection_level)
+
+
+def _write_signed(fp, newmsg, sigmsg, flat):
+    """
+    Write the signed email, without its signed part flattened again.
+
+    The signed part goes into fp as it is in flat, the signed part flattened
+    by _sign.
+    """
+    if newmsg.get_boundary() is None:
+        newmsg.set_boundary(_free_boundary(flat))
+
+    # a part without headers is flattened as an empty line and its payload
+    placeholder = 'memoryhole-signed-' + hexlify(os.urandom(16)).decode()
+    holder = Message()
+    holder.set_payload(placeholder)
+    newmsg.set_payload([holder, sigmsg])
+    out = StringIO()
+    g = RFC3156CompliantGenerator(out, mangle_from_=False, maxheaderlen=76,
+                                  limits=None)
+    g.flatten(newmsg)
+    newmsg.set_payload([])
+
+    head, tail = out.getvalue().split('\n' + placeholder)
+    writer = _BytesWriter(fp)
+    writer.write(head)
+    if hasattr(flat, 'read'):
+        shutil.copyfileobj(flat, fp)
+    else:
+        writer.write(flat)
+    writer.write(tail)
+
+
+def _free_boundary(flat):
+    """
+    Make a boundary that doesn't appear in flat, a str or a binary file.
+    """
+    if not hasattr(flat, 'read'):
+        return _make_boundary(flat)
+    while True:
+        boundary = _make_boundary()
+        delimiter = ('--' + boundary).encode('ascii')
+        flat.seek(0)
+        found = any(line.startswith(delimiter) for line in flat)
+        flat.seek(0)
+        if not found:
+            return boundary
+
+
+def _build(msg, part, payload):
+    """
+    Set the payload of part, in msg, and return msg.
+    """
+    part.set_payload(payload)
+    return msg
+
+
+def _close(flat):
+    if hasattr(flat, 'close'):
+        flat.close()
+
+
+def _cache_key(msg, encrypt, sign, config):
+    sign = sign or not encrypt
+    encraddr = _recipient_addresses(msg) if encrypt else []
+    signaddr = _sender_address(msg) if sign else None
+    return config.cache.key(msg, encrypt, sign, config, encraddr, signaddr)
+
+
+def _cached_protect(msg, encrypt, sign, config):
+    key = _cache_key(msg, encrypt, sign, config)
+    newmsg = config.cache.get(key)
+    if newmsg is not None:
+        return newmsg
+
+    if encrypt:
+        newmsg = _encrypt_mime(msg, config, sign,
+                               boundary=config.cache.boundary(key))
+    else:
+        newmsg = _sign_mime(msg, config,
+                            boundary=config.cache.boundary(key))
+    config.cache.put(key, newmsg)
+    return newmsg
+
+
+def _encrypt_mime(msg, config, sign=False, boundary=None):
+    newmsg, encmsg, encstr = _encrypt(msg, config, sign, boundary)
+    encmsg.set_payload(encstr)
+    return newmsg
+
+
+def _encrypt(msg, config, sign, boundary):
+    """
+    Build the encrypted email.
+
+    :return: the encrypted email, its part for the encrypted data, still
+             without payload, and the encrypted data
+    :rtype: (Message, Message, str)
+    """
     encraddr = _recipient_addresses(msg)
+    signaddr = None
+    if sign:
+        signaddr = _sender_address(msg)
 
+    spool = config.spool(msg)
+
+    # the payloads are not modified when encrypting, big messages don't need
+    # a copy of them
     newmsg, part = _protect_headers(
-        msg, MultipartEncrypted('application/pgp-encrypted'), config)
+        msg, MultipartEncrypted('application/pgp-encrypted',
+                                boundary=boundary),
+        config, shallow=spool)
     if config.replaced_headers:
-        newmsg, part = _replace_headers(newmsg, part, config)
-
-    encstr = config.openpgp.encrypt(part.as_string(unixfrom=False), encraddr)
+        newmsg, part = _replace_headers(newmsg, part, config, boundary)
+
+    if spool:
+        data = tempfile.TemporaryFile()
+        # the same as part.as_string, so the plaintext doesn't depend on
+        # spool_threshold
+        g = Generator(_BytesWriter(data), mangle_from_=False, maxheaderlen=0)
+        g.flatten(part, unixfrom=False)
+        data.seek(0)
+    else:
+        data = part.as_string(unixfrom=False)
+
+    compression = None
+    if config.compression is not None:
+        compression = config.compression.choose(msg)
+    args, kwargs = encrypt_args(data, encraddr, signaddr, compression)
+    try:
+        encstr = config.openpgp.encrypt(*args, **kwargs)
+    finally:
+        if spool:
+            data.close()
     encmsg = MIMEApplication(
-        encstr, _subtype='octet-stream', _encoder=lambda x: x)
+        '', _subtype='octet-stream', _encoder=lambda x: x)
     encmsg.add_header('content-disposition', 'attachment',
                       filename='msg.asc')
 
@@ -105,35 +465,134 @@ def _encrypt_mime(msg, config):
     # attach pgp message parts to new message
     newmsg.attach(metamsg)
     newmsg.attach(encmsg)
-    return newmsg
 
+    signed_by = set([signaddr]) if signaddr is not None else set([])
+    newmsg.protection_level = ProtectionLevel(
+        signed_by=signed_by, encrypted_by=set(encraddr))
+    return newmsg, encmsg, encstr
+
+
+def _sign_mime(msg, config, boundary=None):
+    newmsg, part, sigmsg, flat = _sign(msg, config, boundary)
+    _close(flat)
+    return _build(newmsg, newmsg, [part, sigmsg])
 
-def _sign_mime(msg, config):
+
+def _sign(msg, config, boundary, flattened=False):
+    """
+    Build the signed email.
+
+    :return: the signed email, still without parts, the part signed, the
+             signature and the part flattened, in a temporary file
+             positioned at its begining for big emails, or None if not
+             flattened and it was kept in memory
+    :rtype: (Message, Message, Message, str or file)
+    """
     newmsg, part = _protect_headers(
-        msg, MultipartSigned('application/pgp-signature', 'pgp-sha512'),
+        msg, MultipartSigned('application/pgp-signature', 'pgp-sha512',
+                             boundary=boundary),
         config)
 
     # apply base64 content-transfer-encoding
-    encode_base64_rec(part)
-    # get message text with headers and replace \n for \r\n
-    fp = StringIO()
-    g = RFC3156CompliantGenerator(fp, mangle_from_=False, maxheaderlen=76)
+    encode_base64_rec(part, cache=config.encoding_cache)
+    fold_headers(part)
+    signaddr = _sender_address(msg) or None
+    if not signs_as(config.openpgp):
+        # it signs with its default key, that might not be the sender's
+        signaddr = None
+    if config.spool(msg):
+        flat = _spool_flatten(part)
+        try:
+            msgtext = _spool_signed_text(msg, flat)
+            try:
+                signature = sign_as(config.openpgp, msgtext, signaddr)
+            finally:
+                msgtext.close()
+        except Exception:
+            flat.close()
+            raise
+        flat.seek(0)
+    elif flattened:
+        out = StringIO()
+        g = RFC3156CompliantGenerator(out, mangle_from_=False,
+                                      maxheaderlen=76, limits=None)
+        g.flatten(part)
+        flat = out.getvalue()
+        out.close()
+        signature = sign_as(config.openpgp, canonical_text(part, flat),
+                            signaddr)
+    else:
+        flat = None
+        signature = sign_as(config.openpgp,
+                            signed_text(part, limits=None), signaddr)
+    sigmsg = PGPSignature(signature)
+
+    signed_by = set([signaddr]) if signaddr is not None else set([])
+    newmsg.protection_level = ProtectionLevel(signed_by=signed_by)
+    return newmsg, part, sigmsg, flat
+
+
+def _spool_flatten(part):
+    """
+    Flatten part into a temporary file, as signed_text does.
+
+    :return: the file positioned at the begining of the text
+    :rtype: file
+    """
+    flat = tempfile.TemporaryFile()
+    g = RFC3156CompliantGenerator(_BytesWriter(flat), mangle_from_=False,
+                                  maxheaderlen=76, limits=None)
     g.flatten(part)
-    msgtext = re.sub('\r?\n', '\r\n', fp.getvalue())
+    flat.seek(0)
+    return flat
+
+
+def _spool_signed_text(msg, flat):
+    """
+    Copy the flattened part in flat into a temporary file with \r\n line
+    endings.
+
+    It does the same as signed_text, but the flattened
+    text is never loaded entirely into memory.
+
+    :return: the file positioned at the begining of the text
+    :rtype: file
+    """
+    msgtext = tempfile.TemporaryFile()
+    line = b''
+    for line in flat:
+        msgtext.write(re.sub(b'\r?\n', b'\r\n', line))
     # make sure signed message ends with \r\n as per OpenPGP stantard.
-    if msg.is_multipart() and not msgtext.endswith("\r\n"):
-        msgtext += "\r\n"
+    if msg.is_multipart() and not line.endswith(b"\n"):
+        msgtext.write(b"\r\n")
+    msgtext.seek(0)
+    return msgtext
 
-    signature = config.openpgp.sign(msgtext)
-    sigmsg = PGPSignature(signature)
 
-    # attach original message and signature to new message
-    newmsg.attach(part)
-    newmsg.attach(sigmsg)
-    return newmsg
+class _BytesWriter(object):
+    """
+    Adapt a binary file to be written by the email generators.
+    """
+
+    def __init__(self, fp):
+        self._fp = fp
 
+    def write(self, s):
+        if not isinstance(s, bytes):
+            s = s.encode('utf-8')
+        self._fp.write(s)
 
-def _replace_headers(msg, part, config):
+
+def _payload_size(msg):
+    size = 0
+    for _, _, part, _ in walk(msg):
+        payload = part.get_payload()
+        if not part.is_multipart() and payload is not None:
+            size += len(payload)
+    return size
+
+
+def _replace_headers(msg, part, config, boundary=None):
     headers = ""
     for header, value in msg.items():
         h = header.lower()
@@ -142,7 +601,10 @@ def _replace_headers(msg, part, config):
             headers += header + ": " + value + "\n"
     headerspart = MIMEText(headers, 'rfc822-headers')
     # TODO: should this be an attachment????
-    newpart = MIMEMultipart('mixed', _subparts=[headerspart, part])
+    if boundary is not None:
+        boundary += 'mixed'
+    newpart = MIMEMultipart('mixed', boundary=boundary,
+                            _subparts=[headerspart, part])
 
     for header, value in config.replaced_headers.items():
         if header in msg:
@@ -152,8 +614,12 @@ def _replace_headers(msg, part, config):
     return msg, newpart
 
 
-def _protect_headers(oldmsg, newmsg, config):
-    part = deepcopy(oldmsg)
+def _protect_headers(oldmsg, newmsg, config, shallow=False):
+    if shallow:
+        part = copy(oldmsg)
+        part._headers = list(oldmsg._headers)
+    else:
+        part = copy_tree(oldmsg)
     for header, value in part.items():
         newmsg.add_header(header, value)
         if header.lower() in config.skipped_headers:
@@ -166,3 +632,13 @@ def _recipient_addresses(msg):
     for header in ('to', 'cc', 'bcc'):
         recipients += msg.get_all(header, [])
     return [r[1] for r in getaddresses(recipients)]
+
+
+def _sender_address(msg):
+    return parseaddr(msg.get('from', ''))[1]
+
+
+def _contains(data, s):
+    if isinstance(data, bytes) and not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return s in data
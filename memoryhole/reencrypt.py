@@ -0,0 +1,407 @@
+"""
+Re-encrypt archived emails to new keys.
+
+Usage:
+
+    python -m memoryhole.reencrypt [--workers N] [--checkpoint FILE]
+        [--sign-as SIGNER] --owner ADDRESS OLD_HOMEDIR NEW_HOMEDIR SOURCE
+        DESTINATION
+
+SOURCE is an mbox file or a Maildir, the re-encrypted emails are written
+into the Maildir DESTINATION. They are encrypted to their recipients and to
+ADDRESS, the owner of the archive. Emails with a signature inside the
+encrypted data are signed again as SIGNER, without it they are copied
+unchanged and reported as failed.
+"""
+import argparse
+import json
+import logging
+import mailbox
+import os
+import sys
+import threading
+import time
+from email.parser import BytesParser
+from multiprocessing.pool import ThreadPool
+
+from memoryhole.classify import classify, ENCRYPTED
+from memoryhole.files import write_atomic
+from memoryhole.openpgp import encrypt_args
+from memoryhole.protection import _recipient_addresses
+from memoryhole.unwrapping import _Source
+
+
+logger = logging.getLogger(__name__)
+
+
+class Reencrypter(object):
+
+    def __init__(self, old_openpgp, new_openpgp, owner, recipients=None,
+                 signaddr=None, workers=4, checkpoint=None,
+                 checkpoint_every=100, report=None, report_every=10):
+        """
+        Re-encrypt the emails of an archive, like when rotating keys.
+
+        Emails are read one by one from the source mailbox, the encrypted
+        ones are decrypted with old_openpgp and the decrypted text is
+        encrypted again with new_openpgp as it is, so the protected headers
+        part is kept untouched and the emails are not protected again. Only
+        the encrypted data of the email changes, the rest of its bytes are
+        copied as they are. Other emails are copied without changes, and so
+        are the ones that fail to be re-encrypted.
+
+        The signature inside the encrypted data can't be kept, as it's made
+        over the encrypted packets. If the decrypted data had a valid one
+        it's signed again as signaddr, otherwise or without signaddr the
+        email fails, so it's never left without its signature unnoticed.
+        old_openpgp needs to implement decrypt_verify to find them.
+
+        Up to workers emails are re-encrypted at the same time, and each one
+        is written into the destination Maildir atomically. The index of the
+        first email not done yet is saved every checkpoint_every emails into
+        the checkpoint file, so an interrupted run can be resumed from there.
+
+        :param old_openpgp: implementation to decrypt the emails
+        :type old_openpgp: IOpenPGP
+        :param new_openpgp: implementation to encrypt the emails again
+        :type new_openpgp: IOpenPGP
+        :param owner: address of the owner of the archive, emails are
+                      always encrypted to it so the owner can still read them
+        :type owner: str
+        :param recipients: callable that gets the email and returns the
+                           addresses to encrypt it to besides the owner, by
+                           default its recipients
+        :type recipients: callable
+        :param signaddr: address to sign again the signed emails as
+        :type signaddr: str
+        :param workers: emails re-encrypted at the same time
+        :type workers: int
+        :param checkpoint: path of the checkpoint file, None for no
+                           checkpoints
+        :type checkpoint: str
+        :param checkpoint_every: number of emails between checkpoints
+        :type checkpoint_every: int
+        :param report: callable that gets the ReencryptStats every
+                       report_every seconds and at the end
+        :type report: callable
+        :param report_every: seconds between reports
+        :type report_every: float
+        """
+        if getattr(old_openpgp, 'decrypt_verify', None) is None:
+            raise ValueError('old_openpgp needs decrypt_verify to find the '
+                             'signatures of the emails')
+        self.old_openpgp = old_openpgp
+        self.new_openpgp = new_openpgp
+        self.owner = owner
+        if recipients is None:
+            recipients = _recipient_addresses
+        self.recipients = recipients
+        self.signaddr = signaddr
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.report = report
+        self.report_every = report_every
+
+    def run(self, source, destination):
+        """
+        Re-encrypt the emails of source into destination, resuming from the
+        checkpoint if there is one.
+
+        :param source: path of an mbox file or a Maildir
+        :type source: str
+        :param destination: path of the Maildir to write to
+        :type destination: str
+
+        :return: the stats of the run
+        :rtype: ReencryptStats
+        """
+        if os.path.isdir(source):
+            box = mailbox.Maildir(source, factory=None, create=False)
+            keys = sorted(box.keys())
+        else:
+            box = mailbox.mbox(source, factory=None, create=False)
+            keys = box.keys()
+        mailbox.Maildir(destination, factory=None, create=True)
+
+        stats = ReencryptStats()
+        state = self._load_checkpoint(source)
+        stats.failed = state['failed']
+        progress = _Progress(state['done'])
+
+        # bound the emails read ahead of the workers
+        slots = threading.BoundedSemaphore(self.workers * 2)
+        errors = []
+
+        def done(result):
+            index, error = result
+            if error is None:
+                progress.add(index)
+            else:
+                errors.append(error)
+            slots.release()
+
+        pool = ThreadPool(self.workers)
+        last_report = time.time()
+        try:
+            for index in range(state['done'], len(keys)):
+                slots.acquire()
+                if errors:
+                    break
+                try:
+                    raw = _get_bytes(box, keys[index])
+                    pool.apply_async(
+                        self._process, (index, raw, destination, stats),
+                        callback=done)
+                except Exception:
+                    slots.release()
+                    raise
+
+                if progress.pending_checkpoint >= self.checkpoint_every:
+                    self._save_checkpoint(source, progress, stats)
+                if (self.report is not None and
+                        time.time() - last_report >= self.report_every):
+                    last_report = time.time()
+                    self.report(stats.copy())
+        finally:
+            pool.close()
+            pool.join()
+            box.close()
+            self._save_checkpoint(source, progress, stats)
+        if errors:
+            raise errors[0]
+
+        stats.elapsed = time.time() - stats.started
+        if self.report is not None:
+            self.report(stats.copy())
+        return stats
+
+    def reencrypt(self, raw):
+        """
+        Re-encrypt one email.
+
+        :param raw: the email
+        :type raw: bytes
+
+        :return: the re-encrypted email, or None if it's not encrypted
+        :rtype: bytes
+        """
+        if classify(raw).protection != ENCRYPTED:
+            return None
+
+        msg = BytesParser().parsebytes(raw)
+        encpart = msg.get_payload(1)
+        body = _Source(msg, raw).body_span(encpart)
+        if body is None:
+            raise ValueError('Malformed encrypted part')
+
+        decryption = self.old_openpgp.decrypt_verify(encpart.get_payload())
+        signaddr = None
+        if decryption.signed:
+            if not decryption.valid:
+                raise ValueError('The signature of the email is not valid')
+            if self.signaddr is None:
+                raise ValueError('The email is signed and there is no '
+                                 'address to sign it again')
+            signaddr = self.signaddr
+        args, kwargs = encrypt_args(decryption.data,
+                                    self._encryption_addresses(msg),
+                                    signaddr)
+        encrypted = self.new_openpgp.encrypt(*args, **kwargs)
+        if not isinstance(encrypted, bytes):
+            encrypted = encrypted.encode('ascii')
+        start, end = body
+        if raw[start - 2:start] == b'\r\n':
+            encrypted = encrypted.replace(b'\r\n', b'\n').replace(
+                b'\n', b'\r\n')
+        # the rest of the email is kept byte by byte
+        return raw[:start] + encrypted + raw[end:]
+
+    def _encryption_addresses(self, msg):
+        addresses = list(self.recipients(msg))
+        if self.owner.lower() not in [a.lower() for a in addresses]:
+            addresses.append(self.owner)
+        return addresses
+
+    def _process(self, index, raw, destination, stats):
+        """
+        Re-encrypt and write an email.
+
+        :return: the index of the email and the error writing it, if any
+        :rtype: (int, Exception)
+        """
+        try:
+            data = self.reencrypt(raw)
+        except Exception as e:
+            logger.error('Failed to re-encrypt email %s: %s' % (index, e))
+            data = None
+            stats.record(raw, None, index)
+        else:
+            stats.record(raw, data)
+
+        try:
+            _write_atomic(destination, '%08d.reencrypted' % (index,),
+                          raw if data is None else data)
+        except Exception as e:
+            return index, e
+        return index, None
+
+    def _load_checkpoint(self, source):
+        state = {'source': source, 'done': 0, 'failed': []}
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return state
+        with open(self.checkpoint) as f:
+            saved = json.load(f)
+        if saved.get('source') != source:
+            raise ValueError('The checkpoint is for another source: %s'
+                             % (saved.get('source'),))
+        state.update(saved)
+        return state
+
+    def _save_checkpoint(self, source, progress, stats):
+        done = progress.checkpoint()
+        if self.checkpoint is None:
+            return
+        state = {
+            'source': source,
+            'done': done,
+            'failed': sorted(i for i in stats.failed if i < done),
+        }
+        directory, name = os.path.split(os.path.abspath(self.checkpoint))
+        write_atomic(directory, name, json.dumps(state).encode('utf-8'))
+
+
+class ReencryptStats(object):
+    """
+    Progress of a re-encryption.
+    """
+
+    FIELDS = ('messages', 'reencrypted', 'copied', 'bytes', 'failed',
+              'started', 'elapsed')
+
+    def __init__(self):
+        self.messages = 0
+        self.reencrypted = 0
+        self.copied = 0
+        self.bytes = 0
+        self.failed = []
+        self.started = time.time()
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        """
+        Emails per second.
+        """
+        return self.messages / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def throughput(self):
+        """
+        Bytes read per second.
+        """
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def record(self, raw, reencrypted, failed=None):
+        with self._lock:
+            self.messages += 1
+            self.bytes += len(raw)
+            if failed is not None:
+                self.failed.append(failed)
+            elif reencrypted is None:
+                self.copied += 1
+            else:
+                self.reencrypted += 1
+            self.elapsed = time.time() - self.started
+
+    def copy(self):
+        stats = ReencryptStats()
+        with self._lock:
+            for field in self.FIELDS:
+                setattr(stats, field, getattr(self, field))
+            stats.failed = list(self.failed)
+        return stats
+
+    def __repr__(self):
+        return ('<ReencryptStats: emails(%s) reencrypted(%s) failed(%s) '
+                '%.1f emails/s %.1f KB/s>' % (
+                    self.messages, self.reencrypted, len(self.failed),
+                    self.rate, self.throughput / 1024))
+
+
+class _Progress(object):
+    """
+    Track the emails done to find the first one not done yet.
+    """
+
+    def __init__(self, start):
+        self._next = start
+        self._saved = start
+        self._done = set()
+        self._lock = threading.Lock()
+
+    def add(self, index):
+        with self._lock:
+            self._done.add(index)
+            while self._next in self._done:
+                self._done.remove(self._next)
+                self._next += 1
+
+    @property
+    def pending_checkpoint(self):
+        return self._next - self._saved
+
+    def checkpoint(self):
+        with self._lock:
+            self._saved = self._next
+            return self._next
+
+
+def _get_bytes(box, key):
+    if hasattr(box, 'get_bytes'):
+        return box.get_bytes(key)
+    return box.get_string(key)
+
+
+def _write_atomic(maildir, name, data):
+    """
+    Deliver data into the Maildir, it's written into tmp and moved into new
+    once it's on disk.
+    """
+    write_atomic(os.path.join(maildir, 'new'), name, data,
+                 tmpdir=os.path.join(maildir, 'tmp'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Re-encrypt the emails of an archive to new keys.')
+    parser.add_argument('old_homedir', help='gpg homedir with the old keys')
+    parser.add_argument('new_homedir', help='gpg homedir with the new keys')
+    parser.add_argument('source', help='mbox file or Maildir to read')
+    parser.add_argument('destination', help='Maildir to write')
+    parser.add_argument('--owner', required=True,
+                        help='address of the owner of the archive, the '
+                             'emails are always encrypted to it')
+    parser.add_argument('--sign-as', dest='signaddr',
+                        help='address to sign again the signed emails as')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--checkpoint',
+                        help='file to save the progress, to resume later')
+    args = parser.parse_args(argv)
+
+    from memoryhole.gpg import Gnupg
+
+    def report(stats):
+        sys.stderr.write('%s\n' % (stats,))
+
+    reencrypter = Reencrypter(
+        Gnupg(args.old_homedir), Gnupg(args.new_homedir), args.owner,
+        signaddr=args.signaddr, workers=args.workers,
+        checkpoint=args.checkpoint, report=report)
+    stats = reencrypter.run(args.source, args.destination)
+    return 1 if stats.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
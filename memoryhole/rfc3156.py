@@ -21,6 +21,7 @@ Implements RFC 3156: MIME Security with OpenPGP.
 
 import base64
 import logging
+import re
 try:
         from StringIO import StringIO
 except ImportError:
@@ -29,6 +30,7 @@ except ImportError:
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email import errors
+from email.header import Header
 from email.generator import (
     Generator,
     fcre,
@@ -36,6 +38,18 @@ from email.generator import (
     _make_boundary,
 )
 
+from memoryhole.walk import DEFAULT_LIMITS, walk
+
+try:
+    _encodebytes = base64.encodebytes
+except AttributeError:  # python 2
+    _encodebytes = base64.encodestring
+
+try:
+    basestring
+except NameError:  # python 3
+    basestring = str
+
 
 #
 # A generator that solves http://bugs.python.org/issue14983
@@ -48,8 +62,30 @@ class RFC3156CompliantGenerator(Generator):
 
     This is just a copy of email.generator.Generator which fixes the following
     bug: http://bugs.python.org/issue14983
+
+    Like the parent it flattens each part with a clone of itself, recursing
+    on the tree, so the email is checked against the limits keyword argument
+    (DEFAULT_LIMITS by default) before writing anything: the depth limit
+    keeps the recursion bounded.
     """
 
+    def __init__(self, outfp, *args, **kwargs):
+        self.limits = kwargs.pop('limits', DEFAULT_LIMITS)
+        self._nested = False
+        Generator.__init__(self, outfp, *args, **kwargs)
+
+    def flatten(self, msg, *args, **kwargs):
+        if not self._nested and self.limits is not None:
+            self.limits.check(msg)
+        return Generator.flatten(self, msg, *args, **kwargs)
+
+    def clone(self, fp):
+        g = Generator.clone(self, fp)
+        # the whole email was checked already
+        g._nested = True
+        g.limits = self.limits
+        return g
+
     def _handle_multipart(self, msg):
         """
         A multipart handling implementation that addresses issue #14983.
@@ -133,19 +169,24 @@ def _bencode(s):
     # newline".  Blech!
     if not s:
         return s
-    value = base64.encodestring(s)
-    return value[:-1]
+    value = _encodebytes(s)[:-1]
+    if not isinstance(value, str):
+        value = value.decode('ascii')
+    return value
 
 
-def encode_base64(msg):
+def encode_base64(msg, cache=None):
     """
     Encode a non-multipart message's payload in Base64 (in place).
 
     This method modifies the message contents in place and adds or replaces an
-    appropriate Content-Transfer-Encoding header.
+    appropriate Content-Transfer-Encoding header. If a cache is given payloads
+    encoded before are taken from it.
 
     :param msg: The non-multipart message to be encoded.
     :type msg: email.message.Message
+    :param cache: The cache of encoded payloads.
+    :type cache: memoryhole.cache.EncodingCache
     """
     encoding = msg.get('Content-Transfer-Encoding', None)
     if encoding is not None:
@@ -157,32 +198,127 @@ def encode_base64(msg):
     # now, if content is already encoded as base64 or if it is encoded with
     # some unknown encoding, we just pass.
     if encoding in [None, 'quoted-printable', 'x-uuencode', 'uue', 'x-uue']:
-        orig = msg.get_payload(decode=True)
-        encdata = _bencode(orig)
+        key = encdata = None
+        if cache is not None:
+            key = cache.key(msg.get_payload(), encoding)
+        if key is not None:
+            encdata = cache.get(key)
+        if encdata is None:
+            orig = msg.get_payload(decode=True)
+            encdata = _bencode(orig)
+            if key is not None:
+                cache.put(key, encdata)
         msg.set_payload(encdata)
         # replace or set the Content-Transfer-Encoding header.
         try:
             msg.replace_header('Content-Transfer-Encoding', 'base64')
         except KeyError:
             msg['Content-Transfer-Encoding'] = 'base64'
-    elif encoding is not 'base64':
-        logging.err('Unknown content-transfer-encoding: %s' % encoding)
+    elif encoding != 'base64':
+        logging.error('Unknown content-transfer-encoding: %s' % encoding)
 
 
-def encode_base64_rec(msg):
+def encode_base64_rec(msg, limits=None, cache=None):
     """
     Encode (possibly multipart) messages in base64 (in place).
 
-    This method modifies the message contents in place.
+    This method modifies the message contents in place. If limits are given
+    the message is checked against them before encoding any part.
 
     :param msg: The non-multipart message to be encoded.
     :type msg: email.message.Message
+    :param limits: The limits for the message.
+    :type limits: memoryhole.walk.MIMELimits
+    :param cache: The cache of encoded payloads.
+    :type cache: memoryhole.cache.EncodingCache
+    """
+    if limits is not None:
+        limits.check(msg)
+    for visit in walk(msg):
+        if not visit.part.is_multipart():
+            encode_base64(visit.part, cache)
+
+
+def fold_headers(msg, maxheaderlen=76):
+    """
+    Fold the headers of msg and its subparts in place, as signed_text folds
+    them.
+
+    The folded headers are written as they are by any generator folding
+    at maxheaderlen or more, or not folding, so the signed text is the text
+    the email is sent with and signatures can be verified over the bytes
+    received.
+
+    :param msg: The message to be signed.
+    :type msg: email.message.Message
+    :param maxheaderlen: The length headers are folded at.
+    :type maxheaderlen: int
+    """
+    for visit in walk(msg):
+        part = visit.part
+        if part.is_multipart() and not part.get_boundary():
+            # generators would add it unfolded
+            part.set_boundary(_make_boundary())
+        part._headers = [(name, _fold(name, value, maxheaderlen))
+                         for name, value in part._headers]
+
+
+def _fold(name, value, maxheaderlen):
+    try:
+        # the first folding might leave whitespace at the end, that the
+        # next one removes
+        for _ in range(2):
+            value = Header(value, maxlinelen=maxheaderlen,
+                           header_name=name).encode()
+    except UnicodeError:
+        # raw 8bit data, generators don't fold it
+        pass
+    return value
+
+
+def signed_text(msg, limits=DEFAULT_LIMITS):
+    """
+    Get the text of msg to be signed or verified.
+
+    The message is flattened with its headers and line endings converted to
+    <CR><LF> as required by RFC 3156. The payloads should already be encoded
+    (see encode_base64_rec).
+
+    :param msg: The message to be signed.
+    :type msg: email.message.Message
+    :param limits: The limits for the message, None if it was checked
+                   already.
+    :type limits: memoryhole.walk.MIMELimits
+
+    :return: the canonical text of the message
+    :rtype: str
+    """
+    # get message text with headers and replace \n for \r\n
+    fp = StringIO()
+    g = RFC3156CompliantGenerator(fp, mangle_from_=False, maxheaderlen=76,
+                                  limits=limits)
+    g.flatten(msg)
+    return canonical_text(msg, fp.getvalue())
+
+
+def canonical_text(msg, text):
+    """
+    Convert text, msg flattened by RFC3156CompliantGenerator, into the text
+    to be signed or verified.
+
+    :param msg: The message flattened.
+    :type msg: email.message.Message
+    :param text: The flattened message.
+    :type text: str
+
+    :return: the canonical text of the message
+    :rtype: str
     """
-    if not msg.is_multipart():
-        encode_base64(msg)
-    else:
-        for sub in msg.get_payload():
-            encode_base64_rec(sub)
+    msgtext = re.sub('\r?\n', '\r\n', text)
+    # make sure signed message ends with \r\n as per OpenPGP stantard.
+    if msg.is_multipart() and not msgtext.endswith("\r\n"):
+        msgtext += "\r\n"
+    return msgtext
 
 
 #
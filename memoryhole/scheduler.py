@@ -0,0 +1,250 @@
+import heapq
+import itertools
+import threading
+import time
+
+from memoryhole.protection import protect
+
+
+class DeadlineExceeded(RuntimeError):
+    """
+    Raised when a job could not start before its deadline.
+    """
+
+
+class ProtectScheduler(object):
+
+    def __init__(self, classes, workers=4, config=None):
+        """
+        Schedule protect jobs of different priority classes on a fixed
+        number of worker threads.
+
+        Each class has a weight and a maximum number of jobs running at the
+        same time. Free workers are shared between the classes with queued
+        jobs proportionally to their weight (weighted fair queueing), so
+        bulk jobs can use all the capacity left by interactive ones without
+        delaying them. Leaving some workers out of the concurrency of bulk
+        classes keeps them free for interactive jobs.
+
+        Inside a class jobs are run by earliest deadline first, and jobs that
+        can't start before their deadline fail with DeadlineExceeded without
+        running.
+
+        :param classes: the weight and maximum concurrency of each class, a
+                        None concurrency means no limit
+        :type classes: {str: (int, int)}
+        :param workers: number of worker threads
+        :type workers: int
+        :param config: default configuration of the jobs
+        :type config: ProtectConfig
+        """
+        self.config = config
+        self._classes = dict(
+            (name, _Class(name, weight, max_concurrency))
+            for name, (weight, max_concurrency) in classes.items())
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._closed = False
+
+        self._workers = []
+        for _ in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, msg, priority, deadline=None, encrypt=True,
+               sign=False, config=None):
+        """
+        Queue msg to be protected.
+
+        :param msg: the email to be protected
+        :type msg: Message
+        :param priority: the name of the class of the job
+        :type priority: str
+        :param deadline: time.time() by which the job must start, None for
+                         no deadline
+        :type deadline: float
+        :param encrypt: should the message be encrypted
+        :type encrypt: bool
+        :param sign: should the encrypted message be signed too
+        :type sign: bool
+        :param config: the configuration for this job
+        :type config: ProtectConfig
+
+        :return: the queued job
+        :rtype: Job
+        """
+        if config is None:
+            config = self.config
+        job = Job(msg, encrypt, sign, config, deadline)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('The scheduler is closed')
+            cls = self._classes[priority]
+            if not cls.queue:
+                # an idle class doesn't keep credit from the time it was idle
+                cls.vtime = max(cls.vtime, self._min_vtime())
+            order = deadline if deadline is not None else float('inf')
+            heapq.heappush(cls.queue, (order, next(self._seq), job))
+            self._cond.notify()
+        return job
+
+    def stats(self):
+        """
+        Get the queue stats of every class.
+
+        :return: for each class the number of queued, running, done and
+                 expired jobs, and the mean and max seconds jobs waited in
+                 the queue
+        :rtype: {str: dict}
+        """
+        with self._cond:
+            return dict((name, cls.stats())
+                        for name, cls in self._classes.items())
+
+    def close(self, wait=True):
+        """
+        Stop the workers once the queued jobs are done.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                cls, job = self._next_job()
+                while job is None:
+                    if self._closed and not self._queued():
+                        return
+                    self._cond.wait()
+                    cls, job = self._next_job()
+                cls.running += 1
+
+            try:
+                job._run()
+            finally:
+                with self._cond:
+                    cls.running -= 1
+                    cls.done += 1
+                    self._cond.notify()
+
+    def _next_job(self):
+        """
+        Pop the next job to run, expiring the ones past their deadline.
+        """
+        while True:
+            eligible = [cls for cls in self._classes.values()
+                        if cls.queue and not cls.full()]
+            if not eligible:
+                return None, None
+            cls = min(eligible, key=lambda c: (c.vtime, c.name))
+            _, _, job = heapq.heappop(cls.queue)
+
+            now = time.time()
+            if job.deadline is not None and now > job.deadline:
+                cls.expired += 1
+                job._fail(DeadlineExceeded('Deadline passed in the queue'))
+                continue
+
+            cls.vtime += 1.0 / cls.weight
+            cls.record_wait(now - job.submitted)
+            return cls, job
+
+    def _min_vtime(self):
+        active = [cls.vtime for cls in self._classes.values() if cls.queue]
+        return min(active) if active else 0
+
+    def _queued(self):
+        return any(cls.queue for cls in self._classes.values())
+
+
+class Job(object):
+    """
+    A protect job queued in the scheduler.
+    """
+
+    def __init__(self, msg, encrypt, sign, config, deadline):
+        self.msg = msg
+        self.encrypt = encrypt
+        self.sign = sign
+        self.config = config
+        self.deadline = deadline
+        self.submitted = time.time()
+        self.started = None
+
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def result(self, timeout=None):
+        """
+        Wait for the job to finish.
+
+        :return: the protected email
+        :rtype: Message
+
+        :raises: the exception raised by protect, DeadlineExceeded if the job
+                 didn't start on time or RuntimeError on timeout
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timeout waiting for the job')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def done(self):
+        return self._done.is_set()
+
+    def _run(self):
+        self.started = time.time()
+        try:
+            self._result = protect(self.msg, encrypt=self.encrypt,
+                                   config=self.config, sign=self.sign)
+        except Exception as e:
+            self._error = e
+        self._done.set()
+
+    def _fail(self, error):
+        self._error = error
+        self._done.set()
+
+
+class _Class(object):
+
+    def __init__(self, name, weight, max_concurrency):
+        self.name = name
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.queue = []
+        self.vtime = 0
+        self.running = 0
+        self.done = 0
+        self.expired = 0
+        self._waited = 0.0
+        self._started = 0
+        self._max_wait = 0.0
+
+    def full(self):
+        return (self.max_concurrency is not None and
+                self.running >= self.max_concurrency)
+
+    def record_wait(self, wait):
+        self._waited += wait
+        self._started += 1
+        self._max_wait = max(self._max_wait, wait)
+
+    def stats(self):
+        mean_wait = self._waited / self._started if self._started else 0.0
+        return {
+            'queued': len(self.queue),
+            'running': self.running,
+            'done': self.done,
+            'expired': self.expired,
+            'mean_wait': mean_wait,
+            'max_wait': self._max_wait,
+        }
@@ -0,0 +1,298 @@
+"""
+Record the profile of slow protect and unwrap operations.
+
+A SlowOpRecorder given to ProtectConfig (or to unwrap) times every
+operation. Operations slower than its threshold get a stack profile, sampled
+from a watcher thread while they run past the threshold, and a random sample
+of the operations runs under cProfile. Each recorded operation keeps the
+shape of its email (see message_shape) in a bounded ring buffer, ready to be
+dumped when an outlier needs to be diagnosed.
+"""
+import cProfile
+import json
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque, namedtuple
+from email.utils import getaddresses
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from memoryhole.walk import walk
+
+
+SlowOp = namedtuple("SlowOp", (
+    "operation", "started", "seconds", "reason", "shape", "profile",
+    "stacks", "error"))
+
+SLOW = 'slow'
+SAMPLED = 'sampled'
+
+
+class SlowOpRecorder(object):
+
+    def __init__(self, threshold=1.0, sample_rate=0.0, max_records=100,
+                 interval=0.01, max_stacks=20, max_parts=100):
+        """
+        Recorder of slow operations and a sample of the rest.
+
+        While an operation runs for more than threshold seconds its stack is
+        sampled every interval seconds, once it's done the max_stacks most
+        frequent stacks are recorded. A sample_rate fraction of the
+        operations is run under cProfile and recorded even if they are
+        fast, to compare the outliers with.
+
+        Only the last max_records operations are kept. The records don't
+        have any content, address or header value of the emails, only
+        their shape.
+
+        :param threshold: seconds an operation takes to be recorded, None
+                          to only record the sampled ones
+        :type threshold: float
+        :param sample_rate: fraction of the operations profiled
+        :type sample_rate: float
+        :param max_records: size of the ring buffer of records
+        :type max_records: int
+        :param interval: seconds between stack samples of slow operations
+        :type interval: float
+        :param max_stacks: number of distinct stacks kept in each record
+        :type max_stacks: int
+        :param max_parts: number of parts described in each shape
+        :type max_parts: int
+        """
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.max_parts = max_parts
+        self.recorded = 0
+
+        self._records = deque(maxlen=max_records)
+        self._active = {}
+        self._lock = threading.Lock()
+        self._busy = threading.Event()
+        self._watcher = None
+        self._pid = None
+
+    def record(self, operation, msg, function, *args, **kwargs):
+        """
+        Call function timing it, and record it if it's slow or sampled.
+
+        :param operation: name of the operation, like 'protect'
+        :type operation: str
+        :param msg: the email of the operation, for its shape
+        :type msg: Message
+        :param function: the operation
+        :type function: callable
+
+        :return: what function returns
+        """
+        profiler = None
+        if self.sample_rate and random.random() < self.sample_rate:
+            profiler = cProfile.Profile()
+
+        active = None
+        if self.threshold is not None:
+            active = _Active(threading.current_thread().ident)
+            self._watch(active)
+
+        error = None
+        started = time.time()
+        try:
+            if profiler is not None:
+                try:
+                    profiler.enable()
+                except ValueError:
+                    # another profiler is running in this thread
+                    profiler = None
+            return function(*args, **kwargs)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            seconds = time.time() - started
+            if active is not None:
+                with self._lock:
+                    del self._active[id(active)]
+
+            slow = self.threshold is not None and seconds >= self.threshold
+            if slow or profiler is not None:
+                self._add(SlowOp(
+                    operation, started, seconds,
+                    SLOW if slow else SAMPLED,
+                    message_shape(msg, self.max_parts),
+                    _profile_text(profiler),
+                    active.top(self.max_stacks) if active is not None else [],
+                    error))
+
+    def records(self):
+        """
+        The recorded operations, oldest first.
+
+        :rtype: [SlowOp]
+        """
+        with self._lock:
+            return list(self._records)
+
+    def dump(self, fp=None):
+        """
+        Dump the records as JSON.
+
+        :param fp: file to write them to, if not given they are returned
+        :type fp: file
+
+        :return: the JSON text if fp is not given
+        :rtype: str
+        """
+        records = [record._asdict() for record in self.records()]
+        if fp is None:
+            return json.dumps(records, indent=1)
+        json.dump(records, fp, indent=1)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def _add(self, record):
+        with self._lock:
+            self._records.append(record)
+            self.recorded += 1
+
+    def _watch(self, active):
+        with self._lock:
+            self._active[id(active)] = active
+            self._busy.set()
+            # the watcher doesn't survive a fork
+            if self._watcher is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._watcher = threading.Thread(target=self._sample)
+                self._watcher.daemon = True
+                self._watcher.start()
+
+    def _sample(self):
+        """
+        Sample the stacks of the operations running past the threshold.
+        """
+        while True:
+            self._busy.wait()
+            now = time.time()
+            with self._lock:
+                active = list(self._active.values())
+                if not active:
+                    # clearing it here and not when every operation ends
+                    # doesn't wake up this thread for each one
+                    self._busy.clear()
+                    continue
+            late = [a for a in active
+                    if now - a.started >= self.threshold]
+            if late:
+                frames = sys._current_frames()
+                with self._lock:
+                    # the ones done meanwhile already took their stacks
+                    for a in late:
+                        frame = frames.get(a.thread)
+                        if id(a) in self._active and frame is not None:
+                            a.add(_stack(frame))
+                frames = None
+            if late:
+                time.sleep(self.interval)
+            else:
+                # until the first one gets late
+                first = min(a.started for a in active)
+                time.sleep(max(first + self.threshold - now, 0))
+
+
+class _Active(object):
+    """
+    An operation running, with the stacks sampled from it.
+    """
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.started = time.time()
+        self.stacks = Counter()
+
+    def add(self, stack):
+        self.stacks[stack] += 1
+
+    def top(self, count):
+        return [[stack, n] for stack, n in self.stacks.most_common(count)]
+
+
+def message_shape(msg, max_parts=100):
+    """
+    Describe the structure of msg without its content.
+
+    The shape has the content type, depth, size of the payload and number
+    of headers of the first max_parts parts, and the total number of parts,
+    bytes, headers and recipients in them. The walk stops there, so a huge
+    email doesn't make recording it slow too, truncated says if there were
+    more parts. No header value, address or file name is included.
+
+    :param msg: the email
+    :type msg: Message
+    :param max_parts: maximum number of parts described
+    :type max_parts: int
+
+    :rtype: dict
+    """
+    parts = []
+    count = size = headers = 0
+    truncated = False
+    for visit in walk(msg):
+        if count >= max_parts:
+            truncated = True
+            break
+        part = visit.part
+        payload = part.get_payload()
+        length = 0
+        if not part.is_multipart() and payload is not None:
+            length = len(payload)
+        count += 1
+        size += length
+        headers += len(part)
+        parts.append([visit.depth, part.get_content_type(), length,
+                      len(part)])
+
+    recipients = getaddresses(msg.get_all('to', []) + msg.get_all('cc', []) +
+                              msg.get_all('bcc', []))
+    return {
+        'parts': parts,
+        'part_count': count,
+        'truncated': truncated,
+        'size': size,
+        'header_count': headers,
+        'top_headers': len(msg),
+        'recipients': len(recipients),
+    }
+
+
+def _stack(frame, limit=64):
+    """
+    The functions in the stack of frame, outermost first, separated by ;.
+    """
+    functions = []
+    while frame is not None and len(functions) < limit:
+        code = frame.f_code
+        functions.append('%s:%s:%s' % (
+            os.path.basename(code.co_filename), frame.f_lineno,
+            code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(functions))
+
+
+def _profile_text(profiler, limit=30):
+    if profiler is None:
+        return None
+    out = StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
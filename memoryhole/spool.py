@@ -0,0 +1,393 @@
+"""
+Durable spool directory to protect emails with worker processes.
+
+Usage:
+
+    python -m memoryhole.spool [--workers N] [--homedir HOMEDIR] SPOOL
+
+Emails submitted to the spool are protected by the workers and the protected
+emails are written into SPOOL/outgoing, named by the id returned on submit.
+"""
+import argparse
+import errno
+import itertools
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import time
+from email.errors import MessageError
+from email.message import Message
+from email.parser import BytesParser
+from functools import partial
+
+from memoryhole.files import fsync_dir, write_atomic
+from memoryhole.protection import protect_to_file, ProtectConfig
+from memoryhole.walk import MIMELimitError
+
+
+logger = logging.getLogger(__name__)
+
+TMP = 'tmp'
+INCOMING = 'incoming'
+ACTIVE = 'active'
+OUTGOING = 'outgoing'
+FAILED = 'failed'
+
+
+class ProtectSpool(object):
+
+    # errors of malformed emails, retrying them won't help
+    PERMANENT_ERRORS = (MIMELimitError, MessageError, UnicodeError)
+
+    def __init__(self, path, config=None, workers=4, max_attempts=5,
+                 backoff=30, max_backoff=3600, batch=100, poll=1.0):
+        """
+        A spool directory of emails to be protected, that survives crashes
+        and restarts.
+
+        Emails are written into tmp and moved into incoming once they are on
+        disk. A worker claims an email moving it into active, protects it
+        into tmp and moves the protected email into outgoing, the renames
+        are fsync'd before the email is removed from active. If a worker
+        dies the emails it claimed go back into incoming, so an email is
+        never lost, but it might be protected twice, the second time
+        replaces the first one in outgoing.
+
+        Failed emails are retried with exponential backoff, starting with
+        backoff seconds up to max_backoff. After max_attempts, or on the
+        first PERMANENT_ERRORS, the email is moved into failed with a .error
+        file next to it (dead letters).
+
+        Each worker lists incoming once for every batch of emails instead of
+        once per email. Only one ProtectSpool should run workers on a spool
+        directory at the same time.
+
+        :param path: the spool directory, created if it doesn't exist
+        :type path: str
+        :param config: the configuration to protect the emails, or a
+                       callable returning it called in every worker process
+        :type config: ProtectConfig or callable
+        :param workers: number of worker processes
+        :type workers: int
+        :param max_attempts: times an email is tried before giving up
+        :type max_attempts: int
+        :param backoff: seconds to wait before the first retry
+        :type backoff: float
+        :param max_backoff: maximum seconds between retries
+        :type max_backoff: float
+        :param batch: maximum emails claimed from each directory listing
+        :type batch: int
+        :param poll: seconds to wait when there are no emails ready
+        :type poll: float
+        """
+        self.path = path
+        self.config = config
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.batch = batch
+        self.poll = poll
+        self._stop = multiprocessing.Event()
+        self._seq = itertools.count()
+
+        for name in (TMP, INCOMING, ACTIVE, OUTGOING, FAILED):
+            directory = self._dir(name)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def submit(self, msg, encrypt=True, sign=False):
+        """
+        Queue msg to be protected, it's on disk when submit returns.
+
+        :param msg: the email to be protected
+        :type msg: Message or str or bytes
+        :param encrypt: should the message be encrypted
+        :type encrypt: bool
+        :param sign: should the encrypted message be signed too
+        :type sign: bool
+
+        :return: the id of the email, the name of the protected email in
+                 outgoing
+        :rtype: str
+        """
+        if isinstance(msg, Message):
+            msg = msg.as_string()
+        if not isinstance(msg, bytes):
+            msg = msg.encode('utf-8')
+
+        now = time.time()
+        ident = '%d.M%06dP%dQ%d.%s' % (
+            now, (now % 1) * 1000000, os.getpid(), next(self._seq),
+            _hostname())
+        flags = ('E' if encrypt else '') + ('S' if sign else '')
+        write_atomic(self._dir(INCOMING), _name(ident, flags, 0, 0), msg,
+                     tmpdir=self._dir(TMP))
+        return ident
+
+    def run(self, until_empty=False):
+        """
+        Protect the queued emails with the worker processes until stop is
+        called, restarting the workers that die.
+
+        :param until_empty: return once there are no emails left to protect
+        :type until_empty: bool
+        """
+        self.recover()
+        self._stop.clear()
+        workers = {}
+        empty = 0
+        try:
+            while not self._stop.is_set():
+                for pid, worker in list(workers.items()):
+                    if not worker.is_alive():
+                        worker.join()
+                        del workers[pid]
+                        self._requeue(pid, 'Worker exited with code %s'
+                                      % (worker.exitcode,))
+                while len(workers) < self.workers:
+                    worker = multiprocessing.Process(target=self._work)
+                    worker.daemon = True
+                    worker.start()
+                    workers[worker.pid] = worker
+
+                # emails move between directories while they are listed,
+                # only trust two empty listings in a row
+                empty = empty + 1 if self._empty() else 0
+                if until_empty and empty >= 2:
+                    break
+                self._stop.wait(self.poll)
+        finally:
+            self._stop.set()
+            for worker in workers.values():
+                worker.join()
+            self.recover()
+
+    def stop(self):
+        """
+        Stop the workers once they are done with their current email.
+        """
+        self._stop.set()
+
+    def process(self, config=None):
+        """
+        Protect a batch of the queued emails ready to be tried, in the
+        current process. This is what every worker does in a loop.
+
+        :param config: the configuration, by default the one of the spool
+        :type config: ProtectConfig
+
+        :return: the number of emails claimed
+        :rtype: int
+        """
+        if config is None:
+            config = self._config()
+        return self._batch(config, lambda: False)
+
+    def recover(self):
+        """
+        Move the emails claimed by workers no longer running back into
+        incoming, counting it as a failed attempt: an email that kills its
+        workers ends up in failed too. run does it when it starts and stops.
+        """
+        for claimed in os.listdir(self._dir(ACTIVE)):
+            self._failed(claimed, RuntimeError(
+                'Claimed by a worker no longer running'))
+
+    def counts(self):
+        """
+        Count the emails in each stage.
+
+        :return: the number of emails incoming, active, outgoing and failed
+        :rtype: dict
+        """
+        counts = dict((name, len(os.listdir(self._dir(name))))
+                      for name in (INCOMING, ACTIVE, OUTGOING))
+        counts[FAILED] = len([name for name in os.listdir(self._dir(FAILED))
+                              if not name.endswith('.error')])
+        return counts
+
+    def _work(self):
+        config = self._config()
+        while not self._stop.is_set():
+            if not self._batch(config, self._stop.is_set):
+                self._stop.wait(self.poll)
+
+    def _batch(self, config, stopped):
+        claimed = 0
+        for name in self._scan():
+            if stopped():
+                break
+            if self._process(name, config):
+                claimed += 1
+        return claimed
+
+    def _config(self):
+        config = self.config
+        if callable(config):
+            config = config()
+        if config is None:
+            config = ProtectConfig()
+        return config
+
+    def _scan(self):
+        """
+        List the emails ready to be tried, oldest first.
+
+        :rtype: [str]
+        """
+        now = time.time()
+        ready = []
+        for name in os.listdir(self._dir(INCOMING)):
+            try:
+                not_before = _parse(name)[3]
+            except ValueError:
+                # not queued by a spool
+                continue
+            if not_before <= now:
+                ready.append((not_before, name))
+        ready.sort()
+        return [name for _, name in ready[:self.batch]]
+
+    def _process(self, name, config):
+        """
+        Claim and protect an email.
+
+        :return: if the email was claimed, another worker might have taken
+                 it first
+        :rtype: bool
+        """
+        claimed = '%d-%s' % (os.getpid(), name)
+        path = os.path.join(self._dir(ACTIVE), claimed)
+        try:
+            os.rename(os.path.join(self._dir(INCOMING), name), path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+
+        ident, flags, _, _ = _parse(name)
+        tmppath = os.path.join(self._dir(TMP), '.%s.protected' % (claimed,))
+        try:
+            with open(path, 'rb') as f:
+                msg = BytesParser().parse(f)
+            with open(tmppath, 'wb') as f:
+                protect_to_file(msg, f, 'E' in flags, config, 'S' in flags)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmppath, os.path.join(self._dir(OUTGOING), ident))
+            fsync_dir(self._dir(OUTGOING))
+        except Exception as e:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            self._failed(claimed, e)
+        else:
+            os.remove(path)
+        return True
+
+    def _requeue(self, pid, error):
+        """
+        Retry the emails claimed by the dead worker pid.
+        """
+        prefix = '%d-' % (pid,)
+        for claimed in os.listdir(self._dir(ACTIVE)):
+            if claimed.startswith(prefix):
+                self._failed(claimed, RuntimeError(error))
+
+    def _failed(self, claimed, error):
+        """
+        Move a claimed email back into incoming to be retried later, or into
+        failed if it shouldn't be tried again.
+        """
+        name = claimed.split('-', 1)[1]
+        ident, flags, attempts, _ = _parse(name)
+        attempts += 1
+        path = os.path.join(self._dir(ACTIVE), claimed)
+
+        if (attempts >= self.max_attempts or
+                isinstance(error, self.PERMANENT_ERRORS)):
+            logger.error('Giving up on email %s after %s attempts: %s'
+                         % (ident, attempts, error))
+            report = 'attempts: %s\nerror: %r\n' % (attempts, error)
+            write_atomic(self._dir(FAILED), ident + '.error',
+                         report.encode('utf-8'), tmpdir=self._dir(TMP))
+            os.rename(path, os.path.join(self._dir(FAILED), ident))
+            fsync_dir(self._dir(FAILED))
+            return
+
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        logger.warning('Failed to protect email %s, retrying in %ss: %s'
+                       % (ident, delay, error))
+        os.rename(path, os.path.join(
+            self._dir(INCOMING),
+            _name(ident, flags, attempts, time.time() + delay)))
+        fsync_dir(self._dir(INCOMING))
+
+    def _empty(self):
+        return not (os.listdir(self._dir(ACTIVE)) or
+                    os.listdir(self._dir(INCOMING)))
+
+    def _dir(self, name):
+        return os.path.join(self.path, name)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_seq']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._seq = itertools.count()
+
+
+def _name(ident, flags, attempts, not_before):
+    """
+    The name of an email in incoming, with its protection flags, the
+    attempts done and the time it can be tried again.
+    """
+    return '%s:%s,%d,%d' % (ident, flags, attempts, not_before)
+
+
+def _parse(name):
+    """
+    :return: the id, flags, attempts and time to try again of an email
+    :rtype: (str, str, int, int)
+    """
+    ident, info = name.rsplit(':', 1)
+    flags, attempts, not_before = info.split(',')
+    return ident, flags, int(attempts), int(not_before)
+
+
+def _hostname():
+    # like Maildir, without the characters used in the names
+    return (socket.gethostname().replace('/', r'\057')
+            .replace(':', r'\072').replace('-', r'\055'))
+
+
+def _gnupg_config(homedir):
+    from memoryhole.gpg import Gnupg
+    return ProtectConfig(Gnupg(homedir))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Protect the emails queued in a spool directory.')
+    parser.add_argument('spool', help='the spool directory')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--homedir', help='gpg homedir with the keys')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig()
+    config = partial(_gnupg_config, args.homedir)
+    spool = ProtectSpool(args.spool, config=config, workers=args.workers)
+    try:
+        spool.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parseaddr
+
+from zope.interface import implementer
+
+from memoryhole.gpg import Gnupg
+from memoryhole.openpgp import IOpenPGP
+from memoryhole.pool import OpenPGPPool
+from memoryhole.protection import _recipient_addresses
+
+
+class TenantRouter(object):
+
+    def __init__(self, homedir, factory=Gnupg, pool_size=2, max_tenants=64,
+                 max_metrics=1024, **pool_args):
+        """
+        Route the OpenPGP operations of each domain to its own keyring.
+
+        Every tenant (email domain) has its own gpg homedir, so key lookups
+        only go through the keys of that tenant, and its own OpenPGPPool of
+        backends. Only the pools of the max_tenants most recently used
+        tenants are kept, the rest are discarded and built again if needed.
+        The metrics of the max_metrics most recently used tenants are kept,
+        and at least the ones of the tenants with a pool.
+
+        Domains are validated before building their homedir, ValueError is
+        raised for anything but a DNS name.
+
+        :param homedir: the gpg homedir of a domain, a callable that gets
+                        the domain or a format string with a %s for it
+        :type homedir: callable or str
+        :param factory: callable that builds a backend for a homedir
+        :type factory: callable
+        :param pool_size: size of the pool of each tenant
+        :type pool_size: int
+        :param max_tenants: maximum number of tenant pools kept
+        :type max_tenants: int
+        :param max_metrics: maximum number of tenant metrics kept
+        :type max_metrics: int
+        :param pool_args: extra arguments for OpenPGPPool
+        """
+        if not callable(homedir):
+            template = homedir
+
+            def homedir(domain):
+                return template % (domain,)
+        self._homedir = homedir
+        self._factory = factory
+        self.pool_size = pool_size
+        self.max_tenants = max_tenants
+        self.max_metrics = max(max_metrics, max_tenants)
+        self._pool_args = pool_args
+
+        self._lock = threading.Lock()
+        self._tenants = OrderedDict()
+        self._metrics = OrderedDict()
+
+    def backend(self, domain):
+        """
+        Get the backend of a domain.
+
+        :param domain: the email domain of the tenant
+        :type domain: str
+
+        :rtype: IOpenPGP
+        """
+        domain = domain.lower()
+        if not _valid_domain(domain):
+            raise ValueError('Invalid domain %r' % (domain,))
+        with self._lock:
+            backend = self._tenants.pop(domain, None)
+            metrics = self._metrics.pop(domain, None)
+            if metrics is None:
+                metrics = TenantMetrics()
+            self._metrics[domain] = metrics
+            if backend is None:
+                backend = _TenantBackend(self._new_pool(domain), metrics)
+                metrics.pools += 1
+            self._tenants[domain] = backend
+
+            while len(self._tenants) > self.max_tenants:
+                evicted, _ = self._tenants.popitem(last=False)
+                self._metrics[evicted].evictions += 1
+            # both are in use order, the tenants are the newest metrics
+            while len(self._metrics) > self.max_metrics:
+                self._metrics.popitem(last=False)
+        return backend
+
+    def route(self, msg):
+        """
+        Get the backend for the sender of msg, or for its first recipient if
+        it has no sender.
+
+        Use it to build the configuration to protect msg:
+
+            protect(msg, config=ProtectConfig(openpgp=router.route(msg)))
+
+        :param msg: the email to be protected
+        :type msg: Message
+
+        :rtype: IOpenPGP
+        """
+        address = parseaddr(msg.get('from', ''))[1]
+        if '@' not in address:
+            recipients = _recipient_addresses(msg)
+            if not recipients:
+                raise ValueError('The email has no sender nor recipients')
+            address = recipients[0]
+        return self.backend(address.rpartition('@')[2])
+
+    def route_unwrap(self, msg, recipient=None):
+        """
+        Get the backend for the recipient of msg, the keys to decrypt it are
+        in the keyring of the recipient.
+
+        Use it to unwrap a received email:
+
+            unwrap(msg, router.route_unwrap(msg, rcpt_to))
+
+        :param msg: the email to be unwrapped
+        :type msg: Message
+        :param recipient: the address msg was delivered to, like the
+                          envelope recipient, by default the first recipient
+                          in its headers
+        :type recipient: str
+
+        :rtype: IOpenPGP
+        """
+        if recipient is None:
+            recipients = [r for r in _recipient_addresses(msg) if '@' in r]
+            if not recipients:
+                raise ValueError('The email has no recipients')
+            recipient = recipients[0]
+        return self.backend(recipient.rpartition('@')[2])
+
+    def metrics(self):
+        """
+        Get the metrics of every tenant.
+
+        :return: the metrics of each domain
+        :rtype: {str: TenantMetrics}
+        """
+        with self._lock:
+            return dict((domain, metrics.copy())
+                        for domain, metrics in self._metrics.items())
+
+    def __len__(self):
+        return len(self._tenants)
+
+    def _new_pool(self, domain):
+        homedir = self._homedir(domain)
+        factory = self._factory
+        return OpenPGPPool(lambda: factory(homedir), size=self.pool_size,
+                           **self._pool_args)
+
+
+class TenantMetrics(object):
+    """
+    Operations done by a tenant.
+    """
+
+    FIELDS = ('operations', 'errors', 'seconds', 'pools', 'evictions')
+
+    def __init__(self):
+        self.operations = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.pools = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, failed):
+        with self._lock:
+            self.operations += 1
+            self.seconds += seconds
+            if failed:
+                self.errors += 1
+
+    def copy(self):
+        metrics = TenantMetrics()
+        with self._lock:
+            for field in self.FIELDS:
+                setattr(metrics, field, getattr(self, field))
+        return metrics
+
+    def __repr__(self):
+        return '<TenantMetrics: ops(%s) errors(%s) seconds(%.3f)>' % (
+            self.operations, self.errors, self.seconds)
+
+
+def _valid_domain(domain):
+    """
+    Is domain a DNS name, so it's safe to build a path with it.
+    """
+    return len(domain) <= 253 and all(
+        _label.match(label) for label in domain.split('.'))
+
+
+_label = re.compile(r'^[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\Z')
+
+
+@implementer(IOpenPGP)
+class _TenantBackend(object):
+
+    def __init__(self, pool, metrics):
+        self.pool = pool
+        self._metrics = metrics
+
+    def encrypt(self, data, encraddr, signaddr=None, compression=None):
+        return self._run(self.pool.encrypt, data, encraddr, signaddr,
+                         compression)
+
+    def sign(self, data, signaddr=None):
+        return self._run(self.pool.sign, data, signaddr)
+
+    def decrypt(self, data):
+        return self._run(self.pool.decrypt, data)
+
+    def decrypt_verify(self, data):
+        return self._run(self.pool.decrypt_verify, data)
+
+    def verify(self, data, signature):
+        return self._run(self.pool.verify, data, signature)
+
+    def verify_signer(self, data, signature):
+        return self._run(self.pool.verify_signer, data, signature)
+
+    def key_addresses(self, key_id):
+        return self._run(self.pool.key_addresses, key_id)
+
+    def _run(self, method, *args):
+        start = time.time()
+        failed = True
+        try:
+            result = method(*args)
+            failed = False
+            return result
+        finally:
+            self._metrics.record(time.time() - start, failed)
@@ -0,0 +1,669 @@
+import os
+import re
+import threading
+from email.feedparser import BytesFeedParser
+from email.generator import Generator
+from email.message import Message
+from email.parser import BytesParser
+from email.utils import parseaddr
+from multiprocessing.pool import ThreadPool
+
+from memoryhole.classify import (
+    classify, ENCRYPTED, MAX_HEADER_SIZE, _header_end
+)
+from memoryhole.message import MemoryHoleMessage, ProtectionLevel
+from memoryhole.openpgp import decrypt_verify, key_addresses, verify_signer
+from memoryhole.protection import ProtectConfig, _recipient_addresses
+from memoryhole.walk import DEFAULT_LIMITS, PartCount, walk
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+PROTECTED_TYPES = ('multipart/signed', 'multipart/encrypted')
+
+_PARSE_CHUNK = 64 * 1024
+
+_line_end = re.compile(b'\r?\n')
+_empty_line = re.compile(b'\n\r?\n')
+
+# outer values of the headers replaced when encrypting
+REPLACEMENTS = dict(
+    (name, replace.replacement)
+    for name, replace in ProtectConfig.REPLACED_HEADERS.items()
+    if replace.replacement is not None)
+
+
+def unwrap(msg, openpgp, workers=4, limits=DEFAULT_LIMITS, recorder=None):
+    """
+    Unwrap an email replacing and verifying memory hole headers.
+
+    Every multipart/signed and multipart/encrypted part of the email is
+    unwrapped, the independent ones are verified and decrypted concurrently
+    on a pool of workers. Each unwrapped part is replaced by a
+    MemoryHoleMessage with its protection level, nested parts of msg are
+    replaced in place.
+
+    A part counts as signed by its sender only if the key that made the
+    signature has an uid with the address of the sender. Signatures are
+    verified over the bytes the signed parts were received with, so give
+    the email as bytes when possible: a Message is flattened again to find
+    them.
+
+    The email is checked against limits before unwrapping it, and so is the
+    content of each decrypted part, at the depth of the part and counting
+    its parts and bytes together with the ones already seen. MIMELimitError
+    is raised if they exceed them.
+
+    :param msg: the email to be unwrapped
+    :type msg: Message or bytes
+    :param openpgp: the implementation of openpgp to use for decryption and/or
+                    verification
+    :type openpgp: IOpenPGP
+    :param workers: maximum number of parts unwrapped at the same time
+    :type workers: int
+    :param limits: limits on the structure of the email, None for no limits
+    :type limits: MIMELimits
+    :param recorder: recorder of slow operations
+    :type recorder: SlowOpRecorder
+
+    :return: a decrypted email
+    :rtype: Message
+    """
+    raw = None
+    if not isinstance(msg, Message):
+        raw = _to_bytes(msg)
+        msg = BytesParser().parsebytes(raw)
+    if recorder is not None:
+        return recorder.record('unwrap', msg, _unwrap_checked, msg, openpgp,
+                               workers, limits, raw)
+    return _unwrap_checked(msg, openpgp, workers, limits, raw)
+
+
+def _unwrap_checked(msg, openpgp, workers, limits, raw=None):
+    count = PartCount()
+    if limits is not None:
+        limits.check(msg, count=count)
+    source = _Source(msg, raw) if raw is not None else None
+    return _unwrap(msg, openpgp, workers, msg, limits, source=source,
+                   count=count)
+
+
+def _unwrap(msg, openpgp, workers, root, limits, depth=0, source=None,
+            count=None):
+    """
+    Unwrap the protected parts of msg, source has the bytes msg was parsed
+    from or is None if unknown. The decrypted parts are checked against
+    limits adding them to count, the parts and bytes seen of the email.
+    """
+    subtrees = _protected_parts(msg, depth)
+    if not subtrees:
+        return msg
+    if source is not None:
+        # before any part is replaced by its unwrapped one
+        source.index()
+
+    def unwrap_subtree(subtree):
+        return _unwrap_part(subtree.part, openpgp, workers, root, limits,
+                            subtree.depth, source, count)
+
+    if len(subtrees) == 1 or workers <= 1:
+        unwrapped = [unwrap_subtree(s) for s in subtrees]
+    else:
+        pool = ThreadPool(min(workers, len(subtrees)))
+        try:
+            unwrapped = pool.map(unwrap_subtree, subtrees)
+        finally:
+            pool.close()
+
+    for (parent, index, part, _), newpart in zip(subtrees, unwrapped):
+        if parent is None:
+            return newpart
+        parent.get_payload()[index] = newpart
+    return msg
+
+
+def _protected_parts(msg, depth=0):
+    """
+    Find the outermost signed or encrypted parts of msg.
+
+    The parts inside a protected part are not included, they can only be
+    found once the part is unwrapped. Malformed protected parts, without
+    their two subparts, are left as they are.
+
+    :param msg: the email
+    :type msg: Message
+    :param depth: the depth msg is at
+    :type depth: int
+
+    :return: the visit of each protected part, its parent is None if msg
+             itself is protected
+    :rtype: [Visit]
+    """
+    return [visit for visit in walk(msg, descend=_unprotected, depth=depth)
+            if visit.part.get_content_type() in PROTECTED_TYPES and
+            visit.part.is_multipart() and len(visit.part.get_payload()) >= 2]
+
+
+def _unprotected(part):
+    return part.get_content_type() not in PROTECTED_TYPES
+
+
+def _unwrap_part(part, openpgp, workers, root, limits, depth, source,
+                 count):
+    replacements = None
+    if part.get_content_type() == 'multipart/encrypted':
+        inner, level, source = _decrypt_part(part, openpgp, root)
+        replacements = REPLACEMENTS
+        # the decrypted content takes the place of part
+        if limits is not None:
+            limits.check(inner, depth, count)
+    else:
+        inner, level = _verify_part(part, openpgp, root, source)
+
+    # the protected content might have protected parts itself
+    inner = _unwrap(inner, openpgp, workers, root, limits, depth, source,
+                    count)
+    if isinstance(inner, MemoryHoleMessage):
+        level = ProtectionLevel(
+            level.signed_by | inner.protection_level.signed_by,
+            level.encrypted_by | inner.protection_level.encrypted_by)
+        inner = inner._msg
+    return MemoryHoleMessage(inner, level, part.items(), replacements)
+
+
+def _decrypt_part(part, openpgp, root):
+    """
+    :return: the decrypted email, its protection level and the source of
+             the decrypted data it was parsed from
+    :rtype: (Message, ProtectionLevel, _Source)
+    """
+    encrypted = part.get_payload(1).get_payload()
+    # a signature inside the encrypted data is verified while decrypting
+    decryption = decrypt_verify(openpgp, encrypted)
+    # UnwrapFeeder has the email parsed already
+    parsed = getattr(openpgp, 'decrypted_message', None)
+    found = parsed(decryption.data) if parsed is not None else None
+    decrypted, source = found or _decrypted_message(decryption.data)
+    # nested parts don't have recipients, they were encrypted to the
+    # recipients of the email
+    recipients = (_recipient_addresses(part) or
+                  _recipient_addresses(root))
+    level = ProtectionLevel(encrypted_by=set(recipients))
+    if decryption.valid:
+        signer = _signed_by(openpgp, decryption.key_id, decrypted, part,
+                            root)
+        if signer is not None:
+            level.signed_by.add(signer)
+    return decrypted, level, source
+
+
+def _decrypted_message(data):
+    """
+    Parse the decrypted data, restoring the headers of the text/rfc822-headers
+    part if there is one.
+
+    :return: the email and the source of its parts
+    :rtype: (Message, _Source)
+    """
+    data = _to_bytes(data)
+    # as bytes, 8bit parts don't need to be utf-8. Fed in chunks so they
+    # are not decoded all at once into another copy of the data.
+    parser = BytesFeedParser()
+    for start in range(0, len(data), _PARSE_CHUNK):
+        parser.feed(data[start:start + _PARSE_CHUNK])
+    decrypted = parser.close()
+    source = _Source(decrypted, data)
+    if (decrypted.get_content_type() == 'multipart/mixed' and
+            decrypted.get_payload(0).get_content_type() ==
+            'text/rfc822-headers'):
+        headers = BytesParser().parsebytes(
+            decrypted.get_payload(0).get_payload(decode=True),
+            headersonly=True)
+        decrypted = decrypted.get_payload(1)
+        for name, value in headers.items():
+            if name not in decrypted:
+                decrypted[name] = value
+    return decrypted, source
+
+
+def _verify_part(part, openpgp, root, source):
+    content = part.get_payload(0)
+    signature = part.get_payload(1).get_payload()
+
+    level = ProtectionLevel()
+    signed = _signed_bytes(part, source)
+    if signed is not None:
+        key_id = verify_signer(openpgp, signed, signature)
+        signer = _signed_by(openpgp, key_id, content, part, root)
+        if signer is not None:
+            level.signed_by.add(signer)
+    return content, level
+
+
+def _signed_bytes(part, source):
+    """
+    The bytes the first part of the multipart/signed part was received
+    with, with <CR><LF> line endings as RFC 3156 requires.
+
+    They are taken from source, the bytes of the email the part was parsed
+    from, between the delimiters of the part itself. If source is None the
+    part is flattened without folding its headers again.
+
+    :return: the signed bytes, None if the part is malformed or ambiguous
+    :rtype: bytes
+    """
+    if not part.get_boundary():
+        return None
+    if source is None:
+        source = _Source(part, _flatten(part))
+    signed = source.part_bytes(part.get_payload(0))
+    if signed is None:
+        return None
+    return re.sub(b'\r?\n', b'\r\n', signed)
+
+
+class _Source(object):
+
+    def __init__(self, msg, data):
+        """
+        The bytes msg was parsed from, to find the bytes of each of its parts.
+
+        The parts are located following the structure of msg: each multipart
+        part is split by its own delimiters, only within the bytes of the part.
+        Parts with a boundary already used by an outer part, or where the
+        delimiters don't match the parsed parts, can't be located.
+
+        :param msg: the email parsed from data
+        :type msg: Message
+        :param data: the bytes of the email
+        :type data: bytes
+        """
+        self.msg = msg
+        self.data = data
+        self._spans = None
+        self._lock = threading.Lock()
+
+    def index(self):
+        """
+        Locate the parts, it needs to be done before the email is modified.
+        """
+        with self._lock:
+            if self._spans is None:
+                self._spans = {}
+                _locate(self.msg, self.data, 0, len(self.data), (),
+                        self._spans)
+
+    def part_bytes(self, part):
+        """
+        The bytes part was parsed from.
+
+        :return: the bytes, None if the part can't be located
+        :rtype: bytes
+        """
+        self.index()
+        span = self._spans.get(id(part))
+        if span is None:
+            return None
+        return self.data[span[0]:span[1]]
+
+    def body_span(self, part):
+        """
+        Where the body of part starts and ends in the bytes.
+
+        :return: the start and the end, None if the part can't be located
+        :rtype: (int, int)
+        """
+        self.index()
+        span = self._spans.get(id(part))
+        if span is None:
+            return None
+        start = _body_start(self.data, span[0], span[1])
+        if start is None:
+            return None
+        return start, span[1]
+
+
+def _locate(part, data, start, end, boundaries, spans):
+    """
+    Add to spans the start and end in data of part and its subparts, part
+    is in data[start:end] and boundaries are the ones of its outer parts.
+    """
+    spans[id(part)] = (start, end)
+    if not part.is_multipart():
+        return
+    body = _body_start(data, start, end)
+    if body is None:
+        return
+    subparts = part.get_payload()
+    if part.get_content_maintype() == 'message':
+        subspans = [(body, end)]
+    else:
+        boundary = part.get_boundary()
+        if not boundary or boundary in boundaries:
+            # the delimiters would be ambiguous
+            return
+        boundaries += (boundary,)
+        subspans = _split_parts(data, body, end, boundary)
+    if subspans is None or len(subspans) != len(subparts):
+        return
+    for subpart, (substart, subend) in zip(subparts, subspans):
+        _locate(subpart, data, substart, subend, boundaries, spans)
+
+
+def _body_start(data, start, end):
+    """
+    Where the body of the part in data[start:end] starts, None if it has
+    no body.
+    """
+    # a part without headers starts with the empty line
+    match = _line_end.match(data, start, end)
+    if match is None:
+        match = _empty_line.search(data, start, end)
+    if match is None:
+        return None
+    return match.end()
+
+
+def _split_parts(data, start, end, boundary):
+    """
+    The start and end in data of the parts of the multipart body in
+    data[start:end], split by boundary.
+
+    :return: the spans of the parts, None if there is no closing delimiter
+    :rtype: [(int, int)]
+    """
+    delimiter = re.compile(
+        b'^--' + re.escape(_to_bytes(boundary)) + b'(--)?[ \t]*\r?$', re.M)
+    spans = []
+    part_start = None
+    for match in delimiter.finditer(data, start, end):
+        if part_start is not None:
+            # the line break before the delimiter belongs to it
+            part_end = match.start() - 1
+            if part_end > part_start and data[part_end - 1:part_end] == b'\r':
+                part_end -= 1
+            spans.append((part_start, max(part_end, part_start)))
+        if match.group(1):
+            return spans
+        part_start = _line_end.match(data, match.end(), end)
+        if part_start is None:
+            return None
+        part_start = part_start.end()
+    return None
+
+
+def _signed_by(openpgp, key_id, content, part, root):
+    """
+    The address of the sender of the email if the key with key_id has an
+    uid for it, None otherwise.
+    """
+    if key_id is None:
+        return None
+    sender = _signer(content, part, root)
+    if not sender or sender.lower() not in key_addresses(openpgp, key_id):
+        return None
+    return sender
+
+
+def _signer(content, part, root):
+    """
+    The address of the sender of the email, who signed content.
+    """
+    sender = content.get('from') or part.get('from') or root.get('from')
+    return parseaddr(sender or '')[1]
+
+
+def _flatten(msg):
+    fp = StringIO()
+    Generator(fp, mangle_from_=False, maxheaderlen=0).flatten(msg)
+    return _to_bytes(fp.getvalue())
+
+
+def _to_bytes(data):
+    if isinstance(data, bytes):
+        return data
+    try:
+        return data.encode('utf-8', 'surrogateescape')
+    except LookupError:
+        # python 2 has no surrogateescape
+        return data.encode('utf-8')
+
+
+class UnwrapFeeder(object):
+
+    def __init__(self, openpgp, workers=4, limits=DEFAULT_LIMITS):
+        """
+        Unwrap an email while it's being received.
+
+        The email is fed in chunks as they arrive. If it's multipart/encrypted
+        its encrypted data is streamed into openpgp.decrypt, in a background
+        thread, as soon as the encrypted part starts, so decryption overlaps
+        with receiving the rest of the email. The protected headers are
+        available once the data is decrypted, without waiting for the end of
+        the email. Other emails are parsed as they arrive and unwrapped by
+        close.
+
+        openpgp.decrypt gets a file to read the encrypted data from. Feeding
+        blocks while it doesn't keep up with the data. The limits are checked
+        by close, as unwrap does.
+
+        :param openpgp: the implementation of openpgp to use for decryption
+                        and/or verification
+        :type openpgp: IOpenPGP
+        :param workers: maximum number of parts unwrapped at the same time
+        :type workers: int
+        :param limits: limits on the structure of the email, None for no
+                       limits
+        :type limits: MIMELimits
+        """
+        self.openpgp = openpgp
+        self.workers = workers
+        self.limits = limits
+        self.protected_headers = None
+        self._parser = BytesFeedParser()
+        # the email as received, to verify signatures over, while its
+        # encrypted data is not being streamed
+        self._raw = []
+        self._head = b''
+        self._scanning = True
+        self._delimiter = None
+        self._end = None
+        self._keep = 0
+        self._pipe = None
+        self._thread = None
+        self._decryption = None
+        self._decrypted = None
+        self._error = None
+        self._headers_ready = threading.Event()
+
+    def feed(self, data):
+        """
+        Feed the next chunk of the email.
+
+        :param data: the chunk
+        :type data: bytes
+        """
+        self._parser.feed(data)
+        if self._raw is not None:
+            self._raw.append(data)
+        if self._pipe is not None:
+            self._stream(data)
+        elif self._scanning:
+            self._head += data
+            self._scan()
+
+    def wait_headers(self, timeout=None):
+        """
+        Wait for the protected headers of an encrypted email.
+
+        :param timeout: maximum seconds to wait, None to wait until the
+                        data is decrypted
+        :type timeout: float
+
+        :return: the protected headers, None if the email is not encrypted,
+                 the encrypted data didn't start yet or decryption failed
+        :rtype: [(str, str)]
+        """
+        if self._thread is None:
+            return None
+        self._headers_ready.wait(timeout)
+        return self.protected_headers
+
+    def close(self):
+        """
+        Finish the email and unwrap it, like unwrap.
+
+        :return: a decrypted email
+        :rtype: Message
+        """
+        self._scanning = False
+        self._close_pipe()
+        if self._thread is not None:
+            self._thread.join()
+        msg = self._parser.close()
+        if self._error is not None:
+            raise self._error
+        count = PartCount()
+        if self.limits is not None:
+            self.limits.check(msg, count=count)
+
+        openpgp = self.openpgp
+        if (self._decrypted is not None and
+                msg.get_content_type() == 'multipart/encrypted'):
+            openpgp = _Predecrypted(
+                self.openpgp, msg.get_payload(1).get_payload(),
+                self._decryption, self._decrypted)
+        source = None
+        if self._raw is not None:
+            source = _Source(msg, b''.join(self._raw))
+            self._raw = None
+        return _unwrap(msg, openpgp, self.workers, msg, self.limits,
+                       source=source, count=count)
+
+    def _scan(self):
+        """
+        Look for the start of the encrypted data in the received head of the
+        email.
+        """
+        head = self._head
+        if self._delimiter is None:
+            if _header_end.search(head) is None:
+                if len(head) > MAX_HEADER_SIZE:
+                    self._stop_scanning()
+                return
+            classification = classify(head)
+            if (classification.protection != ENCRYPTED or
+                    not classification.boundary):
+                self._stop_scanning()
+                return
+            boundary = re.escape(classification.boundary.encode('latin-1'))
+            self._delimiter = re.compile(
+                b'^--' + boundary + b'[ \t]*\r?\n', re.M)
+            # the line break before the delimiter belongs to it
+            self._end = re.compile(b'\r?\n--' + boundary)
+            self._keep = len(boundary) + 4
+
+        # the encrypted data is the second part
+        delimiters = list(self._delimiter.finditer(head))
+        start = None
+        if len(delimiters) >= 2:
+            start = _header_end.search(head, delimiters[1].end() - 1)
+        if start is None:
+            if len(head) > MAX_HEADER_SIZE:
+                self._stop_scanning()
+            return
+
+        self._scanning = False
+        self._head = b''
+        # the signatures are inside the encrypted data
+        self._raw = None
+        read, write = os.pipe()
+        self._pipe = os.fdopen(write, 'wb')
+        self._thread = threading.Thread(
+            target=self._decrypt, args=(os.fdopen(read, 'rb'),))
+        self._thread.daemon = True
+        self._thread.start()
+        self._stream(head[start.end():])
+
+    def _stream(self, data):
+        """
+        Write the encrypted data in data into the pipe to openpgp.decrypt,
+        keeping back what might be the start of the closing delimiter.
+        """
+        pending = self._head + data
+        match = self._end.search(pending)
+        if match is not None:
+            self._write(pending[:match.start()])
+            self._close_pipe()
+            return
+        split = max(len(pending) - self._keep, 0)
+        self._head = pending[split:]
+        self._write(pending[:split])
+
+    def _write(self, data):
+        try:
+            self._pipe.write(data)
+        except (IOError, OSError):
+            # decrypt stopped reading, it will report the error
+            self._close_pipe()
+
+    def _close_pipe(self):
+        if self._pipe is None:
+            return
+        pipe, self._pipe = self._pipe, None
+        self._head = b''
+        try:
+            pipe.close()
+        except (IOError, OSError):
+            pass
+
+    def _stop_scanning(self):
+        self._scanning = False
+        self._head = b''
+
+    def _decrypt(self, reader):
+        try:
+            self._decryption = decrypt_verify(self.openpgp, reader)
+            self._decrypted = _decrypted_message(self._decryption.data)
+            self.protected_headers = self._decrypted[0].items()
+        except Exception as e:
+            self._error = e
+        finally:
+            reader.close()
+            self._headers_ready.set()
+
+
+class _Predecrypted(object):
+    """
+    Use the data decrypted by UnwrapFeeder for the encrypted email, and
+    openpgp for everything else.
+    """
+
+    def __init__(self, openpgp, encrypted, decryption, message):
+        self._openpgp = openpgp
+        self._encrypted = encrypted
+        self._decryption = decryption
+        self._message = message
+
+    def decrypt(self, data):
+        return self.decrypt_verify(data).data
+
+    def decrypt_verify(self, data):
+        if data is self._encrypted:
+            return self._decryption
+        return decrypt_verify(self._openpgp, data)
+
+    def decrypted_message(self, data):
+        """
+        The email parsed from data and its source, if it's the data
+        decrypted already.
+        """
+        if data is self._decryption.data:
+            return self._message
+        return None
+
+    def __getattr__(self, name):
+        return getattr(self._openpgp, name)
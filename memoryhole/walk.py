@@ -0,0 +1,184 @@
+"""
+Iterative traversal of MIME trees with limits on their shape.
+
+Message.walk, copy.deepcopy and the email generators recurse on the tree of
+an email, so a deep enough email raises RecursionError, and nothing bounds
+the work done on an email with a huge number of parts. The functions here
+use an explicit stack and can check the tree against MIMELimits while they
+walk it, rejecting hostile emails before any work is done with their parts.
+"""
+import threading
+from collections import namedtuple
+from copy import copy
+
+
+Visit = namedtuple("Visit", ("parent", "index", "part", "depth"))
+
+
+class MIMELimitError(ValueError):
+    """
+    Raised when an email exceeds the MIMELimits.
+    """
+
+
+class MIMELimits(object):
+
+    def __init__(self, max_depth=32, max_parts=10000, max_size=None):
+        """
+        Limits on the shape of the emails processed.
+
+        The depth of the top level email is 0, its parts are at depth 1 and
+        so on. The size is the sum of the lengths of the payloads of the leaf
+        parts, as they are in the email (encoded).
+
+        :param max_depth: maximum nesting of multiparts, None for no limit
+        :type max_depth: int
+        :param max_parts: maximum number of parts, counting multiparts and
+                          the top level email, None for no limit
+        :type max_parts: int
+        :param max_size: maximum size in bytes, None for no limit
+        :type max_size: int
+        """
+        self.max_depth = max_depth
+        self.max_parts = max_parts
+        self.max_size = max_size
+
+    def check(self, msg, depth=0, count=None):
+        """
+        Check that msg doesn't exceed the limits, only looking at the
+        structure of the email and the lengths of its payloads.
+
+        :param msg: the email
+        :type msg: Message
+        :param depth: the depth msg is at, for parts of bigger emails
+        :type depth: int
+        :param count: parts and bytes already seen of the same email, msg
+                      is added to them
+        :type count: PartCount
+
+        :raise MIMELimitError: if msg exceeds the limits
+        """
+        for _ in walk(msg, self, depth=depth, count=count):
+            pass
+
+
+class PartCount(object):
+    """
+    Number of parts and bytes of an email checked in several pieces, like
+    the decrypted layers of an unwrapped email, so the limits apply to all
+    of them together. The pieces can be checked from several threads.
+    """
+
+    def __init__(self):
+        self.parts = 0
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def add(self, parts=0, size=0):
+        """
+        Add parts and size to the count.
+
+        :return: the parts and size counted so far
+        :rtype: (int, int)
+        """
+        with self._lock:
+            self.parts += parts
+            self.size += size
+            return self.parts, self.size
+
+
+DEFAULT_LIMITS = MIMELimits()
+
+
+def walk(msg, limits=None, descend=None, depth=0, count=None):
+    """
+    Walk the parts of msg depth first, in the same order as Message.walk.
+
+    If limits are given MIMELimitError is raised as soon as the parts seen
+    exceed them, the number of parts is checked before adding the subparts of
+    each multipart.
+
+    :param msg: the email
+    :type msg: Message
+    :param limits: the limits to check, None for no limits
+    :type limits: MIMELimits
+    :param descend: callable that gets a multipart and returns if its
+                    subparts should be walked, by default all are
+    :type descend: callable
+    :param depth: the depth msg is at
+    :type depth: int
+    :param count: parts and bytes already seen of the same email, the parts
+                  of msg are added to them and checked together
+    :type count: PartCount
+
+    :return: the parent, index in the parent, part and depth of each part,
+             parent is None for msg
+    :rtype: iterator of Visit
+    """
+    max_depth = max_parts = max_size = None
+    if limits is not None:
+        max_depth = limits.max_depth
+        max_parts = limits.max_parts
+        max_size = limits.max_size
+    parts = 1
+    size = 0
+    if count is not None:
+        parts, size = count.add(parts=1)
+
+    pending = [Visit(None, 0, msg, depth)]
+    while pending:
+        visit = pending.pop()
+        part = visit.part
+        if max_depth is not None and visit.depth > max_depth:
+            raise MIMELimitError(
+                'Email nested more than %s levels' % (max_depth,))
+
+        payload = part.get_payload()
+        if part.is_multipart():
+            if descend is None or descend(part):
+                if count is None:
+                    parts += len(payload)
+                else:
+                    parts, size = count.add(parts=len(payload))
+                if max_parts is not None and parts > max_parts:
+                    raise MIMELimitError(
+                        'Email with more than %s parts' % (max_parts,))
+                for index in reversed(range(len(payload))):
+                    pending.append(Visit(part, index, payload[index],
+                                         visit.depth + 1))
+        elif payload is not None:
+            if count is None:
+                size += len(payload)
+            else:
+                parts, size = count.add(size=len(payload))
+            if max_size is not None and size > max_size:
+                raise MIMELimitError(
+                    'Email bigger than %s bytes' % (max_size,))
+        yield visit
+
+
+def copy_tree(msg):
+    """
+    Copy the tree of msg, like copy.deepcopy but without recursion.
+
+    Every part is copied with its own headers and list of subparts, so they
+    can be modified without changing msg. The payloads are strings, they
+    are shared.
+
+    :param msg: the email
+    :type msg: Message
+
+    :rtype: Message
+    """
+    copies = {}
+    for parent, index, part, _ in walk(msg):
+        new = copy(part)
+        new._headers = list(part._headers)
+        if getattr(part, 'defects', None) is not None:
+            new.defects = list(part.defects)
+        if part.is_multipart():
+            new._payload = list(part._payload)
+        if parent is not None:
+            copies[id(parent)]._payload[index] = new
+        copies[id(part)] = new
+    return copies[id(msg)]
@@ -0,0 +1,254 @@
+import pickle
+from email.charset import Charset, QP
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.parser import Parser
+from zope.interface import implementer
+
+from memoryhole import protect, ProtectConfig, IOpenPGP
+from memoryhole import cache, rfc3156
+from memoryhole.cache import EncodingCache, ProtectCache, SignerCache
+from memoryhole.compression import CompressionPolicy
+
+
+EMAIL = """From: me@domain.com
+To: you@other.com
+Subject: some subject
+
+body text
+"""
+
+parser = Parser()
+
+QP_UTF8 = Charset('utf-8')
+QP_UTF8.body_encoding = QP
+
+
+def test_retry_without_crypto():
+    openpgp = CountingOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp, cache=ProtectCache())
+
+    first = protect(parser.parsestr(EMAIL), config=conf, sign=True)
+    second = protect(parser.parsestr(EMAIL), config=conf, sign=True)
+
+    assert openpgp.calls == 1
+    assert first.as_string() == second.as_string()
+    assert second.protection_level.score == 3
+    assert conf.cache.hits == 1
+
+
+def test_deterministic_boundaries():
+    conf = ProtectConfig(openpgp=CountingOpenPGP(),
+                         cache=ProtectCache(secret=b'secret'))
+    first = protect(parser.parsestr(EMAIL), config=conf)
+
+    conf = ProtectConfig(openpgp=CountingOpenPGP(),
+                         cache=ProtectCache(secret=b'secret'))
+    second = protect(parser.parsestr(EMAIL), config=conf)
+
+    assert first.get_boundary() == second.get_boundary()
+    assert first.as_string() == second.as_string()
+
+    # without the secret the boundary doesn't tell anything about the email
+    conf = ProtectConfig(openpgp=CountingOpenPGP(), cache=ProtectCache())
+    third = protect(parser.parsestr(EMAIL), config=conf)
+    key = conf.cache.key(parser.parsestr(EMAIL), True, False, conf,
+                         ['you@other.com'], None)
+    assert third.get_boundary() != first.get_boundary()
+    assert key[:32] not in third.get_boundary()
+
+
+def test_key_changes(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'time', lambda: now[0])
+    openpgp = CountingOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp, cache=ProtectCache())
+
+    protect(parser.parsestr(EMAIL), config=conf)
+    protect(parser.parsestr(EMAIL), config=conf, sign=True)
+    protect(parser.parsestr(EMAIL), encrypt=False, config=conf)
+    protect(parser.parsestr(EMAIL.replace("body", "other")), config=conf)
+    openpgp.fingerprint = "NEWKEY"
+    now[0] += conf.cache.fingerprint_ttl
+    protect(parser.parsestr(EMAIL), config=conf)
+
+    assert openpgp.calls == 5
+    assert conf.cache.hits == 0
+
+
+def test_config_changes():
+    openpgp = CountingOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp, cache=ProtectCache())
+    protect(parser.parsestr(EMAIL), config=conf)
+
+    conf.compression = CompressionPolicy(level=9)
+    protect(parser.parsestr(EMAIL), config=conf)
+    conf.compression = CompressionPolicy(level=1)
+    protect(parser.parsestr(EMAIL), config=conf)
+    conf.openpgp = HomedirOpenPGP()
+    protect(parser.parsestr(EMAIL), config=conf)
+    conf.openpgp = HomedirOpenPGP('/other/keyring')
+    protect(parser.parsestr(EMAIL), config=conf)
+
+    assert conf.cache.hits == 0
+    conf.openpgp = HomedirOpenPGP('/other/keyring')
+    protect(parser.parsestr(EMAIL), config=conf)
+    assert conf.cache.hits == 1
+
+
+def test_fingerprints_not_looked_up_on_hits():
+    openpgp = CountingOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp, cache=ProtectCache())
+
+    for _ in range(3):
+        protect(parser.parsestr(EMAIL), config=conf)
+
+    assert conf.cache.hits == 2
+    assert openpgp.lookups == 1
+
+
+def test_lru_eviction():
+    openpgp = CountingOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp,
+                         cache=ProtectCache(max_entries=1))
+
+    protect(parser.parsestr(EMAIL), config=conf)
+    protect(parser.parsestr(EMAIL), config=conf, sign=True)
+    protect(parser.parsestr(EMAIL), config=conf)
+
+    assert openpgp.calls == 3
+    assert len(conf.cache) == 1
+
+
+def test_signer_idle_eviction(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'time', lambda: now[0])
+    released = []
+    signers = SignerCache(idle=60, max_entries=2)
+
+    signers.put(None, 'one@domain.com', 'FPR1',
+                release=lambda: released.append('one'))
+    now[0] += 30
+    signers.put(None, 'two@domain.com', 'FPR2',
+                release=lambda: released.append('two'))
+    now[0] += 40
+    assert signers.get(None, 'TWO@domain.com') == 'FPR2'
+    assert released == ['one']
+    assert signers.get(None, 'one@domain.com') is None
+
+    signers.put('/other', 'two@domain.com', 'FPR3')
+    signers.put(None, 'three@domain.com', 'FPR4')
+    assert released == ['one', 'two']
+    assert len(signers) == 2
+    assert signers.evicted == 2
+
+    now[0] += 100
+    signers.put(None, 'four@domain.com', 'FPR5')
+    assert len(signers) == 1
+    assert signers.evicted == 4
+
+
+def test_repeated_attachment_encoded_once(monkeypatch):
+    encoded = []
+    bencode = rfc3156._bencode
+
+    def counting_bencode(s):
+        encoded.append(s)
+        return bencode(s)
+    monkeypatch.setattr(rfc3156, '_bencode', counting_bencode)
+
+    attachment = "the same attachment \u00e9\n" * 1000
+    conf = ProtectConfig(openpgp=CountingOpenPGP(),
+                         encoding_cache=EncodingCache())
+    signed = [protect(newsletter(i, attachment), encrypt=False, config=conf)
+              for i in range(3)]
+
+    assert len(encoded) == 1
+    assert conf.encoding_cache.hits == 2
+    attachments = [msg.get_payload(0).get_payload(1) for msg in signed]
+    assert attachments[0].get_payload() == attachments[2].get_payload()
+    assert attachments[2]['content-transfer-encoding'] == 'base64'
+    assert (attachments[2].get_payload(decode=True) ==
+            attachment.encode('utf-8'))
+
+
+def test_encoding_cache_bytes_bound():
+    encodings = EncodingCache(max_bytes=10, min_size=1)
+    keys = [encodings.key(payload, None) for payload in ('a', 'b', 'c')]
+    encodings.put(keys[0], 'AAAA')
+    encodings.put(keys[1], 'BBBB')
+    assert encodings.get(keys[0]) == 'AAAA'
+    encodings.put(keys[2], 'CCCC')
+
+    assert encodings.get(keys[1]) is None
+    assert encodings.get(keys[0]) == 'AAAA'
+    assert encodings.key('a', 'quoted-printable') != keys[0]
+    assert encodings.key('a' * 10, None) is not None
+    assert EncodingCache(min_size=11).key('a' * 10, None) is None
+
+
+def test_encoding_cache_shared_directory(tmpdir):
+    directory = str(tmpdir)
+    encodings = EncodingCache(max_bytes=100, min_size=1, directory=directory)
+    # as sent to another process
+    other = pickle.loads(pickle.dumps(encodings))
+
+    key = encodings.key('payload', None)
+    encodings.put(key, 'cGF5bG9hZA==')
+    assert other.get(key) == 'cGF5bG9hZA=='
+
+    for i in range(20):
+        other.put(other.key('payload %s' % (i,), None), 'X' * 10)
+    assert len(other) <= 10
+    assert sum(len(open(str(f)).read()) for f in tmpdir.listdir()
+               if not f.basename.startswith('.')) <= 100
+
+
+def test_encoding_cache_directory_bounded_across_processes(tmpdir):
+    directory = str(tmpdir)
+    encodings = EncodingCache(max_bytes=100, min_size=1, directory=directory)
+    processes = [pickle.loads(pickle.dumps(encodings)) for _ in range(4)]
+
+    for i in range(40):
+        cache = processes[i % len(processes)]
+        cache.put(cache.key('payload %s' % (i,), None), 'X' * 10)
+        assert sum(size for _, _, size in encodings._files()) <= 100
+
+    big = encodings.key('big', None)
+    encodings.put(big, 'X' * 101)
+    assert encodings.get(big) is None
+
+
+def newsletter(number, attachment):
+    msg = MIMEMultipart('mixed', _subparts=[
+        MIMEText('Newsletter number %s' % (number,)),
+        MIMEText(attachment, 'plain', QP_UTF8)])
+    msg['From'] = 'news@domain.com'
+    msg['To'] = 'you@other.com'
+    msg['Subject'] = 'News'
+    return msg
+
+
+@implementer(IOpenPGP)
+class CountingOpenPGP(object):
+    calls = 0
+    lookups = 0
+    fingerprint = "OLDKEY"
+
+    def encrypt(self, data, encraddr, signaddr=None, compression=None):
+        self.calls += 1
+        return "encrypted %s" % (self.calls,)
+
+    def sign(self, data, signaddr=None):
+        self.calls += 1
+        return "signature %s" % (self.calls,)
+
+    def fingerprints(self, addresses):
+        self.lookups += 1
+        return [self.fingerprint for _ in addresses]
+
+
+class HomedirOpenPGP(CountingOpenPGP):
+
+    def __init__(self, homedir=None):
+        self.homedir = homedir
@@ -0,0 +1,89 @@
+from email.parser import Parser
+
+from zope.interface import implementer
+
+from memoryhole import protect, classify, ProtectConfig, IOpenPGP
+from memoryhole.classify import ENCRYPTED, SIGNED, PROTECTED_HEADERS
+
+
+EMAIL = """From: me@domain.com
+To: you@other.com
+Subject: some subject
+
+body text
+"""
+
+PROTECTED = """From: me@domain.com
+Content-Type: multipart/mixed;
+ boundary="bound"
+
+--bound
+Content-Type: text/rfc822-headers
+
+Subject: some subject
+
+--bound
+Content-Type: text/plain
+
+body text
+--bound--
+"""
+
+parser = Parser()
+
+
+def test_encrypted():
+    encmsg = protect(parser.parsestr(EMAIL),
+                     config=ProtectConfig(openpgp=OpenPGP()))
+    raw = encmsg.as_string().encode('utf-8')
+
+    c = classify(raw)
+    assert c.protection == ENCRYPTED
+    assert c.protocol == 'application/pgp-encrypted'
+    assert c.boundary == encmsg.get_boundary()
+    assert c.micalg is None
+
+
+def test_signed_crlf():
+    signmsg = protect(parser.parsestr(EMAIL), encrypt=False,
+                      config=ProtectConfig(openpgp=OpenPGP()))
+    raw = signmsg.as_string().replace('\n', '\r\n').encode('utf-8')
+
+    c = classify(raw)
+    assert c.protection == SIGNED
+    assert c.protocol == 'application/pgp-signature'
+    assert c.micalg == 'pgp-sha512'
+    assert c.boundary == signmsg.get_boundary()
+
+
+def test_protected_headers():
+    c = classify(bytearray(PROTECTED.encode('utf-8')))
+    assert c.protection == PROTECTED_HEADERS
+    assert c.boundary == 'bound'
+
+
+def test_unprotected():
+    assert classify(EMAIL.encode('utf-8')).protection is None
+    assert classify(b'no headers end').protection is None
+    first_part = PROTECTED.replace('text/rfc822-headers', 'text/plain')
+    assert classify(first_part.encode('utf-8')).protection is None
+
+
+def test_boundary_in_other_lines():
+    # neither --b10 nor a --b1 inside a line delimits parts of b1
+    for line in ('--b10', 'not a delimiter --b1'):
+        raw = PROTECTED.replace('"bound"', '"b1"').replace(
+            '--bound', '--b1').replace(
+            '\n\n--b1\n', '\n\n%s\nContent-Type: text/rfc822-headers\n\n'
+            '--b1\nContent-Type: text/plain\n\n--b1\n' % (line,), 1)
+        assert classify(raw.encode('utf-8')).protection is None
+
+
+@implementer(IOpenPGP)
+class OpenPGP(object):
+
+    def encrypt(self, data, encraddr):
+        return "encrypted"
+
+    def sign(self, data):
+        return "signature"
@@ -0,0 +1,100 @@
+import os
+import zlib
+from binascii import hexlify
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from zope.interface import implementer
+
+from memoryhole import protect, ProtectConfig, IOpenPGP
+from memoryhole.compression import (
+    CompressionPolicy, Compression, UNCOMPRESSED, entropy)
+from memoryhole.pool import OpenPGPPool
+
+
+FROM = "me@domain.com"
+TO = "you@other.com"
+TEXT = "Some text that compresses pretty well.\n" * 4096
+
+
+def test_entropy():
+    assert entropy(b"") == 0.0
+    assert entropy(b"a" * 100) == 0.0
+    assert entropy(b"ab" * 100) == 1.0
+    assert entropy(bytes(bytearray(range(256)))) == 8.0
+    assert entropy(os.urandom(4096)) > 7.5
+
+
+def test_compress_text():
+    policy = CompressionPolicy()
+    assert policy.choose(email(MIMEText(TEXT))) == Compression('ZLIB', 6)
+
+
+def test_skip_compressed_types():
+    policy = CompressionPolicy()
+    msg = email(MIMEText("hi"), MIMEImage(b"x" * 128 * 1024, 'jpeg'))
+    assert policy.choose(msg) == UNCOMPRESSED
+
+
+def test_skip_high_entropy():
+    policy = CompressionPolicy(algorithm='BZIP2', level=9)
+    random = MIMEApplication(os.urandom(128 * 1024))
+    assert policy.choose(email(MIMEText("hi"), random)) == UNCOMPRESSED
+
+    hexdump = hexlify(os.urandom(128 * 1024))
+    deflated = MIMEApplication(zlib.compress(hexdump))
+    assert policy.choose(email(deflated)) == UNCOMPRESSED
+
+    plain = MIMEApplication(TEXT.encode('utf-8'))
+    assert policy.choose(email(plain)) == Compression('BZIP2', 9)
+
+
+def test_mostly_compressible():
+    policy = CompressionPolicy()
+    msg = email(MIMEText(TEXT * 4), MIMEImage(b"x" * 64 * 1024, 'png'))
+    assert policy.choose(msg) == Compression('ZLIB', 6)
+
+
+def test_small_emails_compressed():
+    policy = CompressionPolicy()
+    msg = email(MIMEImage(b"x" * 1024, 'jpeg'))
+    assert policy.choose(msg) == Compression('ZLIB', 6)
+
+
+def test_protect_passes_compression():
+    openpgp = Encrypter()
+    conf = ProtectConfig(openpgp=openpgp, compression=CompressionPolicy())
+    protect(email(MIMEImage(b"x" * 128 * 1024, 'gif')), config=conf)
+    assert openpgp.compression == UNCOMPRESSED
+
+
+def test_pool_passes_compression():
+    openpgp = Encrypter()
+    pool = OpenPGPPool(lambda: openpgp, size=1)
+    conf = ProtectConfig(openpgp=pool, compression=CompressionPolicy())
+    protect(email(MIMEText(TEXT)), config=conf)
+    assert openpgp.compression == Compression('ZLIB', 6)
+
+
+def test_no_policy():
+    openpgp = Encrypter()
+    protect(email(MIMEText(TEXT)), config=ProtectConfig(openpgp=openpgp))
+    assert openpgp.compression is None
+
+
+def email(*parts):
+    msg = MIMEMultipart()
+    msg['From'] = FROM
+    msg['To'] = TO
+    for part in parts:
+        msg.attach(part)
+    return msg
+
+
+@implementer(IOpenPGP)
+class Encrypter(object):
+
+    def encrypt(self, data, encraddr, compression=None):
+        self.compression = compression
+        return "this is encrypted"
@@ -0,0 +1,180 @@
+import os
+import socket
+import stat
+import struct
+import threading
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import pytest
+
+from memoryhole import protect, unwrap, ProtectConfig, MIMELimits
+from memoryhole.daemon import (
+    CryptoDaemon, DaemonClient, DaemonError, FrameError, MAX_FRAME, _recv,
+    _send
+)
+from memoryhole.slowops import SlowOpRecorder
+from memoryhole.walk import MIMELimitError
+
+from tests.test_unwrap import (
+    EMAIL, FROM, SUBJECT, TO, FakeOpenPGP, SigningOpenPGP, parser
+)
+
+
+@pytest.fixture
+def daemon(tmpdir):
+    openpgp = SigningOpenPGP()
+    daemon = CryptoDaemon(str(tmpdir.join('memoryhole.sock')),
+                          ProtectConfig(openpgp=openpgp))
+    daemon.start()
+    yield daemon
+    daemon.shutdown()
+
+
+def test_client_implements_openpgp(daemon):
+    client = DaemonClient(daemon.path)
+    conf = ProtectConfig(openpgp=client)
+
+    encmsg = protect(parser.parsestr(EMAIL), config=conf, sign=True)
+    msg = unwrap(encmsg, client)
+
+    assert msg['subject'] == SUBJECT
+    assert msg.protection_level.signed_by == set([FROM])
+    assert msg.protection_level.encrypted_by == set([TO])
+    assert daemon.config.openpgp.decrypted == 1
+
+    signature = client.sign('some text', FROM)
+    assert client.verify('some text', signature)
+    assert not client.verify('other text', signature)
+    assert client.verify_signer(b'some text', signature) == 'KEYID'
+    assert client.verify_signer('other text', signature) is None
+    assert client.key_addresses('KEYID') == [FROM]
+
+
+def test_protect_and_unwrap_in_daemon(daemon):
+    client = DaemonClient(daemon.path)
+
+    encmsg = client.protect(parser.parsestr(EMAIL), sign=True)
+    assert encmsg['subject'] == 'encrypted email'
+    assert encmsg.protection_level.score == 3
+
+    encmsg.replace_header('to', 'attacker@evil.com')
+    msg = client.unwrap(encmsg)
+
+    assert msg['subject'] == SUBJECT
+    assert msg.protection_level.signed_by == set([FROM])
+    assert msg.get_protected_header('subject').protection_level.score == 3
+    assert msg.is_tampered_header('to')
+    assert not msg.is_tampered_header('subject')
+
+
+def test_unwrap_unprotected_in_daemon(daemon):
+    client = DaemonClient(daemon.path)
+
+    msg = client.unwrap(parser.parsestr(EMAIL))
+    assert msg['subject'] == SUBJECT
+    assert msg.protection_level.score == 0
+    assert not msg.is_tampered_header('subject')
+
+    signed = protect(parser.parsestr(EMAIL), encrypt=False,
+                     config=ProtectConfig(openpgp=FakeOpenPGP()))
+    mixed = MIMEMultipart('mixed', _subparts=[MIMEText('intro'), signed])
+    mixed['Subject'] = 'nested'
+
+    msg = client.unwrap(mixed)
+    assert msg['subject'] == 'nested'
+    assert msg.protection_level.score == 0
+    assert msg.get_payload(1).get_content_type() == 'text/plain'
+    assert msg.get_payload(1)['subject'] == SUBJECT
+
+
+def test_socket_mode(tmpdir):
+    umask = os.umask(0)
+    try:
+        path = str(tmpdir.join('private.sock'))
+        daemon = CryptoDaemon(path, ProtectConfig(openpgp=FakeOpenPGP()))
+        assert os.umask(0) == 0
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    daemon.start()
+    daemon.shutdown()
+
+
+def test_slow_ops(daemon):
+    client = DaemonClient(daemon.path)
+    assert client.slow_ops() == []
+
+    daemon.config.recorder = SlowOpRecorder(sample_rate=1)
+    client.protect(parser.parsestr(EMAIL))
+
+    record, = client.slow_ops()
+    assert record['operation'] == 'protect_to_file'
+    assert record['shape']['recipients'] == 1
+
+
+def test_connection_per_thread(daemon):
+    client = DaemonClient(daemon.path)
+    results = []
+
+    def run(n):
+        encrypted = client.encrypt('secret %s' % (n,), [TO])
+        results.append(client.decrypt(encrypted) == b'secret %d' % (n,))
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [True] * 8
+
+
+def test_errors(daemon):
+    daemon.config.limits = MIMELimits(max_depth=0)
+    client = DaemonClient(daemon.path)
+    msg = protect(parser.parsestr(EMAIL), config=ProtectConfig(
+        openpgp=FakeOpenPGP()))
+
+    with pytest.raises(MIMELimitError):
+        client.protect(msg)
+    with pytest.raises(DaemonError):
+        client.decrypt('not base64 !')
+    # the connection is still usable
+    assert client.sign('text')
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(daemon.path)
+    _send(sock, 99, [b'data'])
+    code, fields = _recv(sock.makefile('rb'))
+    assert fields[0] == b'FrameError'
+    sock.close()
+
+
+def test_frames():
+    left, right = socket.socketpair()
+    _send(left, 3, [b'data', None, u'café', b''])
+    assert _recv(right.makefile('rb')) == (
+        3, [b'data', None, u'café'.encode('utf-8'), b''])
+
+    left.sendall(struct.pack('!IBH', MAX_FRAME + 1, 3, 1))
+    with pytest.raises(FrameError):
+        _recv(right.makefile('rb'))
+
+    left.sendall(struct.pack('!IBHI', 4, 3, 1, 10))
+    with pytest.raises(FrameError):
+        _recv(right.makefile('rb'))
+    left.close()
+    right.close()
+
+
+def test_unwrap_8bit_email(daemon):
+    client = DaemonClient(daemon.path)
+    email = EMAIL.replace('body text', u'body text café')
+    encmsg = client.protect(parser.parsestr(email), sign=True)
+
+    msg = client.unwrap(encmsg)
+
+    assert msg['subject'] == SUBJECT
+    assert msg.protection_level.signed_by == set([FROM])
+    assert msg.replacements['subject'] == 'encrypted email'
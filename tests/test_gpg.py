@@ -0,0 +1,317 @@
+import os
+import subprocess
+import time
+
+import pytest
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+from memoryhole import gpg
+from memoryhole.cache import SessionKeyCache, SignerCache
+from memoryhole.gpg import Gnupg, GnupgTimeout
+
+
+def test_timeout_kills_gpg(monkeypatch):
+    backend = fake_gnupg(monkeypatch, timeout=0.2)
+
+    start = time.time()
+    with pytest.raises(GnupgTimeout):
+        backend.sign("data")
+
+    assert time.time() - start < 2
+    assert len(backend.gpg.procs) == 1
+    assert backend.gpg.procs[0].returncode is not None
+
+
+def test_timeout_cleans_temp_files(monkeypatch):
+    backend = fake_gnupg(monkeypatch, timeout=0.2)
+    created = []
+    mkstemp = gpg.tempfile.mkstemp
+
+    def tracked_mkstemp():
+        fd, path = mkstemp()
+        created.append(path)
+        return fd, path
+    monkeypatch.setattr(gpg.tempfile, 'mkstemp', tracked_mkstemp)
+
+    with pytest.raises(GnupgTimeout):
+        backend.verify("data", "signature")
+    assert created and not os.path.exists(created[0])
+
+
+def test_fast_operation(monkeypatch):
+    backend = fake_gnupg(monkeypatch, timeout=5, sleep=0)
+    assert backend.sign("data") == "signature"
+
+
+@pytest.mark.skipif(not which('gpg'), reason="needs gpg")
+def test_session_key_cache(monkeypatch, tmpdir):
+    homedir = gpg_homedir(tmpdir)
+    try:
+        ciphertext = run_gpg(homedir, '--trust-model', 'always', '-a', '-e',
+                             '-r', 'me@domain.com', data=b'secret\n')
+        cache = SessionKeyCache()
+        backend = gpg_gnupg(monkeypatch, homedir, session_keys=cache)
+
+        assert backend.decrypt(ciphertext) == b'secret\n'
+        assert len(cache) == 1
+
+        # without the secret key only the cached session key can decrypt it
+        fingerprint = [line.split(':')[9] for line in run_gpg(
+            homedir, '--with-colons', '-K').decode().splitlines()
+            if line.startswith('fpr:')][0]
+        run_gpg(homedir, '--yes', '--delete-secret-keys', fingerprint)
+        assert backend.decrypt(ciphertext) == b'secret\n'
+        assert cache.hits == 1
+
+        cache.clear()
+        with pytest.raises(RuntimeError) as e:
+            backend.decrypt(ciphertext)
+        assert 'session key' not in str(e.value)
+    finally:
+        subprocess.call(['gpgconf', '--homedir', homedir, '--kill',
+                         'gpg-agent'])
+
+
+@pytest.mark.skipif(not which('gpg'), reason="needs gpg")
+def test_decrypt_verify(monkeypatch, tmpdir):
+    homedir = gpg_homedir(tmpdir)
+    try:
+        signed = run_gpg(homedir, '--trust-model', 'always', '-a', '-s',
+                         '-e', '-r', 'me@domain.com', data=b'secret\n')
+        plain = run_gpg(homedir, '--trust-model', 'always', '-a', '-e',
+                        '-r', 'me@domain.com', data=b'secret\n')
+        backend = gpg_gnupg(monkeypatch, homedir,
+                            session_keys=SessionKeyCache())
+
+        decryption = backend.decrypt_verify(signed)
+        assert decryption.data == b'secret\n'
+        assert decryption.signed and decryption.valid
+        # the primary key, not the subkey that signed
+        primary = [line.split(':')[9] for line in run_gpg(
+            homedir, '--with-colons', '-K').decode().splitlines()
+            if line.startswith('fpr:')][0]
+        assert decryption.key_id == primary
+
+        decryption = backend.decrypt_verify(plain)
+        assert decryption == (b'secret\n', False, False, None)
+    finally:
+        subprocess.call(['gpgconf', '--homedir', homedir, '--kill',
+                         'gpg-agent'])
+
+
+@pytest.mark.skipif(not which('gpg'), reason="needs gpg")
+def test_decrypt_unknown_signer(monkeypatch, tmpdir):
+    homedir = gpg_homedir(tmpdir)
+    try:
+        run_gpg(homedir, '--passphrase', '', '--quick-gen-key',
+                'Other <other@domain.com>', 'future-default', 'default',
+                'never')
+        signed = run_gpg(homedir, '--trust-model', 'always', '-a', '-s',
+                         '-u', 'other@domain.com', '-e', '-r',
+                         'me@domain.com', data=b'secret\n')
+        other = [line.split(':')[9] for line in run_gpg(
+            homedir, '--with-colons', '-K', 'other@domain.com'
+        ).decode().splitlines() if line.startswith('fpr:')][0]
+        run_gpg(homedir, '--yes', '--delete-secret-and-public-keys', other)
+        backend = gpg_gnupg(monkeypatch, homedir,
+                            session_keys=SessionKeyCache())
+
+        # gpg exits with an error, as it can't check the signature
+        for _ in range(2):
+            decryption = backend.decrypt_verify(signed)
+            assert decryption.data == b'secret\n'
+            assert decryption.signed and not decryption.valid
+    finally:
+        subprocess.call(['gpgconf', '--homedir', homedir, '--kill',
+                         'gpg-agent'])
+
+
+@pytest.mark.skipif(not which('gpg-connect-agent'), reason="needs gpg")
+def test_signer_cache(monkeypatch, tmpdir):
+    homedir = gpg_homedir(tmpdir)
+    with open(os.path.join(homedir, 'gpg-agent.conf'), 'w') as conf:
+        conf.write('allow-preset-passphrase\n')
+    try:
+        subprocess.call(['gpgconf', '--homedir', homedir, '--reload',
+                         'gpg-agent'])
+        run_gpg(homedir, '--pinentry-mode', 'loopback', '--passphrase',
+                'secret', '--quick-gen-key', 'Other <other@domain.com>',
+                'future-default', 'default', 'never')
+        other = [line.split(':')[9] for line in run_gpg(
+            homedir, '--with-colons', '-K', 'other@domain.com'
+        ).decode().splitlines() if line.startswith('fpr:')][0]
+
+        signers = SignerCache(passphrase=lambda address: 'secret')
+        backend = gpg_gnupg(monkeypatch, homedir, signers=signers)
+        assert backend._signing_key('other@domain.com') == other
+        assert backend._signing_key('Other@Domain.com') == other
+        assert signers.hits == 1
+        # never signs as another user
+        with pytest.raises(RuntimeError):
+            backend._signing_key('nobody@domain.com')
+
+        # the passphrase is preset, gpg doesn't need to ask for it
+        sign = ('--pinentry-mode', 'error', '-u', other, '--detach-sign')
+        run_gpg(homedir, *sign, data=b'data')
+        signers.clear()
+        with pytest.raises(AssertionError):
+            run_gpg(homedir, *sign, data=b'data')
+    finally:
+        subprocess.call(['gpgconf', '--homedir', homedir, '--kill',
+                         'gpg-agent'])
+
+
+def test_no_signing_key_for_address(monkeypatch):
+    backend = fake_gnupg(monkeypatch, None)
+    backend.gpg.list_keys = lambda secret=False: [
+        {'fingerprint': 'FPR', 'uids': ['Me <me@domain.com>']}]
+
+    assert backend._signing_key('ME@domain.com') == 'FPR'
+    with pytest.raises(RuntimeError):
+        backend._signing_key('other@domain.com')
+
+
+def test_key_addresses(monkeypatch):
+    backend = fake_gnupg(monkeypatch, None)
+    backend.gpg.list_keys = lambda secret=False: [
+        {'fingerprint': 'AAAA' * 10, 'uids': ['Other <other@domain.com>'],
+         'subkeys': []},
+        {'fingerprint': 'BBBB' * 10, 'uids': ['Me <Me@Domain.com>'],
+         'subkeys': [['CCCC' * 4, 's']]}]
+
+    assert backend.key_addresses('BBBB' * 10) == ['me@domain.com']
+    assert backend.key_addresses('bbbb' * 4) == ['me@domain.com']
+    # signatures made with a subkey give its id or fingerprint
+    assert backend.key_addresses('CCCC' * 4) == ['me@domain.com']
+    assert backend.key_addresses('DDDD' * 6 + 'CCCC' * 4) == [
+        'me@domain.com']
+    # short key ids are not trusted
+    assert backend.key_addresses('BBBBBBBB') == []
+    assert backend.key_addresses('EEEE' * 4) == []
+
+
+def test_verify_signer(monkeypatch):
+    backend = fake_gnupg(monkeypatch, None, sleep=0)
+
+    class Result(object):
+        valid = True
+        fingerprint = 'SUBKEY'
+        pubkey_fingerprint = 'PRIMARY'
+
+    backend.gpg.verify_file = lambda stream, sig_file=None: Result
+    assert backend.verify("data", "signature")
+    assert backend.verify_signer("data", "signature") == 'PRIMARY'
+    Result.valid = False
+    assert backend.verify_signer("data", "signature") is None
+
+
+def test_decrypt_signature_status(monkeypatch):
+    backend = fake_gnupg(monkeypatch, None)
+
+    class Result(object):
+        ok = True
+        data = b'secret'
+        # python-gnupg sets key_id to the key the data is encrypted to
+        key_id = '62F204B91E9BE956'
+        pubkey_fingerprint = None
+        stderr = ('[GNUPG:] ENC_TO 62F204B91E9BE956 18 0\n'
+                  '[GNUPG:] DECRYPTION_OKAY\n')
+    backend.gpg.decrypt = lambda data: Result
+    assert backend.decrypt_verify('data') == (b'secret', False, False, None)
+
+    encrypted = Result.stderr
+    Result.stderr = encrypted + (
+        '[GNUPG:] BADSIG 1111222233334444 Me <me@domain.com>\n')
+    assert backend.decrypt_verify('data') == (
+        b'secret', True, False, '1111222233334444')
+
+    Result.stderr = encrypted + (
+        '[GNUPG:] GOODSIG 1111222233334444 Me <me@domain.com>\n'
+        '[GNUPG:] VALIDSIG SUBKEY 2020-01-01 1577836800 0 4 0 22 10 00 '
+        'PRIMARY\n')
+    assert backend.decrypt_verify('data') == (
+        b'secret', True, True, 'PRIMARY')
+    Result.pubkey_fingerprint = 'PUBKEY'
+    assert backend.decrypt_verify('data').key_id == 'PUBKEY'
+
+
+def test_session_key_wiped():
+    cache = SessionKeyCache(max_entries=1)
+    cache.put(None, b'message 1', b'9:AAAA')
+    key = cache._entries[list(cache._entries)[0]][0]
+    cache.put(None, b'message 2', b'9:BBBB')
+
+    assert key == bytearray(len(key))
+    assert cache.get(None, b'message 1') is None
+    assert cache.get('/other/homedir', b'message 2') is None
+    assert cache.get(None, b'message 2') == bytearray(b'9:BBBB')
+
+
+def gpg_homedir(tmpdir):
+    homedir = str(tmpdir.mkdir('gnupg'))
+    os.chmod(homedir, 0o700)
+    run_gpg(homedir, '--passphrase', '', '--quick-gen-key',
+            'Me <me@domain.com>', 'future-default', 'default', 'never')
+    return homedir
+
+
+def run_gpg(homedir, *args, **kwargs):
+    proc = subprocess.Popen(
+        ['gpg', '--batch', '--homedir', homedir] + list(args),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    out, err = proc.communicate(kwargs.get('data'))
+    assert proc.returncode == 0, err
+    return out
+
+
+def gpg_gnupg(monkeypatch, homedir, **kwargs):
+    class GPG(object):
+        binary = 'gpg'
+
+        def __init__(self, homedir=None):
+            pass
+
+        def _open_subprocess(self, args=None, passphrase=False):
+            raise NotImplementedError()
+
+    gnupg = pytest.importorskip('gnupg')
+    monkeypatch.setattr(gnupg, 'GPG', GPG)
+    return Gnupg(homedir, **kwargs)
+
+
+def fake_gnupg(monkeypatch, timeout, sleep=30):
+    class FakeGPG(object):
+        _encoding = 'utf-8'
+
+        def __init__(self, homedir=None):
+            self.procs = []
+
+        def _open_subprocess(self, args=None, passphrase=False):
+            proc = subprocess.Popen(['sleep', str(sleep)])
+            self.procs.append(proc)
+            return proc
+
+        def sign(self, data):
+            return self._run()
+
+        def verify_file(self, stream, sig_file=None):
+            return self._run()
+
+        def _run(self):
+            proc = self._open_subprocess()
+            proc.wait()
+            return Result()
+
+    class Result(object):
+        ok = True
+        valid = True
+        data = "signature"
+
+    gnupg = pytest.importorskip('gnupg')
+    monkeypatch.setattr(gnupg, 'GPG', FakeGPG)
+    return Gnupg(timeout=timeout)
@@ -0,0 +1,85 @@
+import subprocess
+
+import pytest
+from zope.interface import implementer
+
+from memoryhole import IOpenPGP
+from memoryhole.gpgv import GpgvVerifier
+from tests.test_gpg import gpg_homedir, run_gpg, which
+
+
+pytestmark = pytest.mark.skipif(not (which('gpg') and which('gpgv')),
+                                reason="needs gpg and gpgv")
+
+
+@pytest.fixture
+def homedirs(tmpdir):
+    homedirs = [gpg_homedir(tmpdir.mkdir(name)) for name in ('us', 'them')]
+    yield homedirs
+    for homedir in homedirs:
+        subprocess.call(['gpgconf', '--homedir', homedir, '--kill',
+                         'gpg-agent'])
+
+
+def test_verify(homedirs):
+    ours, _ = homedirs
+    signature = run_gpg(ours, '-a', '-b', data=b'data')
+    fallback = Fallback()
+    verifier = GpgvVerifier(fallback, homedir=ours)
+    try:
+        assert verifier.verify('data', signature)
+        assert not verifier.verify('other data', signature)
+        assert fallback.verified == 0
+    finally:
+        verifier.close()
+
+
+def test_verify_signer(homedirs):
+    ours, theirs = homedirs
+    fingerprint = [line.split(':')[9] for line in run_gpg(
+        ours, '--with-colons', '--fingerprint', 'me@domain.com'
+    ).decode().splitlines() if line.startswith('fpr:')][0]
+    signature = run_gpg(ours, '-a', '-b', data=b'data')
+    unknown = run_gpg(theirs, '-a', '-b', data=b'data')
+    fallback = Fallback()
+    verifier = GpgvVerifier(fallback, homedir=ours)
+    try:
+        assert verifier.verify_signer('data', signature) == fingerprint
+        assert verifier.verify_signer('other data', signature) is None
+        assert verifier.verify_signer('data', unknown) == 'FALLBACK'
+        assert verifier.key_addresses(fingerprint) == ['me@domain.com']
+    finally:
+        verifier.close()
+
+
+def test_fallback_for_unknown_keys(homedirs):
+    ours, theirs = homedirs
+    signature = run_gpg(theirs, '-a', '-b', data=b'data')
+    fallback = Fallback()
+    verifier = GpgvVerifier(fallback, homedir=ours)
+    try:
+        assert verifier.verify('data', signature) == 'fallback'
+        assert verifier.fallbacks == 1
+
+        # the key is in the snapshot once refreshed
+        run_gpg(ours, '--import', data=run_gpg(theirs, '--export'))
+        verifier.refresh_snapshot()
+        assert verifier.verify('data', signature) is True
+        assert fallback.verified == 1
+    finally:
+        verifier.close()
+
+
+@implementer(IOpenPGP)
+class Fallback(object):
+    verified = 0
+
+    def verify(self, data, signature):
+        self.verified += 1
+        return 'fallback'
+
+    def verify_signer(self, data, signature):
+        return 'FALLBACK'
+
+    def key_addresses(self, key_id):
+        return ['me@domain.com']
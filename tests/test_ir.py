@@ -0,0 +1,103 @@
+import multiprocessing
+import pickle
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.parser import Parser
+
+import pytest
+
+from memoryhole import protect, unwrap, ProtectConfig
+from memoryhole.ir import (
+    CompactEmail, protect_compact, unwrap_compact, shared_memory)
+from memoryhole.message import MemoryHoleMessage
+from tests.test_unwrap import FakeOpenPGP, EMAIL, FROM, TO, SUBJECT
+
+
+parser = Parser()
+
+
+def test_roundtrip():
+    msg = email()
+    msg.as_string()
+    compact = CompactEmail.from_message(msg)
+
+    assert len(compact.parts) == 3
+    assert compact.to_message().as_string() == msg.as_string()
+    copy = pickle.loads(pickle.dumps(compact))
+    assert copy.to_message().as_string() == msg.as_string()
+
+
+def test_protection_kept():
+    openpgp = FakeOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp)
+    encmsg = protect(parser.parsestr(EMAIL), config=conf)
+    compact = CompactEmail.from_message(encmsg)
+    assert compact.to_message().protection_level.score == 1
+
+    msg = unwrap(parser.parsestr(encmsg.as_string()), openpgp)
+    copy = CompactEmail.from_message(msg).to_message()
+    assert isinstance(copy, MemoryHoleMessage)
+    assert copy.protection_level.encrypted_by == set([TO])
+    assert copy['subject'] == SUBJECT
+    assert copy.header_index['subject'].outer == 'encrypted email'
+    assert not copy.is_tampered_header('subject')
+
+
+@pytest.mark.skipif(shared_memory is None, reason="needs shared_memory")
+def test_shared_buffer():
+    msg = email()
+    msg.as_string()
+    compact = CompactEmail.from_message(msg).share(threshold=1024)
+    try:
+        data = pickle.dumps(compact)
+        assert len(data) < len(compact)
+        assert pickle.loads(data).to_message().as_string() == msg.as_string()
+    finally:
+        compact.release()
+
+
+@pytest.mark.skipif(shared_memory is None, reason="needs shared_memory")
+def test_process_pool():
+    pool = multiprocessing.Pool(2)
+    try:
+        compacts = [CompactEmail.from_message(email(n)).share(threshold=1024)
+                    for n in range(4)]
+        protected = pool.map(_protect, compacts)
+        for compact in compacts:
+            compact.release()
+
+        unwrapped = pool.map(_unwrap, protected)
+    finally:
+        pool.close()
+        pool.join()
+
+    for n, compact in enumerate(unwrapped):
+        msg = compact.to_message()
+        assert msg['subject'] == "subject %s" % (n,)
+        assert msg.protection_level.encrypted_by == set([TO])
+        attachment = msg.get_payload(1).get_payload(decode=True)
+        assert attachment == _attachment(n)
+
+
+def _protect(compact):
+    conf = ProtectConfig(openpgp=FakeOpenPGP())
+    return protect_compact(compact, config=conf)
+
+
+def _unwrap(compact):
+    return unwrap_compact(compact, FakeOpenPGP())
+
+
+def email(n=0):
+    msg = MIMEMultipart()
+    msg['From'] = FROM
+    msg['To'] = TO
+    msg['Subject'] = "subject %s" % (n,)
+    msg.attach(MIMEText("body"))
+    msg.attach(MIMEApplication(_attachment(n)))
+    return msg
+
+
+def _attachment(n):
+    return bytes(bytearray(i % 251 for i in range(n, n + 16 * 1024)))
@@ -0,0 +1,174 @@
+"""
+Memory profile of protect and unwrap.
+
+Every stage of the pipeline is wrapped to record its peak and retained
+allocations with tracemalloc, and the peak of the whole operation is
+compared with the size of the message. Run with -s to see the per stage
+report.
+"""
+import functools
+import os
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.parser import Parser
+
+import pytest
+
+from memoryhole import protect, unwrap, ProtectConfig
+from memoryhole import protection, rfc3156, unwrapping
+
+from tests.test_unwrap import FakeOpenPGP
+
+tracemalloc = pytest.importorskip('tracemalloc')
+if not hasattr(tracemalloc, 'reset_peak'):
+    pytest.skip('tracemalloc.reset_peak needs python >= 3.9',
+                allow_module_level=True)
+
+
+SIZES = (64 * 1024, 1024 * 1024)
+DEPTHS = (1, 16)
+
+# peak bytes allocated / message bytes, a new full copy of the message in
+# the pipeline adds at least 1 to them
+MAX_AMPLIFICATION = {
+    'encrypt': 5,
+    'sign': 3.5,
+    'unwrap': 7,
+}
+
+
+class StageProfiler(object):
+    """
+    Record peak and retained memory of nested pipeline stages.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._stack = []
+
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self._enter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._exit(name)
+        return wrapper
+
+    def _enter(self):
+        current, peak = tracemalloc.get_traced_memory()
+        if self._stack:
+            self._stack[-1][1] = max(self._stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        self._stack.append([current, current])
+
+    def _exit(self, name):
+        current, peak = tracemalloc.get_traced_memory()
+        start, outer_peak = self._stack.pop()
+        peak = max(peak, outer_peak)
+        if self._stack:
+            self._stack[-1][1] = max(self._stack[-1][1], peak)
+        stage = self.stages.setdefault(name, {'peak': 0, 'retained': 0})
+        stage['peak'] = max(stage['peak'], peak - start)
+        stage['retained'] = max(stage['retained'], current - start)
+
+
+@pytest.fixture
+def profiler(monkeypatch):
+    profiler = StageProfiler()
+    stages = [
+        (protection, '_protect_headers'),
+        (protection, 'encode_base64_rec'),
+        (protection, 'signed_text'),
+        (rfc3156.RFC3156CompliantGenerator, 'flatten'),
+        (protection.Generator, 'flatten'),
+        (unwrapping, '_decrypt_part'),
+        (unwrapping, '_verify_part'),
+    ]
+    for owner, name in stages:
+        monkeypatch.setattr(owner, name,
+                            profiler.wrap(name, getattr(owner, name)))
+    for name in ('encrypt', 'sign', 'decrypt', 'verify'):
+        monkeypatch.setattr(FakeOpenPGP, name,
+                            profiler.wrap(name, getattr(FakeOpenPGP, name)))
+    return profiler
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('depth', DEPTHS)
+def test_encrypt_amplification(profiler, size, depth):
+    raw = _build_message(size, depth)
+    conf = ProtectConfig(openpgp=FakeOpenPGP())
+    _measure(profiler, 'encrypt', raw,
+             lambda msg: protect(msg, config=conf))
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('depth', DEPTHS)
+def test_sign_amplification(profiler, size, depth):
+    raw = _build_message(size, depth)
+    conf = ProtectConfig(openpgp=FakeOpenPGP())
+    _measure(profiler, 'sign', raw,
+             lambda msg: protect(msg, encrypt=False, config=conf))
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('depth', DEPTHS)
+def test_unwrap_amplification(profiler, size, depth):
+    openpgp = FakeOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp)
+    encmsg = protect(Parser().parsestr(_build_message(size, depth)),
+                     config=conf)
+    raw = encmsg.as_string()
+    _measure(profiler, 'unwrap', raw,
+             lambda msg: unwrap(msg, openpgp, workers=1))
+
+
+def _measure(profiler, operation, raw, func):
+    msg = Parser().parsestr(raw)
+    profiler.stages.clear()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        result = func(msg)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    amplification = float(peak - start) / len(raw)
+    _report(operation, len(raw), amplification, current - start,
+            profiler.stages)
+    assert result is not None
+    assert amplification < MAX_AMPLIFICATION[operation]
+
+
+def _report(operation, size, amplification, retained, stages):
+    print('\n%s %d bytes: amplification %.2f, retained %d' % (
+        operation, size, amplification, retained))
+    for name, stage in sorted(stages.items()):
+        print('    %-20s peak %10d  retained %10d' % (
+            name, stage['peak'], stage['retained']))
+
+
+def _build_message(size, depth):
+    """
+    Build an email with an attachment of size bytes nested in depth
+    multiparts.
+    """
+    attachment = MIMEApplication(os.urandom(size), 'octet-stream')
+    part = attachment
+    for _ in range(depth - 1):
+        parent = MIMEMultipart('mixed')
+        parent.attach(MIMEText('level text'))
+        parent.attach(part)
+        part = parent
+    msg = MIMEMultipart('mixed')
+    msg['From'] = 'me@domain.com'
+    msg['To'] = 'you@other.com'
+    msg['Subject'] = 'memory'
+    msg.attach(MIMEText('body text'))
+    msg.attach(part)
+    return msg.as_string()
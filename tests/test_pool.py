@@ -0,0 +1,242 @@
+import threading
+import time
+from email.parser import Parser
+
+import pytest
+from zope.interface import implementer
+
+from memoryhole import protect, ProtectConfig, IOpenPGP
+from memoryhole.openpgp import BackendError
+from memoryhole.pool import OpenPGPPool, PoolFullError, HedgedOpenPGP
+
+
+EMAIL = """From: me@domain.com
+To: %(to)s
+Subject: subject %(n)s
+
+body %(n)s
+"""
+
+
+def test_concurrent_protect():
+    backends = []
+
+    def factory():
+        backend = Backend()
+        backends.append(backend)
+        return backend
+
+    pool = OpenPGPPool(factory, size=3)
+    conf = ProtectConfig(openpgp=pool)
+    errors = []
+
+    def worker(n):
+        try:
+            to = "user%s@other.com" % (n,)
+            msg = Parser().parsestr(EMAIL % {"to": to, "n": n})
+            encmsg = protect(msg, config=conf)
+            encrypted = encmsg.get_payload(1).get_payload()
+            assert to in encrypted
+            assert "body %s\n" % (n,) in encrypted
+            assert encmsg["to"] == to
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in range(50)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not errors
+    assert len(backends) <= 3
+    assert not any(b.overlapped for b in backends)
+    assert sum(b.calls for b in backends) == 50
+    assert Backend.max_concurrency <= 3
+    assert pool.in_flight == 0
+    assert conf.replaced_headers == ProtectConfig.REPLACED_HEADERS
+
+
+def test_queue_full():
+    backend = Backend()
+    pool = OpenPGPPool(lambda: backend, size=1, max_queue=1, block=False)
+    backend.hold.clear()
+
+    holder = threading.Thread(target=pool.sign, args=("a",))
+    holder.start()
+    waiter = threading.Thread(target=pool.sign, args=("b",))
+    _wait_for(lambda: pool.in_flight == 1)
+    waiter.start()
+    _wait_for(lambda: pool.queued == 1)
+
+    with pytest.raises(PoolFullError):
+        pool.sign("c")
+
+    backend.hold.set()
+    holder.join()
+    waiter.join()
+    assert backend.calls == 2
+
+
+def test_fifo_order():
+    backend = Backend()
+    pool = OpenPGPPool(lambda: backend, size=1)
+    backend.hold.clear()
+
+    threads = [threading.Thread(target=pool.sign, args=(str(n),))
+               for n in range(5)]
+    threads[0].start()
+    _wait_for(lambda: pool.in_flight == 1)
+    for n, t in enumerate(threads[1:]):
+        t.start()
+        _wait_for(lambda: pool.queued == n + 1)
+
+    backend.hold.set()
+    for t in threads:
+        t.join()
+    assert backend.signed == [str(n) for n in range(5)]
+
+
+def test_evict_broken_backend():
+    backends = []
+
+    def factory():
+        backend = Backend()
+        backends.append(backend)
+        return backend
+
+    pool = OpenPGPPool(factory, size=1, max_failures=2)
+    for _ in range(2):
+        with pytest.raises(BackendError):
+            pool.sign(None)
+
+    assert pool.evicted == 1
+    assert pool.sign("data") == "signature"
+    # backends without signaddr sign with their default key
+    assert pool.sign("more", "me@domain.com") == "signature"
+    assert len(backends) == 2
+    assert backends[1].signed == ["data", "more"]
+
+
+def test_request_errors_dont_evict():
+    backends = []
+
+    def factory():
+        backend = Backend()
+        backends.append(backend)
+        return backend
+
+    pool = OpenPGPPool(factory, size=1, max_failures=2)
+    for data in ("bad", None, "bad", "bad", None, "bad"):
+        with pytest.raises(Exception):
+            pool.sign(data)
+
+    assert pool.evicted == 0
+    assert pool.sign("data") == "signature"
+    assert len(backends) == 1
+
+
+def test_factory_failure():
+    backends = []
+
+    def factory():
+        if not backends:
+            backends.append(None)
+            raise RuntimeError("no gpg")
+        backend = Backend()
+        backends.append(backend)
+        return backend
+
+    pool = OpenPGPPool(factory, size=1, timeout=1)
+    with pytest.raises(RuntimeError):
+        pool.sign("data")
+
+    assert pool.in_flight == 0
+    assert pool.sign("data") == "signature"
+    assert pool.in_flight == 0
+    assert len(backends) == 2
+
+
+def test_hedge_slow_operation():
+    primary = Backend()
+    secondary = Backend()
+    hedged = HedgedOpenPGP(primary, secondary, min_samples=5)
+    for _ in range(5):
+        assert hedged.encrypt("data", ["to"]) == "encrypted to to: data"
+    assert hedged.hedge_delay() is not None
+
+    primary.hold.clear()
+    start = time.time()
+    assert hedged.sign("slow") == "signature"
+    assert time.time() - start < 1
+    assert hedged.hedged == 1
+    assert secondary.signed == ["slow"]
+    primary.hold.set()
+
+
+def test_no_hedge_without_samples():
+    primary = Backend()
+    secondary = Backend()
+    hedged = HedgedOpenPGP(primary, secondary, min_samples=5)
+    assert hedged.sign("data") == "signature"
+    assert secondary.calls == 0
+
+
+def _wait_for(condition):
+    for _ in range(500):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("timeout waiting for condition")
+
+
+@implementer(IOpenPGP)
+class Backend(object):
+    max_concurrency = 0
+    _active = 0
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.busy = False
+        self.overlapped = False
+        self.calls = 0
+        self.signed = []
+        self.hold = threading.Event()
+        self.hold.set()
+
+    def encrypt(self, data, encraddr):
+        self._enter()
+        try:
+            time.sleep(0.001)
+            return "encrypted to %s: %s" % (encraddr[0], data)
+        finally:
+            self._exit()
+
+    def sign(self, data):
+        self._enter()
+        try:
+            self.hold.wait()
+            if data is None:
+                raise BackendError("broken backend")
+            if data == "bad":
+                raise ValueError("bad data")
+            self.signed.append(data)
+            return "signature"
+        finally:
+            self._exit()
+
+    def _enter(self):
+        if self.busy:
+            self.overlapped = True
+        self.busy = True
+        self.calls += 1
+        with Backend._lock:
+            Backend._active += 1
+            Backend.max_concurrency = max(Backend.max_concurrency,
+                                          Backend._active)
+
+    def _exit(self):
+        self.busy = False
+        with Backend._lock:
+            Backend._active -= 1
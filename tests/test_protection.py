@@ -3,7 +3,11 @@ from base64 import b64encode
 from email.parser import Parser
 from zope.interface import implementer
 
-from memoryhole import protect, ProtectConfig, IOpenPGP
+from memoryhole import (
+    protect, protect_to_bytes, protect_to_file, ProtectConfig, IOpenPGP
+)
+from memoryhole.cache import ProtectCache
+from memoryhole.rfc3156 import RFC3156CompliantGenerator
 
 
 FROM = "me@domain.com"
@@ -22,6 +26,26 @@ Subject: %(subject)s
     "body": BODY
 }
 
+MULTIPART = """From: %(from)s
+To: %(to)s
+Subject: %(subject)s
+Content-Type: multipart/mixed; boundary="b1"
+
+--b1
+Content-Type: text/plain
+
+%(body)s
+--b1
+Content-Type: text/plain
+
+%(body)s
+--b1--""" % {
+    "from": FROM,
+    "to": TO,
+    "subject": SUBJECT,
+    "body": BODY
+}
+
 parser = Parser()
 
 
@@ -37,6 +61,31 @@ def test_pgp_encrypted_mime():
     assert get_body(encrypter.data) == BODY + '\n'
 
 
+def test_pgp_signed_and_encrypted_mime():
+    msg = parser.parsestr(EMAIL)
+    encrypter = SignEncrypter()
+    conf = ProtectConfig(openpgp=encrypter, replaced_headers=[])
+    encmsg = protect(msg, config=conf, sign=True)
+
+    assert encrypter.calls == 1
+    assert encmsg.get_payload(1).get_payload() == encrypter.encstr
+    assert [TO] == encrypter.encraddr
+    assert FROM == encrypter.signaddr
+    assert get_body(encrypter.data) == BODY + '\n'
+    assert encmsg.protection_level.signed_by == set([FROM])
+    assert encmsg.protection_level.encrypted_by == set([TO])
+    assert encmsg.protection_level.score == 3
+
+
+def test_encrypted_protection_level():
+    msg = parser.parsestr(EMAIL)
+    conf = ProtectConfig(openpgp=Encrypter(), replaced_headers=[])
+    encmsg = protect(msg, config=conf)
+
+    assert not encmsg.protection_level.signed_by
+    assert encmsg.protection_level.encrypted_by == set([TO])
+
+
 def test_kept_headers():
     msg = parser.parsestr(EMAIL)
     encrypter = Encrypter()
@@ -83,6 +132,21 @@ def test_pgp_signed_mime():
     assert encmsg.get_content_type() == "multipart/signed"
 
 
+def test_sign_as_sender():
+    signer = SenderSigner()
+    conf = ProtectConfig(openpgp=signer)
+    signmsg = protect(parser.parsestr(EMAIL), encrypt=False, config=conf)
+
+    assert signer.signaddr == FROM
+    assert signmsg.protection_level.signed_by == set([FROM])
+
+    # the default key might not be the sender's
+    conf = ProtectConfig(openpgp=DefaultKeySigner())
+    signmsg = protect(parser.parsestr(EMAIL), encrypt=False, config=conf)
+    assert signmsg.get_content_type() == 'multipart/signed'
+    assert signmsg.protection_level.signed_by == set([])
+
+
 def test_signed_headers():
     msg = parser.parsestr(EMAIL)
     signer = Signer()
@@ -99,6 +163,119 @@ def test_signed_headers():
     assert signedpart['subject'] == SUBJECT
 
 
+def test_spooled_encryption():
+    encrypter = Encrypter()
+    conf = ProtectConfig(openpgp=encrypter, replaced_headers=[])
+    protect(parser.parsestr(EMAIL), config=conf)
+
+    spooler = Encrypter()
+    spoolconf = ProtectConfig(openpgp=spooler, replaced_headers=[],
+                              spool_threshold=1)
+    msg = parser.parsestr(EMAIL)
+    encmsg = protect(msg, config=spoolconf)
+
+    assert spooler.data == encrypter.data
+    assert encmsg.get_payload(1).get_payload() == spooler.encstr
+    assert msg['subject'] == SUBJECT
+
+
+def test_spooled_encryption_long_headers():
+    long_email = EMAIL.replace(SUBJECT, ' '.join(['word'] * 40))
+    encrypter = Encrypter()
+    conf = ProtectConfig(openpgp=encrypter, replaced_headers=[])
+    protect(parser.parsestr(long_email), config=conf)
+
+    spooler = Encrypter()
+    spoolconf = ProtectConfig(openpgp=spooler, replaced_headers=[],
+                              spool_threshold=1)
+    protect(parser.parsestr(long_email), config=spoolconf)
+
+    assert spooler.data == encrypter.data
+
+
+def test_spooled_signature():
+    signer = Signer()
+    conf = ProtectConfig(openpgp=signer)
+    protect(parser.parsestr(MULTIPART), encrypt=False, config=conf)
+
+    spooler = Signer()
+    spoolconf = ProtectConfig(openpgp=spooler, spool_threshold=1)
+    protect(parser.parsestr(MULTIPART), encrypt=False, config=spoolconf)
+
+    assert spooler.data == signer.data
+    assert spooler.data.endswith('\r\n')
+
+
+def test_small_messages_in_memory():
+    signer = Signer()
+    conf = ProtectConfig(openpgp=signer, spool_threshold=len(BODY) + 1)
+    protect(parser.parsestr(EMAIL), encrypt=False, config=conf)
+
+    assert isinstance(signer.received, str)
+
+
+def test_protect_to_bytes():
+    encrypter = Encrypter()
+    conf = ProtectConfig(openpgp=encrypter)
+    protected = protect_to_bytes(parser.parsestr(EMAIL), config=conf)
+
+    encmsg = protected.message()
+    assert protected.data == encmsg.as_string().encode('utf-8')
+    assert encmsg.get_payload(1).get_payload() == Encrypter.encstr
+    assert protected.protection_level.encrypted_by == set([TO])
+    assert encmsg["subject"] == "encrypted email"
+
+
+def test_protect_to_file_signed():
+    signer = Signer()
+    conf = ProtectConfig(openpgp=signer)
+    out = six.BytesIO()
+    protected = protect_to_file(parser.parsestr(MULTIPART), out,
+                                encrypt=False, config=conf)
+
+    assert protected.data is None
+    assert protected.protection_level.signed_by == set([FROM])
+    signmsg = parser.parsestr(out.getvalue().decode('utf-8'))
+    assert signmsg.get_content_type() == 'multipart/signed'
+    # the line break before the delimiter belongs to the delimiter
+    signedtext = out.getvalue().decode('utf-8').split(
+        '--' + signmsg.get_boundary() + '\n')[1][:-1]
+    assert signer.data == signedtext.replace('\n', '\r\n')
+
+
+def test_protect_to_file_signed_spool():
+    outs = []
+    for threshold in (None, 1):
+        signer = Signer()
+        conf = ProtectConfig(openpgp=signer, spool_threshold=threshold,
+                             cache=ProtectCache(secret=b'secret'))
+        out = six.BytesIO()
+        protected = protect_to_file(parser.parsestr(MULTIPART), out,
+                                    encrypt=False, config=conf)
+        outs.append(out.getvalue())
+
+        signmsg = protected.message()
+        assert signmsg.get_payload(1).get_payload() == Signer.signature
+        fp = six.StringIO()
+        RFC3156CompliantGenerator(fp, mangle_from_=False,
+                                  maxheaderlen=76).flatten(signmsg)
+        assert fp.getvalue().encode('utf-8') == out.getvalue()
+
+    assert outs[0] == outs[1]
+
+
+def test_protect_to_bytes_cached():
+    encrypter = SignEncrypter()
+    conf = ProtectConfig(openpgp=encrypter, cache=ProtectCache())
+    first = protect_to_bytes(parser.parsestr(EMAIL), config=conf)
+    second = protect_to_bytes(parser.parsestr(EMAIL), config=conf)
+
+    assert encrypter.calls == 1
+    assert first.data == second.data
+    assert second.message().as_string().encode('utf-8') == second.data
+    assert second.protection_level.encrypted_by == set([TO])
+
+
 def get_body(data):
     return parser.parsestr(data).get_payload()
 
@@ -108,8 +285,21 @@ class Encrypter(object):
     encstr = "this is encrypted"
 
     def encrypt(self, data, encraddr):
+        self.data = read_data(data)
+        self.encraddr = encraddr
+        return self.encstr
+
+
+@implementer(IOpenPGP)
+class SignEncrypter(object):
+    encstr = "this is signed and encrypted"
+    calls = 0
+
+    def encrypt(self, data, encraddr, signaddr=None):
+        self.calls += 1
         self.data = data
         self.encraddr = encraddr
+        self.signaddr = signaddr
         return self.encstr
 
 
@@ -117,6 +307,28 @@ class Encrypter(object):
 class Signer(object):
     signature = "this is a signature"
 
-    def sign(self, data):
-        self.data = data
+    def sign(self, data, signaddr=None):
+        self.received = data
+        self.data = read_data(data)
         return self.signature
+
+
+@implementer(IOpenPGP)
+class SenderSigner(object):
+
+    def sign(self, data, signaddr=None):
+        self.signaddr = signaddr
+        return "signature"
+
+
+@implementer(IOpenPGP)
+class DefaultKeySigner(object):
+
+    def sign(self, data):
+        return "signature"
+
+
+def read_data(data):
+    if hasattr(data, 'read'):
+        data = data.read().decode('utf-8')
+    return data
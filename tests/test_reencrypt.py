@@ -0,0 +1,215 @@
+import json
+import mailbox
+import os
+import threading
+from email.parser import BytesParser, Parser
+
+import pytest
+from zope.interface import implementer
+
+from memoryhole import reencrypt
+
+from memoryhole import protect, ProtectConfig, IOpenPGP
+from memoryhole.openpgp import Decryption
+from memoryhole.reencrypt import Reencrypter
+
+
+EMAIL = """From: me@domain.com
+To: you@other.com
+Subject: subject %s
+
+body %s
+"""
+OWNER = 'owner@domain.com'
+
+
+def test_reencrypt_mbox(tmpdir):
+    source = make_mbox(tmpdir, 3, plain=1, broken=1)
+    destination = str(tmpdir.join('new'))
+    old, new = FakeOpenPGP('old'), FakeOpenPGP('new')
+    reports = []
+
+    stats = Reencrypter(old, new, OWNER, report=reports.append).run(
+        source, destination)
+
+    assert stats.messages == 5
+    assert stats.reencrypted == 3
+    assert stats.copied == 1
+    assert stats.failed == [4]
+    assert reports[-1].messages == 5
+    emails = read_maildir(destination)
+    assert len(emails) == 5
+    for n in range(3):
+        encpart = emails[n].get_payload(1).get_payload()
+        assert encpart.startswith('new:you@other.com,%s:' % (OWNER,))
+        decrypted = new.decrypt(encpart)
+        assert 'Subject: subject %s' % (n,) in decrypted
+        assert 'text/rfc822-headers' in decrypted
+        assert decrypted == old.decrypt(original(source, n))
+        assert emails[n]['subject'] == 'encrypted email'
+    assert emails[3]['subject'] == 'subject 3'
+    assert emails[4].get_payload(1).get_payload() == 'broken'
+
+
+def test_resume(tmpdir):
+    source = make_mbox(tmpdir, 5)
+    destination = str(tmpdir.join('new'))
+    checkpoint = str(tmpdir.join('checkpoint'))
+    with open(checkpoint, 'w') as f:
+        json.dump({'source': source, 'done': 3, 'failed': []}, f)
+    old, new = FakeOpenPGP('old'), FakeOpenPGP('new')
+
+    stats = Reencrypter(old, new, OWNER, checkpoint=checkpoint,
+                        checkpoint_every=1).run(source, destination)
+
+    assert stats.messages == 2
+    assert old.decrypted == 2
+    assert sorted(os.listdir(os.path.join(destination, 'new'))) == [
+        '00000003.reencrypted', '00000004.reencrypted']
+    with open(checkpoint) as f:
+        assert json.load(f)['done'] == 5
+
+
+def test_signed_emails(tmpdir):
+    source = make_mbox(tmpdir, 2, sign=True)
+    old = FakeOpenPGP('old')
+
+    unsigned = str(tmpdir.join('unsigned'))
+    stats = Reencrypter(old, FakeOpenPGP('new'), OWNER).run(source, unsigned)
+
+    # copied as they were, not left without their signature
+    assert stats.failed == [0, 1]
+    for n, email in enumerate(read_maildir(unsigned)):
+        assert email.get_payload(1).get_payload() == original(source, n)
+
+    new = FakeOpenPGP('new')
+    signed = str(tmpdir.join('signed'))
+    stats = Reencrypter(old, new, OWNER, signaddr=OWNER).run(source, signed)
+
+    assert stats.reencrypted == 2
+    for email in read_maildir(signed):
+        decryption = new.decrypt_verify(email.get_payload(1).get_payload())
+        assert decryption.valid
+        assert decryption.key_id == OWNER
+
+    with pytest.raises(ValueError):
+        Reencrypter(DecryptOnly('old'), new, OWNER)
+
+
+def test_reencrypt_keeps_bytes():
+    conf = ProtectConfig(openpgp=FakeOpenPGP('old'))
+    raw = protect(Parser().parsestr(EMAIL % (0, 0)), config=conf).as_bytes()
+    head, body = raw.split(b'\n\n', 1)
+    raw = (head + b'\nX-Folded: one\n\t two' + b'\n\n' + body).replace(
+        b'\n', b'\r\n')
+    new = FakeOpenPGP('new')
+
+    reencrypted = Reencrypter(FakeOpenPGP('old'), new, OWNER).reencrypt(raw)
+
+    assert reencrypted.split(b'\r\n\r\n')[0] == raw.split(b'\r\n\r\n')[0]
+    assert b'\n' not in reencrypted.replace(b'\r\n', b'')
+    msg = BytesParser().parsebytes(reencrypted)
+    decrypted = new.decrypt(msg.get_payload(1).get_payload())
+    assert 'Subject: subject 0' in decrypted
+
+
+def test_read_error_frees_slot(tmpdir, monkeypatch):
+    source = make_mbox(tmpdir, 3)
+    destination = str(tmpdir.join('new'))
+    slots = []
+    reads = []
+
+    def get_bytes(box, key):
+        reads.append(key)
+        if len(reads) == 2:
+            raise IOError('read error')
+        return box.get_bytes(key)
+
+    monkeypatch.setattr(reencrypt, '_get_bytes', get_bytes)
+    monkeypatch.setattr(reencrypt.threading, 'BoundedSemaphore',
+                        lambda n: slots.append(Slots(n)) or slots[-1])
+    reencrypter = Reencrypter(FakeOpenPGP('old'), FakeOpenPGP('new'), OWNER)
+    with pytest.raises(IOError):
+        reencrypter.run(source, destination)
+
+    assert slots[0].taken == 0
+
+
+class Slots(object):
+
+    semaphore = threading.BoundedSemaphore
+
+    def __init__(self, n):
+        self._semaphore = self.semaphore(n)
+        self.taken = 0
+
+    def acquire(self):
+        self._semaphore.acquire()
+        self.taken += 1
+
+    def release(self):
+        self._semaphore.release()
+        self.taken -= 1
+
+
+def make_mbox(tmpdir, encrypted, plain=0, broken=0, sign=False):
+    path = str(tmpdir.join('mbox'))
+    box = mailbox.mbox(path)
+    conf = ProtectConfig(openpgp=FakeOpenPGP('old'))
+    for n in range(encrypted):
+        msg = Parser().parsestr(EMAIL % (n, n))
+        box.add(protect(msg, config=conf, sign=sign).as_string())
+    for n in range(encrypted, encrypted + plain):
+        box.add(EMAIL % (n, n))
+    for n in range(broken):
+        msg = protect(Parser().parsestr(EMAIL % (n, n)), config=conf)
+        msg.get_payload(1).set_payload('broken')
+        box.add(msg.as_string())
+    box.close()
+    return path
+
+
+def original(source, n):
+    box = mailbox.mbox(source)
+    return box[n].get_payload(1).get_payload()
+
+
+def read_maildir(path):
+    directory = os.path.join(path, 'new')
+    emails = []
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name)) as f:
+            emails.append(Parser().parse(f))
+    return emails
+
+
+@implementer(IOpenPGP)
+class FakeOpenPGP(object):
+
+    def __init__(self, key):
+        self.key = key
+        self.decrypted = 0
+
+    def encrypt(self, data, encraddr, signaddr=None):
+        if signaddr is not None:
+            data = 'signed by %s\n%s' % (signaddr, data)
+        return '%s:%s:%s' % (self.key, ','.join(encraddr), data)
+
+    def decrypt(self, data):
+        return self.decrypt_verify(data).data
+
+    def decrypt_verify(self, data):
+        key, _, data = data.partition(':')
+        if key != self.key:
+            raise RuntimeError('Not encrypted to ' + self.key)
+        self.decrypted += 1
+        data = data.partition(':')[2]
+        signer = None
+        if data.startswith('signed by '):
+            signer, data = data[len('signed by '):].split('\n', 1)
+        return Decryption(data, signer is not None, signer is not None,
+                          signer)
+
+
+class DecryptOnly(FakeOpenPGP):
+    decrypt_verify = None
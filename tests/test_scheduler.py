@@ -0,0 +1,132 @@
+import threading
+import time
+from email.parser import Parser
+
+import pytest
+from zope.interface import implementer
+
+from memoryhole import ProtectConfig, IOpenPGP
+from memoryhole.scheduler import ProtectScheduler, DeadlineExceeded
+
+
+EMAIL = """From: me@domain.com
+To: you@other.com
+Subject: %s
+
+body text
+"""
+
+
+def new_msg(subject='subject'):
+    return Parser().parsestr(EMAIL % (subject,))
+
+
+def test_interactive_latency_under_bulk_load():
+    openpgp = SlowOpenPGP(0.05)
+    scheduler = ProtectScheduler(
+        {'interactive': (10, None), 'bulk': (1, 1)}, workers=2,
+        config=ProtectConfig(openpgp=openpgp))
+    try:
+        bulk = [scheduler.submit(new_msg(), 'bulk') for _ in range(10)]
+        time.sleep(0.01)
+        waits = []
+        for _ in range(3):
+            start = time.time()
+            scheduler.submit(new_msg(), 'interactive').result(5)
+            waits.append(time.time() - start)
+        for job in bulk:
+            job.result(5)
+    finally:
+        scheduler.close()
+
+    assert max(waits) < 0.05 * 2.5
+    stats = scheduler.stats()
+    assert stats['bulk']['done'] == 10
+    assert stats['interactive']['done'] == 3
+    assert stats['bulk']['max_wait'] > stats['interactive']['max_wait']
+    assert openpgp.max_concurrency <= 2
+
+
+def test_weighted_share():
+    openpgp = SlowOpenPGP(0.01)
+    scheduler = ProtectScheduler({'a': (3, None), 'b': (1, None)},
+                                 workers=1,
+                                 config=ProtectConfig(openpgp=openpgp))
+    openpgp.hold.clear()
+    try:
+        first = scheduler.submit(new_msg('first'), 'a')
+        _wait_for(lambda: scheduler.stats()['a']['running'] == 1)
+        jobs = []
+        for n in range(8):
+            jobs.append(scheduler.submit(new_msg('a'), 'a'))
+            jobs.append(scheduler.submit(new_msg('b'), 'b'))
+        openpgp.hold.set()
+        first.result(5)
+        for job in jobs:
+            job.result(5)
+    finally:
+        scheduler.close()
+
+    order = openpgp.subjects[1:9]
+    assert order.count('a') == 6
+    assert order.count('b') == 2
+
+
+def test_deadlines():
+    openpgp = SlowOpenPGP(0)
+    scheduler = ProtectScheduler({'bulk': (1, None)}, workers=1,
+                                 config=ProtectConfig(openpgp=openpgp))
+    openpgp.hold.clear()
+    try:
+        blocker = scheduler.submit(new_msg('blocker'), 'bulk')
+        _wait_for(lambda: scheduler.stats()['bulk']['running'] == 1)
+        late = scheduler.submit(new_msg('late'), 'bulk')
+        expired = scheduler.submit(new_msg('expired'), 'bulk',
+                                   deadline=time.time() + 0.01)
+        urgent = scheduler.submit(new_msg('urgent'), 'bulk',
+                                  deadline=time.time() + 60)
+        time.sleep(0.05)
+        openpgp.hold.set()
+
+        for job in (blocker, late, urgent):
+            job.result(5)
+        with pytest.raises(DeadlineExceeded):
+            expired.result(5)
+    finally:
+        scheduler.close()
+
+    assert openpgp.subjects == ['blocker', 'urgent', 'late']
+    assert scheduler.stats()['bulk']['expired'] == 1
+
+
+def _wait_for(condition):
+    for _ in range(500):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("timeout waiting for condition")
+
+
+@implementer(IOpenPGP)
+class SlowOpenPGP(object):
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.subjects = []
+        self.active = 0
+        self.max_concurrency = 0
+        self.lock = threading.Lock()
+        self.hold = threading.Event()
+        self.hold.set()
+
+    def encrypt(self, data, encraddr):
+        with self.lock:
+            self.active += 1
+            self.max_concurrency = max(self.max_concurrency, self.active)
+        self.hold.wait()
+        time.sleep(self.delay)
+        subject = Parser().parsestr(data).get_payload(1)['subject']
+        with self.lock:
+            self.subjects.append(subject)
+            self.active -= 1
+        return "encrypted"
@@ -0,0 +1,106 @@
+import json
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import pytest
+
+from memoryhole import protect, unwrap, ProtectConfig, MIMELimits
+from memoryhole.slowops import SlowOpRecorder, message_shape
+from memoryhole.walk import MIMELimitError
+
+from tests.test_unwrap import (
+    EMAIL, FROM, SUBJECT, FakeOpenPGP, parser, reparse
+)
+
+
+def test_slow_unwrap_recorded():
+    openpgp = FakeOpenPGP(delay=0.3)
+    encmsg = reparse(protect(parser.parsestr(EMAIL),
+                             config=ProtectConfig(openpgp=openpgp)))
+    recorder = SlowOpRecorder(threshold=0.1, interval=0.01)
+
+    msg = unwrap(encmsg, openpgp, recorder=recorder)
+
+    assert msg['subject'] == SUBJECT
+    record, = recorder.records()
+    assert record.operation == 'unwrap'
+    assert record.reason == 'slow'
+    assert record.seconds >= 0.3
+    assert record.profile is None
+    assert any(':_wait' in stack for stack, _ in record.stacks)
+    assert record.shape['recipients'] == 1
+    assert record.shape['parts'][0][1] == 'multipart/encrypted'
+
+    dump = recorder.dump()
+    assert json.loads(dump)[0]['operation'] == 'unwrap'
+    # nothing about the content of the email
+    for private in (FROM, SUBJECT, 'body text'):
+        assert private not in dump
+
+
+def test_sampled_operations():
+    recorder = SlowOpRecorder(threshold=None, sample_rate=1, max_records=2)
+    conf = ProtectConfig(openpgp=FakeOpenPGP(), recorder=recorder)
+
+    for _ in range(3):
+        protect(parser.parsestr(EMAIL), config=conf)
+
+    assert recorder.recorded == 3
+    records = recorder.records()
+    assert len(records) == 2
+    assert records[0].reason == 'sampled'
+    assert '_encrypt_mime' in records[0].profile
+    assert not records[0].stacks
+
+
+def test_fast_operations_not_recorded():
+    recorder = SlowOpRecorder(threshold=10)
+    conf = ProtectConfig(openpgp=FakeOpenPGP(), recorder=recorder)
+
+    protect(parser.parsestr(EMAIL), config=conf)
+
+    assert recorder.records() == []
+
+
+def test_failed_operation_recorded():
+    recorder = SlowOpRecorder(sample_rate=1)
+    conf = ProtectConfig(openpgp=FakeOpenPGP(), recorder=recorder,
+                         limits=MIMELimits(max_size=1))
+
+    with pytest.raises(MIMELimitError):
+        protect(parser.parsestr(EMAIL), config=conf)
+
+    assert recorder.records()[0].error == 'MIMELimitError'
+
+
+def test_message_shape():
+    msg = MIMEMultipart('mixed', _subparts=[
+        MIMEMultipart('alternative', _subparts=[MIMEText('a' * 10),
+                                                MIMEText('b' * 20)]),
+        MIMEText('c' * 30)])
+    msg['To'] = 'one@domain.com, two@domain.com'
+    msg['Cc'] = 'three@domain.com'
+
+    shape = message_shape(msg)
+
+    assert shape['part_count'] == 5
+    assert not shape['truncated']
+    assert shape['size'] == 60
+    assert shape['recipients'] == 3
+    assert shape['top_headers'] == 4
+    assert [part[:3] for part in shape['parts']] == [
+        [0, 'multipart/mixed', 0],
+        [1, 'multipart/alternative', 0],
+        [2, 'text/plain', 10],
+        [2, 'text/plain', 20],
+        [1, 'text/plain', 30]]
+
+    shape = message_shape(msg, max_parts=3)
+
+    assert shape['part_count'] == 3
+    assert shape['truncated']
+    assert shape['size'] == 10
+    assert [part[:3] for part in shape['parts']] == [
+        [0, 'multipart/mixed', 0],
+        [1, 'multipart/alternative', 0],
+        [2, 'text/plain', 10]]
@@ -0,0 +1,153 @@
+import os
+from base64 import b64decode, b64encode
+from email.parser import Parser
+
+from zope.interface import implementer
+
+from memoryhole import unwrap, ProtectConfig, IOpenPGP, MIMELimits
+from memoryhole import spool as spool_module
+from memoryhole.spool import ProtectSpool
+
+
+EMAIL = """From: me@domain.com
+To: you@other.com
+Subject: subject %s
+
+body %s
+"""
+
+
+def test_spool_protects_emails(tmpdir):
+    openpgp = SpoolOpenPGP()
+    spool = ProtectSpool(str(tmpdir), ProtectConfig(openpgp=openpgp),
+                         workers=2, batch=3, poll=0.01)
+    idents = [spool.submit(EMAIL % (n, n)) for n in range(10)]
+
+    spool.run(until_empty=True)
+
+    assert spool.counts() == {'incoming': 0, 'active': 0, 'outgoing': 10,
+                              'failed': 0}
+    for n, ident in enumerate(idents):
+        msg = read(tmpdir, 'outgoing', ident)
+        assert msg['subject'] == 'encrypted email'
+        assert unwrap(msg, openpgp)['subject'] == 'subject %s' % (n,)
+
+
+def test_worker_crash(tmpdir):
+    crashed = str(tmpdir.join('crashed'))
+    spool = ProtectSpool(str(tmpdir.join('spool')),
+                         ProtectConfig(openpgp=SpoolOpenPGP(crash=crashed)),
+                         workers=1, backoff=0, poll=0.01)
+    ident = spool.submit(EMAIL % (1, 1))
+
+    spool.run(until_empty=True)
+
+    # the worker died protecting the email, and a new one did it again
+    assert os.path.exists(crashed)
+    assert spool.counts()['outgoing'] == 1
+    assert read(tmpdir.join('spool'), 'outgoing', ident)['to'] == (
+        'you@other.com')
+
+
+def test_retry_and_dead_letter(tmpdir, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(spool_module.time, 'time', lambda: now[0])
+    openpgp = SpoolOpenPGP(fail=2)
+    spool = ProtectSpool(str(tmpdir), ProtectConfig(openpgp=openpgp),
+                         max_attempts=2, backoff=60)
+    spool.submit(EMAIL % (1, 1))
+
+    assert spool.process() == 1
+    assert spool.counts()['incoming'] == 1
+    # waiting for the backoff
+    now[0] += 59
+    assert spool.process() == 0
+    assert openpgp.calls == 1
+
+    now[0] += 1
+    assert spool.process() == 1
+    assert spool.counts()['failed'] == 1
+    ident = spool.submit(EMAIL % (2, 2))
+    assert spool.process() == 1
+    assert os.listdir(str(tmpdir.join('outgoing'))) == [ident]
+
+    error = [f for f in tmpdir.join('failed').listdir()
+             if f.ext == '.error'][0]
+    assert 'attempts: 2' in error.read()
+
+
+def test_malformed_email_not_retried(tmpdir):
+    openpgp = SpoolOpenPGP()
+    config = ProtectConfig(openpgp=openpgp, limits=MIMELimits(max_size=10))
+    spool = ProtectSpool(str(tmpdir), config, backoff=0)
+    spool.submit(EMAIL % (1, 'x' * 20))
+
+    spool.process()
+
+    assert spool.counts()['failed'] == 1
+    assert openpgp.calls == 0
+
+
+def test_recover_claimed(tmpdir):
+    spool = ProtectSpool(str(tmpdir), ProtectConfig(openpgp=SpoolOpenPGP()),
+                         max_attempts=2, backoff=0)
+    ident = spool.submit(EMAIL % (1, 1))
+    # a worker claimed it and died
+    name = os.listdir(str(tmpdir.join('incoming')))[0]
+    os.rename(str(tmpdir.join('incoming', name)),
+              str(tmpdir.join('active', '12345-' + name)))
+    assert spool.process() == 0
+
+    spool.recover()
+
+    # it counts as an attempt
+    name, = os.listdir(str(tmpdir.join('incoming')))
+    assert spool_module._parse(name)[2] == 1
+    assert spool.process() == 1
+    assert os.listdir(str(tmpdir.join('outgoing'))) == [ident]
+
+    # emails that kill every worker end up failed
+    spool.submit(EMAIL % (2, 2))
+    for _ in range(2):
+        name, = os.listdir(str(tmpdir.join('incoming')))
+        os.rename(str(tmpdir.join('incoming', name)),
+                  str(tmpdir.join('active', '12345-' + name)))
+        spool.recover()
+    assert spool.counts()['failed'] == 1
+
+
+def test_non_utf8_email(tmpdir):
+    openpgp = SpoolOpenPGP()
+    spool = ProtectSpool(str(tmpdir), ProtectConfig(openpgp=openpgp))
+    ident = spool.submit((EMAIL % (1, 'caf\xe9')).encode('latin-1'))
+
+    assert spool.process() == 1
+
+    assert spool.counts()['outgoing'] == 1
+    assert read(tmpdir, 'outgoing', ident)['subject'] == 'encrypted email'
+
+
+def read(spooldir, directory, ident):
+    with open(str(spooldir.join(directory, ident))) as f:
+        return Parser().parse(f)
+
+
+@implementer(IOpenPGP)
+class SpoolOpenPGP(object):
+
+    def __init__(self, crash=None, fail=0):
+        self.crash = crash
+        self.fail = fail
+        self.calls = 0
+
+    def encrypt(self, data, encraddr):
+        self.calls += 1
+        if self.crash is not None and not os.path.exists(self.crash):
+            open(self.crash, 'w').close()
+            os._exit(1)
+        if self.calls <= self.fail:
+            raise RuntimeError('gpg failed')
+        return b64encode(data.encode('utf-8')).decode('ascii')
+
+    def decrypt(self, data):
+        return b64decode(data).decode('utf-8')
@@ -0,0 +1,110 @@
+from email.parser import Parser
+
+import pytest
+from zope.interface import implementer
+
+from memoryhole import protect, ProtectConfig, IOpenPGP
+from memoryhole.tenant import TenantRouter
+
+
+EMAIL = """From: Me <me@%(domain)s>
+To: you@other.com
+Subject: some subject
+
+body text
+"""
+
+parser = Parser()
+
+
+def test_route_by_sender_domain():
+    router = TenantRouter('/var/lib/memoryhole/%s', factory=Backend)
+
+    for domain in ('one.org', 'two.org', 'ONE.org'):
+        msg = parser.parsestr(EMAIL % {'domain': domain})
+        conf = ProtectConfig(openpgp=router.route(msg))
+        encmsg = protect(msg, config=conf)
+        assert encmsg.get_payload(1).get_payload() == (
+            'encrypted with /var/lib/memoryhole/%s' % domain.lower())
+
+    assert len(router) == 2
+    metrics = router.metrics()
+    assert metrics['one.org'].operations == 2
+    assert metrics['two.org'].operations == 1
+    assert metrics['two.org'].pools == 1
+
+
+def test_route_by_recipient():
+    router = TenantRouter(lambda domain: domain, factory=Backend)
+    msg = parser.parsestr("To: you@other.com\n\nbody\n")
+    assert router.route(msg) is router.backend('other.com')
+
+    with pytest.raises(ValueError):
+        router.route(parser.parsestr("Subject: nobody\n\nbody\n"))
+
+
+def test_route_unwrap_by_recipient():
+    router = TenantRouter(lambda domain: domain, factory=Backend)
+    msg = parser.parsestr(EMAIL % {'domain': 'one.org'})
+
+    assert router.route_unwrap(msg) is router.backend('other.com')
+    assert router.route_unwrap(msg, 'me@two.org') is router.backend('two.org')
+    with pytest.raises(ValueError):
+        router.route_unwrap(parser.parsestr("From: me@one.org\n\nbody\n"))
+
+
+def test_invalid_domains():
+    router = TenantRouter('/var/lib/memoryhole/%s', factory=Backend)
+    for domain in ('..', 'a/../b', 'a..b', '-a.org', 'a.org\n', '', 'a_b',
+                   'a' * 64 + '.org'):
+        with pytest.raises(ValueError):
+            router.backend(domain)
+    with pytest.raises(ValueError):
+        router.route(parser.parsestr(EMAIL % {'domain': '../etc'}))
+    assert len(router) == 0
+    router.backend('xn--caf-dma.example-1.org')
+
+
+def test_lru_eviction():
+    router = TenantRouter('%s', factory=Backend, max_tenants=2)
+
+    one = router.backend('one.org')
+    router.backend('two.org')
+    assert router.backend('one.org') is one
+    router.backend('three.org')
+
+    assert len(router) == 2
+    assert router.backend('one.org') is one
+    assert router.metrics()['two.org'].evictions == 1
+    router.backend('two.org')
+    assert router.metrics()['two.org'].pools == 2
+
+
+def test_metrics_bounded():
+    router = TenantRouter('%s', factory=Backend, max_tenants=2,
+                          max_metrics=3)
+    for n in range(10):
+        router.backend('domain%s.org' % (n,))
+
+    assert sorted(router.metrics()) == [
+        'domain7.org', 'domain8.org', 'domain9.org']
+
+
+def test_errors_metrics():
+    router = TenantRouter('%s', factory=Backend)
+    with pytest.raises(RuntimeError):
+        router.backend('one.org').sign('data')
+    assert router.metrics()['one.org'].errors == 1
+
+
+@implementer(IOpenPGP)
+class Backend(object):
+
+    def __init__(self, homedir):
+        self.homedir = homedir
+
+    def encrypt(self, data, encraddr):
+        return 'encrypted with %s' % (self.homedir,)
+
+    def sign(self, data):
+        raise RuntimeError('no secret key')
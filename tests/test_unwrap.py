@@ -0,0 +1,446 @@
+import hashlib
+import threading
+import time
+from base64 import b64decode, b64encode
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.parser import Parser
+
+from zope.interface import implementer
+
+from memoryhole import (
+    protect, unwrap, ProtectConfig, IOpenPGP, UnwrapFeeder
+)
+from memoryhole.message import MemoryHoleMessage
+from memoryhole.openpgp import Decryption
+
+
+FROM = "me@domain.com"
+TO = "you@other.com"
+SUBJECT = "some subject"
+EMAIL = """From: %(from)s
+To: %(to)s
+Subject: %(subject)s
+
+body text
+""" % {
+    "from": FROM,
+    "to": TO,
+    "subject": SUBJECT,
+}
+
+parser = Parser()
+
+
+def test_unwrap_encrypted():
+    openpgp = FakeOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp)
+    encmsg = reparse(protect(parser.parsestr(EMAIL), config=conf))
+    assert encmsg['subject'] != SUBJECT
+
+    msg = unwrap(encmsg, openpgp)
+
+    assert isinstance(msg, MemoryHoleMessage)
+    assert msg['subject'] == SUBJECT
+    assert msg.get_payload() == "body text\n"
+    assert msg.protection_level.encrypted_by == set([TO])
+    assert not msg.protection_level.signed_by
+    assert msg.get_protected_header('subject').encrypted_by == set([TO])
+    outer = dict((k.lower(), v) for k, v in msg.outer_headers)
+    assert outer['subject'] == 'encrypted email'
+
+
+def test_unwrap_encrypted_8bit():
+    openpgp = BytesOpenPGP()
+    encmsg = protect(parser.parsestr(EMAIL),
+                     config=ProtectConfig(openpgp=openpgp))
+    content = (b'From: ' + FROM.encode('ascii') + b'\n'
+               b'Subject: caf\xe9\n'
+               b'Content-Type: text/plain; charset="iso-8859-1"\n'
+               b'Content-Transfer-Encoding: 8bit\n\n'
+               b'caf\xe9\n')
+    encmsg.get_payload(1).set_payload(b64encode(content).decode('ascii'))
+
+    msg = unwrap(reparse(encmsg), openpgp)
+
+    assert msg.protection_level.encrypted_by == set([TO])
+    assert msg.get_payload(decode=True) == b'caf\xe9\n'
+    assert msg.get_content_charset() == 'iso-8859-1'
+    assert not msg.is_tampered_header('subject')
+
+
+def test_unwrap_signed():
+    openpgp = FakeOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp)
+    signmsg = reparse(protect(parser.parsestr(EMAIL), encrypt=False,
+                              config=conf))
+
+    msg = unwrap(signmsg, openpgp)
+
+    assert msg.protection_level.signed_by == set([FROM])
+    assert msg.get_protected_header('subject').protection_level.score == 2
+
+
+def test_unwrap_signed_by_other_key():
+    openpgp = FakeOpenPGP(addresses=["attacker@evil.com"])
+    conf = ProtectConfig(openpgp=openpgp)
+    signmsg = reparse(protect(parser.parsestr(EMAIL), encrypt=False,
+                              config=conf))
+
+    msg = unwrap(signmsg, openpgp)
+    assert not msg.protection_level.signed_by
+
+    # without verify_signer the signer can't be checked
+    class VerifyOnly(FakeOpenPGP):
+        verify_signer = None
+
+    msg = unwrap(signmsg, VerifyOnly())
+    assert not msg.protection_level.signed_by
+
+
+def test_unwrap_signed_original_bytes():
+    openpgp = FakeOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp)
+    content = MIMEMultipart('mixed', _subparts=[MIMEText("one"),
+                                                MIMEText("two")])
+    content['From'] = FROM
+    content['Subject'] = ' '.join(['long subject'] * 20)
+    raw = protect(content, encrypt=False, config=conf).as_bytes()
+
+    msg = unwrap(raw, openpgp)
+    assert msg.protection_level.signed_by == set([FROM])
+    assert msg['subject'].replace('\n ', ' ') == content['subject']
+    assert unwrap(parser.parsestr(raw.decode('utf-8')),
+                  openpgp).protection_level.signed_by == set([FROM])
+
+    # folded in transit, the signature is not valid anymore
+    signed = raw.rindex(b'Subject: long subject long')
+    refolded = raw[:signed] + raw[signed:].replace(
+        b'long subject long', b'long subject\n long', 1)
+    msg = unwrap(refolded, openpgp)
+    assert not msg.protection_level.signed_by
+
+
+def test_unwrap_signed_decoy():
+    openpgp = FakeOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp)
+    signmsg = protect(parser.parsestr(EMAIL), encrypt=False, config=conf)
+    raw = signmsg.as_bytes()
+    signed = raw[raw.index(b'\n\n') + 2:]
+    content_type = signmsg['content-type'].encode('ascii')
+
+    def mixed(boundary, *parts):
+        return b''.join(
+            [b'From: ' + FROM.encode('ascii') + b'\n'
+             b'Content-Type: multipart/mixed; boundary="' + boundary +
+             b'"\n\n'] +
+            [b'--' + boundary + b'\n' + part + b'\n' for part in parts] +
+            [b'--' + boundary + b'--\n'])
+
+    genuine = mixed(b'outer', b'Content-Type: ' + content_type + b'\n\n' +
+                    signed)
+    msg = unwrap(genuine, openpgp)
+    assert msg.get_payload(0).protection_level.signed_by == set([FROM])
+
+    # a copy of the signed part earlier in the email doesn't sign a forgery
+    forged = mixed(b'outer', b'Content-Type: text/plain\n\n' + signed,
+                   b'Content-Type: ' + content_type + b'\n\n' +
+                   signed.replace(b64encode(b'body text\n'),
+                                  b64encode(b'forged text\n')))
+    msg = unwrap(forged, openpgp)
+    assert msg.get_payload(1).get_payload(decode=True) == b'forged text\n'
+    assert not msg.get_payload(1).protection_level.signed_by
+
+    # neither do boundaries used by outer parts
+    boundary = signmsg.get_boundary().encode('ascii')
+    ambiguous = mixed(boundary, b'Content-Type: ' + content_type + b'\n\n' +
+                      signed)
+    msg = unwrap(ambiguous, openpgp)
+    for part in msg.walk():
+        assert not isinstance(part, MemoryHoleMessage)
+
+
+def test_unwrap_bad_signature():
+    openpgp = FakeOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp)
+    signmsg = protect(parser.parsestr(EMAIL), encrypt=False, config=conf)
+    signmsg.get_payload(1).set_payload("bad signature")
+
+    msg = unwrap(reparse(signmsg), openpgp)
+
+    assert msg.protection_level.score == 0
+    assert msg.get_protected_header('subject') is None
+
+
+def test_unwrap_nested_parts_in_parallel():
+    openpgp = FakeOpenPGP(delay=0.2)
+    conf = ProtectConfig(openpgp=openpgp)
+    outer = MIMEMultipart('mixed')
+    outer['From'] = FROM
+    outer['To'] = TO
+    outer.attach(MIMEText("cover text"))
+    for n in range(4):
+        part = MIMEText("attachment %s" % (n,))
+        part['From'] = FROM
+        outer.attach(protect(part, encrypt=(n % 2 == 0), config=conf))
+
+    start = time.time()
+    msg = unwrap(reparse(outer), openpgp, workers=4)
+    elapsed = time.time() - start
+
+    assert openpgp.max_concurrency == 4
+    assert elapsed < 4 * 0.2
+    parts = msg.get_payload()
+    assert parts[0].get_payload() == "cover text"
+    for n, part in enumerate(parts[1:]):
+        assert isinstance(part, MemoryHoleMessage)
+        assert part.get_payload(decode=True) == ("attachment %s" % n).encode()
+        assert part.protection_level.score == (1 if n % 2 == 0 else 2)
+
+
+def test_unwrap_signed_and_encrypted():
+    openpgp = FakeOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp)
+    signmsg = protect(parser.parsestr(EMAIL), encrypt=False, config=conf)
+    encmsg = protect(signmsg, config=conf)
+
+    msg = unwrap(reparse(encmsg), openpgp)
+
+    assert msg.protection_level.score == 3
+
+
+def test_header_index():
+    openpgp = FakeOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp)
+    encmsg = reparse(protect(parser.parsestr(EMAIL), config=conf))
+    encmsg['Received'] = 'from relay.example'
+
+    msg = unwrap(encmsg, openpgp)
+
+    subject = msg.header_index['subject']
+    assert subject.value == SUBJECT
+    assert subject.protected == SUBJECT
+    assert subject.outer == 'encrypted email'
+    assert not subject.tampered
+    assert subject.protection_level.encrypted_by == set([TO])
+
+    received = msg.header_index['received']
+    assert received.protected is None
+    assert received.protection_level.score == 0
+    assert msg['received'] == 'from relay.example'
+    assert msg.get_content_type() == 'text/plain'
+
+
+def test_tampered_header():
+    openpgp = FakeOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp)
+    signmsg = reparse(protect(parser.parsestr(EMAIL), encrypt=False,
+                              config=conf))
+    signmsg.replace_header('Subject', 'something else')
+
+    msg = unwrap(signmsg, openpgp)
+
+    assert msg.is_tampered_header('Subject')
+    assert msg['subject'] == SUBJECT
+    assert msg.header_index['subject'].outer == 'something else'
+    assert not msg.is_tampered_header('from')
+    assert not msg.is_tampered_header('content-type')
+
+    msg.replace_header('Subject', 'changed')
+    assert msg['subject'] == 'changed'
+
+
+def test_unwrap_signed_and_encrypted_single_pass():
+    openpgp = SigningOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp)
+    encmsg = reparse(protect(parser.parsestr(EMAIL), sign=True, config=conf))
+
+    msg = unwrap(encmsg, openpgp)
+
+    assert msg['subject'] == SUBJECT
+    assert msg.protection_level.encrypted_by == set([TO])
+    assert msg.protection_level.signed_by == set([FROM])
+    assert msg.get_protected_header('subject').protection_level.score == 3
+    assert openpgp.decrypted == 1
+    assert openpgp.verified == 0
+
+    # without decrypt_verify the signature can't be checked
+    class DecryptOnly(FakeOpenPGP):
+        decrypt = openpgp.decrypt
+
+    msg = unwrap(encmsg, DecryptOnly())
+    assert msg['subject'] == SUBJECT
+    assert not msg.protection_level.signed_by
+
+    # signed by a key without an uid for the sender
+    msg = unwrap(encmsg, SigningOpenPGP(addresses=["attacker@evil.com"]))
+    assert not msg.protection_level.signed_by
+
+    openpgp.valid = False
+    msg = unwrap(encmsg, openpgp)
+    assert not msg.protection_level.signed_by
+
+
+def test_feeder_unwrap_encrypted():
+    openpgp = FakeOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp)
+    raw = protect(parser.parsestr(EMAIL), config=conf).as_string()
+
+    feeder = UnwrapFeeder(openpgp)
+    for chunk in chunks(raw.encode('utf-8'), 50):
+        feeder.feed(chunk)
+    assert ('Subject', SUBJECT) in feeder.wait_headers(timeout=5)
+    msg = feeder.close()
+
+    assert isinstance(msg, MemoryHoleMessage)
+    assert msg['subject'] == SUBJECT
+    assert msg.get_payload() == "body text\n"
+    assert msg.protection_level.encrypted_by == set([TO])
+
+
+def test_feeder_unwrap_signed_and_encrypted():
+    openpgp = SigningOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp)
+    raw = protect(parser.parsestr(EMAIL), sign=True, config=conf).as_string()
+
+    feeder = UnwrapFeeder(openpgp)
+    for chunk in chunks(raw.encode('utf-8'), 50):
+        feeder.feed(chunk)
+    msg = feeder.close()
+
+    assert msg.protection_level.signed_by == set([FROM])
+    assert openpgp.decrypted == 1
+
+
+def test_feeder_decrypts_while_receiving():
+    started = threading.Event()
+
+    class StreamingOpenPGP(FakeOpenPGP):
+        def decrypt(self, data):
+            started.set()
+            return FakeOpenPGP.decrypt(self, data)
+
+    openpgp = StreamingOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp)
+    body = "line of a long body\n" * 5000
+    plain = parser.parsestr(EMAIL.replace("body text\n", body))
+    raw = protect(plain, config=conf).as_string().encode('utf-8')
+    # up to the "--" ending the closing delimiter
+    end = raw.rindex(b'--')
+
+    feeder = UnwrapFeeder(openpgp)
+    feeder.feed(raw[:end // 2])
+    assert started.wait(5)
+    assert feeder.protected_headers is None
+
+    # the closing delimiter ends the encrypted data
+    feeder.feed(raw[end // 2:end])
+    assert ('Subject', SUBJECT) in feeder.wait_headers(timeout=5)
+    feeder.feed(raw[end:])
+    msg = feeder.close()
+    assert msg.get_payload() == body
+
+
+def test_feeder_unwrap_signed():
+    openpgp = FakeOpenPGP()
+    conf = ProtectConfig(openpgp=openpgp)
+    raw = protect(parser.parsestr(EMAIL), encrypt=False,
+                  config=conf).as_string()
+
+    feeder = UnwrapFeeder(openpgp)
+    for chunk in chunks(raw.encode('utf-8'), 50):
+        feeder.feed(chunk)
+    assert feeder.wait_headers() is None
+    msg = feeder.close()
+
+    assert msg.protection_level.signed_by == set([FROM])
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def reparse(msg):
+    return parser.parsestr(msg.as_string())
+
+
+@implementer(IOpenPGP)
+class FakeOpenPGP(object):
+
+    def __init__(self, delay=0, addresses=(FROM,)):
+        self.delay = delay
+        self.addresses = list(addresses)
+        self.active = 0
+        self.max_concurrency = 0
+        self.lock = threading.Lock()
+
+    def encrypt(self, data, encraddr):
+        return b64encode(data.encode('utf-8')).decode('ascii')
+
+    def decrypt(self, data):
+        self._wait()
+        if hasattr(data, 'read'):
+            data = data.read()
+        return b64decode(data).decode('utf-8')
+
+    def sign(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return hashlib.sha1(data).hexdigest()
+
+    def verify(self, data, signature):
+        self._wait()
+        return self.sign(data) == signature
+
+    def verify_signer(self, data, signature):
+        if self.verify(data, signature):
+            return "KEYID"
+        return None
+
+    def key_addresses(self, key_id):
+        return self.addresses
+
+    def _wait(self):
+        with self.lock:
+            self.active += 1
+            self.max_concurrency = max(self.max_concurrency, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+
+
+class BytesOpenPGP(FakeOpenPGP):
+
+    def decrypt(self, data):
+        return b64decode(data)
+
+
+class SigningOpenPGP(FakeOpenPGP):
+    """
+    Signs inside the encrypted data when encrypting with a signaddr.
+    """
+    decrypted = 0
+    verified = 0
+    valid = True
+    marker = "signed by "
+
+    def encrypt(self, data, encraddr, signaddr=None):
+        if signaddr is not None:
+            data = "%s%s\n%s" % (self.marker, signaddr, data)
+        return FakeOpenPGP.encrypt(self, data, encraddr)
+
+    def decrypt(self, data):
+        return self.decrypt_verify(data).data
+
+    def decrypt_verify(self, data):
+        self.decrypted += 1
+        data = FakeOpenPGP.decrypt(self, data)
+        signed = data.startswith(self.marker)
+        if signed:
+            data = data.split("\n", 1)[1]
+        return Decryption(data, signed, signed and self.valid,
+                          "KEYID" if signed else None)
+
+    def verify(self, data, signature):
+        self.verified += 1
+        return FakeOpenPGP.verify(self, data, signature)
@@ -0,0 +1,118 @@
+import sys
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import pytest
+
+from memoryhole import protect, unwrap, ProtectConfig
+from memoryhole.rfc3156 import encode_base64_rec
+from memoryhole.walk import (
+    MIMELimitError, MIMELimits, PartCount, copy_tree, walk
+)
+
+from tests.test_unwrap import FakeOpenPGP
+
+
+def test_walk_order():
+    msg = MIMEMultipart('mixed', _subparts=[
+        MIMEMultipart('alternative', _subparts=[MIMEText('a'),
+                                                MIMEText('b')]),
+        MIMEText('c')])
+
+    visits = list(walk(msg))
+
+    assert [v.part for v in visits] == list(msg.walk())
+    assert [v.depth for v in visits] == [0, 1, 2, 2, 1]
+    assert visits[3].parent is msg.get_payload(0)
+    assert visits[3].index == 1
+
+
+def test_deep_email_without_recursion():
+    depth = sys.getrecursionlimit() * 2
+    msg = nested(depth)
+
+    assert len(list(walk(msg))) == depth + 1
+    del leaf(msg)['content-transfer-encoding']
+    encode_base64_rec(msg)
+    assert leaf(msg)['content-transfer-encoding'] == 'base64'
+
+    copied = copy_tree(msg)
+    leaf(copied).set_payload('changed')
+    assert leaf(msg).get_payload() != 'changed'
+
+
+def test_limits():
+    with pytest.raises(MIMELimitError):
+        MIMELimits(max_depth=10).check(nested(11))
+    MIMELimits(max_depth=10).check(nested(10))
+    with pytest.raises(MIMELimitError):
+        MIMELimits(max_depth=10).check(nested(5), depth=6)
+
+    wide = MIMEMultipart('mixed', _subparts=[MIMEText('x')
+                                             for _ in range(100)])
+    with pytest.raises(MIMELimitError):
+        MIMELimits(max_parts=100).check(wide)
+    MIMELimits(max_parts=101).check(wide)
+    with pytest.raises(MIMELimitError):
+        MIMELimits(max_size=99).check(wide)
+
+
+def test_wide_email_rejected_before_walking_parts():
+    wide = MIMEMultipart('mixed', _subparts=[MIMEText('x')
+                                             for _ in range(100)])
+    seen = []
+
+    with pytest.raises(MIMELimitError):
+        for visit in walk(wide, MIMELimits(max_parts=10)):
+            seen.append(visit)
+    assert not seen
+
+
+def test_protect_and_unwrap_limits():
+    openpgp = FakeOpenPGP()
+    msg = nested(40)
+    msg['From'] = 'me@domain.com'
+    msg['To'] = 'you@other.com'
+
+    with pytest.raises(MIMELimitError):
+        protect(msg, config=ProtectConfig(openpgp=openpgp))
+
+    conf = ProtectConfig(openpgp=openpgp, limits=MIMELimits(max_depth=50))
+    encmsg = protect(msg, config=conf)
+    # the decrypted content is checked too
+    with pytest.raises(MIMELimitError):
+        unwrap(encmsg, openpgp)
+    assert unwrap(encmsg, openpgp, limits=MIMELimits(max_depth=50))
+
+
+def test_parts_counted_across_layers():
+    openpgp = FakeOpenPGP()
+    wide = MIMEMultipart('mixed', _subparts=[MIMEText('x')
+                                             for _ in range(40)])
+    wide['From'] = 'me@domain.com'
+    wide['To'] = 'you@other.com'
+    conf = ProtectConfig(openpgp=openpgp)
+    encmsg = protect(protect(wide, config=conf), config=conf)
+
+    # no layer has more than 45 parts, all together they have
+    with pytest.raises(MIMELimitError):
+        unwrap(encmsg, openpgp, limits=MIMELimits(max_parts=45))
+    assert unwrap(encmsg, openpgp, limits=MIMELimits(max_parts=50))
+
+    count = PartCount()
+    MIMELimits(max_parts=60).check(wide, count=count)
+    with pytest.raises(MIMELimitError):
+        MIMELimits(max_parts=60).check(wide, count=count)
+
+
+def nested(depth):
+    msg = MIMEText('text')
+    for _ in range(depth):
+        msg = MIMEMultipart('mixed', _subparts=[msg])
+    return msg
+
+
+def leaf(msg):
+    while msg.is_multipart():
+        msg = msg.get_payload(0)
+    return msg